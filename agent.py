@@ -1,11 +1,20 @@
 import os
-from google import genai
-from google.genai import types
-from pydantic import BaseModel, Field
-from typing import List
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import TYPE_CHECKING, Dict, List
 import asyncio
+import time
+from context import WorkingContext, extract_code
+from db import aget_task, aget_completed_steps, asave_plan, asave_step_result
+from events import bus
+from llm import generate_content, get_client
+from plans import plan_store
+from routing import AGENT_LLM_CONFIRMATIONS, DETERMINISTIC, router
+from tracing import span
 from tools import code_generator, content_generator, web_scraper, data_analyzer, execute_python_code
 
+if TYPE_CHECKING:
+    from google import genai
+
 # --- Pydantic Schemas for Structured Output ---
 
 class Step(BaseModel):
@@ -13,11 +22,33 @@ class Step(BaseModel):
     step_id: int = Field(description="Unique identifier for the step, starting from 1.")
     description: str = Field(description="A clear, concise description of the action to be taken in this step.")
     tool_required: str = Field(description="The tool required for this step (e.g., 'code_generator', 'web_scraper', 'data_analyzer', or 'none').")
+    depends_on: List[int] = Field(default_factory=list, description="The step_ids whose results this step needs. Empty if the step can start immediately.")
 
 class Plan(BaseModel):
     """The complete plan for a complex task."""
     task_goal: str = Field(description="The overall goal of the task.")
-    phases: List[Step] = Field(description="A sequential list of steps to achieve the task goal.")
+    phases: List[Step] = Field(description="The list of steps to achieve the task goal, with their dependencies.")
+
+    @model_validator(mode="after")
+    def check_step_ids(self) -> "Plan":
+        """Steps are keyed by step_id: duplicate ids or dependencies on missing steps make the plan invalid."""
+        ids = [step.step_id for step in self.phases]
+        duplicates = sorted({step_id for step_id in ids if ids.count(step_id) > 1})
+        if duplicates:
+            raise ValueError(f"duplicate step_id values: {duplicates}")
+        unknown = sorted({dep for step in self.phases for dep in step.depends_on if dep not in ids})
+        if unknown:
+            raise ValueError(f"depends_on references unknown step_id values: {unknown}")
+        return self
+
+# Maximum number of steps of a single task that may run at the same time
+MAX_PARALLEL_STEPS = int(os.environ.get("AGENT_MAX_PARALLEL_STEPS", "4"))
+
+def fallback_plan(task_description: str) -> Plan:
+    """One-step plan used when the model's structured output cannot be parsed."""
+    return Plan(task_goal=task_description, phases=[
+        Step(step_id=1, description="Erro no planejamento. Tentar novamente.", tool_required="none")
+    ])
 
 # --- Autonomous Agent Class ---
 
@@ -25,13 +56,18 @@ class AutonomousAgent:
     """
     An autonomous agent that plans and executes complex tasks using the Gemini API.
     """
-    def __init__(self, task_id: str, model_name: str = 'gemini-2.5-flash'):
-        """Initializes the Gemini client."""
-        # Assumes GEMINI_API_KEY is set in the environment
-        self.client = genai.Client()
-        self.model_name = model_name
+    def __init__(self, task_id: str, model_name: str = None, max_parallel_steps: int = MAX_PARALLEL_STEPS,
+                 client: "genai.Client" = None):
+        """
+        Initializes the agent on the shared, process-wide Gemini client.
+        `model_name` overrides the planning model chosen by `routing.router`.
+        """
+        self.client = client or get_client()
+        self.model_name = model_name or router.model_for("planning")
         self.task_id = task_id
+        self.max_parallel_steps = max(1, max_parallel_steps)
         self.history = [] # To maintain conversation history for context
+        self.context: WorkingContext = None # Step results of the plan being executed
 
     async def create_plan(self, task_description: str) -> Plan:
         """
@@ -40,119 +76,287 @@ class AutonomousAgent:
         print(f"-> Gerando plano para a tarefa: {task_description}")
         
         prompt = (
-            f"Você é um planejador de tarefas autônomo. Sua função é transformar uma tarefa complexa em um plano sequencial de passos. "
+            f"Você é um planejador de tarefas autônomo. Sua função é transformar uma tarefa complexa em um plano de passos. "
             f"A tarefa é: '{task_description}'. "
             f"Crie um plano detalhado, identificando o objetivo principal e uma lista de fases (steps). "
-            f"Para cada passo, indique a ferramenta necessária ('code_generator', 'web_scraper', 'data_analyzer', ou 'none')."
+            f"Para cada passo, indique a ferramenta necessária ('code_generator', 'web_scraper', 'data_analyzer', ou 'none'). "
+            f"Em 'depends_on', liste apenas os step_id cujos resultados o passo realmente precisa; "
+            f"passos independentes devem ter 'depends_on' vazio para que possam ser executados em paralelo."
         )
 
-        try:
-            # Run the synchronous call in a separate thread
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+        with span("plan.create", model=self.model_name) as current:
+            # Gemini errors (after the scheduler's retries) propagate and fail the task
+            response_text = await generate_content(
+                self.client,
                 model=self.model_name,
                 contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=Plan,
-                ),
+                response_schema=Plan,
+                route="planning",
             )
-            
-            # The response.text will be a JSON string conforming to the Plan schema
-            return Plan.model_validate_json(response.text)
-        
-        except Exception as e:
-            print(f"Erro ao gerar o plano: {e}")
-            # Fallback to a simple plan if structured output fails
-            return Plan(task_goal=task_description, phases=[
-                Step(step_id=1, description="Erro no planejamento. Tentar novamente.", tool_required="none")
-            ])
 
-    async def execute_step(self, step: Step, context: str) -> str:
+            try:
+                # The response text will be a JSON string conforming to the Plan schema
+                plan = Plan.model_validate_json(response_text)
+                current.set("steps", len(plan.phases))
+                return plan
+
+            except ValidationError as e:
+                print(f"Erro ao gerar o plano: {e}")
+                current.set("fallback", True)
+                # Fallback to a simple plan if structured output fails
+                return fallback_plan(task_description)
+
+    async def plan_task(self, task_description: str) -> tuple[Plan, bool]:
+        """
+        Returns the plan for the task and whether it came from the plan cache (see plans.PlanStore).
+        Tasks with the same shape as an earlier one reuse its plan, with their own parameters
+        substituted, instead of a planning call; new plans are stored for the next ones.
+        """
+        with span("plan", route="planning") as current:
+            cached = await plan_store.lookup(task_description)
+            if cached is not None:
+                try:
+                    plan = Plan.model_validate(cached)
+                    router.record("planning", DETERMINISTIC, 0.0)
+                    current.set("cache_hit", True)
+                    print("-> Plano reaproveitado do cache de planos")
+                    return plan, True
+                except ValidationError as e:
+                    print(f"Plano em cache inválido, gerando um novo: {e}")
+
+            current.set("cache_hit", False)
+            plan = await self.create_plan(task_description)
+            if plan != fallback_plan(task_description):
+                await plan_store.store(task_description, plan.model_dump())
+            return plan, False
+
+    async def execute_step(self, step: Step, context: WorkingContext) -> str:
         """
-        Simulates the execution of a single step. This will be expanded in Phase 5.
-        This function dispatches the task to the appropriate tool.
+        Dispatches a single step to the appropriate tool. Steps that use previous results
+        receive the token-budgeted view of `context` (see context.WorkingContext).
         """
         print(f"-> Executando Passo {step.step_id}: {step.description} (Ferramenta: {step.tool_required})")
+
+        # Partial LLM output is streamed to /status/{task_id}/stream as it arrives
+        def on_delta(text: str):
+            bus.publish(self.task_id, "step_delta", {"step_id": step.step_id, "text": text})
         
         # Dispatch to the appropriate tool based on the plan
         if step.tool_required == 'code_generator':
+            # A description that already contains the code needs no model call
+            code = extract_code(step.description)
+            if code is not None:
+                router.record("code_generator", DETERMINISTIC, 0.0)
+                return code
             # For code generation, the description is the prompt for the code
-            return await asyncio.to_thread(code_generator, self.client, prompt=step.description)
+            return await code_generator(self.client, prompt=step.description, on_delta=on_delta)
         
         elif step.tool_required == 'code_execution':
-            # Execute the code generated in the previous step (which is in the context)
-            # We assume the previous step's result is the code to execute
-            # For a more robust system, we would need to parse the code from the context
-            return await asyncio.to_thread(execute_python_code, context)
+            # Execute the code produced by the previous steps (extracted from their results)
+            code = context.code_for(step.step_id)
+            if code is None:
+                return "Erro de Execução: nenhum código Python encontrado nos resultados dos passos anteriores."
+            started = time.monotonic()
+            output = await execute_python_code(code)
+            router.record("code_execution", DETERMINISTIC, time.monotonic() - started)
+            return output
         
         elif step.tool_required == 'content_generator':
             # For content generation, the description is the prompt for the content
-            return await asyncio.to_thread(content_generator, self.client, prompt=step.description)
+            return await content_generator(self.client, prompt=step.description, on_delta=on_delta)
             
         elif step.tool_required == 'web_scraper':
             # The web scraper now takes the objective and uses its internal logic
-            return await asyncio.to_thread(web_scraper, self.client, objective=step.description)
+            return await web_scraper(self.client, objective=step.description, on_delta=on_delta)
             
         elif step.tool_required == 'data_analyzer':
-            # In a real scenario, we would pass the actual data from the context
-            # For this prototype, we'll use a simplified simulation
-            return await asyncio.to_thread(data_analyzer, self.client, data_summary=context, analysis_objective=step.description)
+            # The data are the (token-budgeted) results of the previous steps
+            return await data_analyzer(self.client, data_summary=context.view(step.step_id),
+                                       analysis_objective=step.description, on_delta=on_delta)
             
         elif step.tool_required == 'none':
-            # If no tool is required, use the model to confirm or perform a simple task
+            if not AGENT_LLM_CONFIRMATIONS:
+                return self.confirm_step(step, context)
+            # Model confirmation (AGENT_LLM_CONFIRMATIONS=1), on the lite route
             prompt = (
                 f"Confirme a conclusão do passo: '{step.description}'. "
-                f"Contexto anterior: {context}. "
+                f"Contexto anterior: {context.view(step.step_id)}. "
                 f"Forneça uma breve confirmação e um resumo do estado atual."
             )
-            try:
-                # Run the synchronous call in a separate thread
-                response = await asyncio.to_thread(
-                    self.client.models.generate_content,
-                    model=self.model_name,
-                    contents=prompt
-                )
-                return response.text
-            except Exception as e:
-                return f"Erro na execução do passo 'none': {e}"
+            return await generate_content(
+                self.client,
+                model=router.model_for("none"),
+                contents=prompt,
+                on_delta=on_delta,
+                route="none",
+            )
         
         else:
             return f"Ferramenta desconhecida: {step.tool_required}"
 
+    @staticmethod
+    def confirm_step(step: Step, context: WorkingContext) -> str:
+        """
+        Deterministic answer for steps without a tool: a confirmation followed by the results
+        of the step's dependencies, so they still reach the final result. No model call.
+        """
+        confirmation = f"Passo {step.step_id} concluído: {step.description}"
+        previous = context.render(context.dependencies.get(step.step_id, []))
+        router.record("none", DETERMINISTIC, 0.0)
+        return f"{confirmation}\n\n{previous}" if previous else confirmation
+
+    @staticmethod
+    def resolve_dependencies(plan: Plan) -> Dict[int, List[int]]:
+        """
+        Returns the validated dependency graph of a plan as {step_id: [dependency step_ids]}.
+
+        Step ids are unique and dependencies point to existing steps (see Plan.check_step_ids).
+        Self-references are dropped. If the remaining graph has a cycle, the plan falls back to
+        sequential execution (each step depends on the previous one).
+        """
+        dependencies = {
+            step.step_id: sorted({dep for dep in step.depends_on if dep != step.step_id})
+            for step in plan.phases
+        }
+
+        # Kahn's algorithm: if not every step can be ordered, there is a cycle
+        pending = {step_id: len(deps) for step_id, deps in dependencies.items()}
+        ready = [step_id for step_id, count in pending.items() if count == 0]
+        ordered = 0
+        while ready:
+            current = ready.pop()
+            ordered += 1
+            for step_id, deps in dependencies.items():
+                if current in deps:
+                    pending[step_id] -= 1
+                    if pending[step_id] == 0:
+                        ready.append(step_id)
+
+        if ordered != len(dependencies):
+            print("Aviso: dependências cíclicas no plano. Executando os passos em sequência.")
+            ids = [step.step_id for step in plan.phases]
+            return {step_id: ids[:i][-1:] for i, step_id in enumerate(ids)}
+
+        return dependencies
+
+    async def execute_plan(self, plan: Plan, completed: Dict[int, str] = None) -> Dict[int, str]:
+        """
+        Executes the plan as a DAG: each step starts as soon as its dependencies finish,
+        with at most `max_parallel_steps` steps running at once. Returns {step_id: result}.
+
+        Steps present in `completed` (checkpointed by a previous run) are not executed again;
+        their stored results are used instead. Every finished step is checkpointed in `task_steps`
+        and recorded in `self.context`, which builds the context handed to the following steps.
+        """
+        completed = completed or {}
+        dependencies = self.resolve_dependencies(plan)
+        steps = {step.step_id: step for step in plan.phases}
+        results: Dict[int, str] = {}
+        self.context = WorkingContext(dependencies)
+        running: Dict[int, asyncio.Task] = {}
+        slots = asyncio.Semaphore(self.max_parallel_steps)
+
+        async def run_step(step: Step) -> str:
+            if step.step_id in completed:
+                results[step.step_id] = completed[step.step_id]
+                self.context.record(step.step_id, step.description, step.tool_required, completed[step.step_id])
+                return completed[step.step_id]
+
+            # Wait for the dependencies; a failure in any of them propagates here
+            await asyncio.gather(*(running[dep] for dep in dependencies[step.step_id]))
+            ready = time.monotonic()
+            async with slots:
+                bus.publish(self.task_id, "step_started", {
+                    "step_id": step.step_id, "description": step.description, "tool_required": step.tool_required,
+                })
+                with span("step.execute", step_id=step.step_id, tool=step.tool_required) as current:
+                    # Time spent waiting for a free slot (max_parallel_steps) once the dependencies were done
+                    current.queue_wait = time.monotonic() - ready
+                    try:
+                        result = await self.execute_step(step, self.context)
+                    except Exception as e:
+                        await asave_step_result(self.task_id, step.step_id, "FAILED", str(e))
+                        raise
+            print(f"\n[Resultado do Passo {step.step_id}]")
+            print(result)
+            results[step.step_id] = result
+            self.context.record(step.step_id, step.description, step.tool_required, result)
+            await asave_step_result(self.task_id, step.step_id, "COMPLETED", result)
+            bus.publish(self.task_id, "step_finished", {"step_id": step.step_id, "result": result})
+            return result
+
+        # Create the tasks in topological order so every dependency already has a task
+        remaining = dict(dependencies)
+        while remaining:
+            for step_id, deps in list(remaining.items()):
+                if all(dep in running for dep in deps):
+                    running[step_id] = asyncio.create_task(run_step(steps[step_id]))
+                    del remaining[step_id]
+
+        try:
+            await asyncio.gather(*running.values())
+        except BaseException:
+            for task in running.values():
+                task.cancel()
+            raise
+
+        return results
+
+    async def load_checkpoint(self) -> tuple[Plan | None, Dict[int, str]]:
+        """Returns the stored plan and the results of its completed steps, if a previous run saved them."""
+        task = await aget_task(self.task_id)
+        if not task or not task.get("plan"):
+            return None, {}
+        try:
+            plan = Plan.model_validate_json(task["plan"])
+        except ValidationError as e:
+            # Saved before plans were checked for duplicate/unknown step ids: plan again
+            print(f"Plano salvo inválido, gerando um novo: {e}")
+            return None, {}
+        return plan, await aget_completed_steps(self.task_id)
+
     async def run(self, task_description: str, update_db_status: callable):
         """
-        Main execution loop: plans the task and executes the steps sequentially.
+        Main execution loop: plans the task and executes the steps as a dependency graph.
+        `update_db_status` is a coroutine function such as `db.aupdate_task_status`.
+
+        If a previous run of the same task (crashed worker or manual retry) left a checkpoint,
+        the stored plan is reused and only the incomplete steps are executed.
         """
         # 1. Update DB status to IN_PROGRESS
-        update_db_status(self.task_id, "IN_PROGRESS")
+        await update_db_status(self.task_id, "IN_PROGRESS")
+        bus.publish(self.task_id, "task_started", {"task_description": task_description})
         
-        plan = await self.create_plan(task_description)
+        plan, completed = await self.load_checkpoint()
+        cached = False
+        if plan is None:
+            plan, cached = await self.plan_task(task_description)
+            if plan != fallback_plan(task_description):
+                await asave_plan(self.task_id, plan.model_dump_json())
+        else:
+            print(f"-> Retomando a tarefa {self.task_id}: {len(completed)} passo(s) já concluído(s)")
+        bus.publish(self.task_id, "plan_created", {
+            **plan.model_dump(), "resumed_steps": sorted(completed), "cached_plan": cached,
+        })
         print("\n--- Plano Gerado ---")
         print(f"Objetivo: {plan.task_goal}")
         for step in plan.phases:
-            print(f"  [{step.step_id}] {step.description} (Ferramenta: {step.tool_required})")
+            depends = f", depende de: {step.depends_on}" if step.depends_on else ""
+            print(f"  [{step.step_id}] {step.description} (Ferramenta: {step.tool_required}{depends})")
         print("--------------------\n")
 
-        current_context = "Início da execução. Nenhum resultado anterior."
-        
-        for step in plan.phases:
-            # 2. Execute step
-            result = await self.execute_step(step, current_context)
-            print(f"\n[Resultado do Passo {step.step_id}]")
-            print(result)
-            
-            # Update context for the next step
-            current_context = f"Resultado do Passo {step.step_id}: {result}"
-            
-            # 3. Update DB with current context (optional, for detailed logging)
-            # update_db_status(self.task_id, "IN_PROGRESS", current_context)
+        # 2. Execute the steps; independent steps run concurrently
+        results = await self.execute_plan(plan, completed)
+
+        # The final result is made of the steps no other step depends on
+        dependencies = self.resolve_dependencies(plan)
+        needed = {dep for deps in dependencies.values() for dep in deps}
+        final_steps = [step.step_id for step in plan.phases if step.step_id not in needed]
+        current_context = self.context.render(final_steps)
 
         print("\n--- Tarefa Concluída ---")
         
-        # 4. Final update to DB status
-        update_db_status(self.task_id, "COMPLETED", current_context)
+        # 3. Final update to DB status
+        await update_db_status(self.task_id, "COMPLETED", current_context)
         
         return current_context
-
-
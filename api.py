@@ -1,19 +1,50 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
 import asyncio
+import base64
+import hmac
 import os
 import json
+import time
 import uuid
-import httpx
+from urllib.parse import urlparse
 
-# Import the agent and database modules
-from agent import AutonomousAgent
-from db import init_db, create_task, update_task_status, get_task
+# Import the database module (tasks are executed by worker.py, not by the API process)
+from db import (
+    DEFAULT_TENANT, TASK_DEFAULT_PRIORITY, TERMINAL_STATUSES, init_db, warm_up, acreate_or_attach_task,
+    acreate_or_attach_tasks, aget_task, aget_tasks, alist_tasks, aretry_task, acancel_task, alist_dead_letters,
+    aredrive_dead_letters, aplan_cache_stats, aget_task_spans,
+)
+from events import EVENTS_RELAY_TOKEN, bus
+from tracing import exposition
 
-# Initialize the database on startup
-init_db()
+# Comment lines sent on idle SSE streams so proxies do not close them
+SSE_KEEPALIVE_SECONDS = 15
+# How often an open stream re-reads the task, to end it when the task finished without its final event
+# reaching this process (no EVENTS_RELAY_URL, or the relay targets another API process)
+SSE_STATUS_POLL_SECONDS = float(os.environ.get("SSE_STATUS_POLL_SECONDS", "2"))
+# Maximum tasks per POST /webhook/batch and ids per POST /status/batch
+WEBHOOK_BATCH_MAX_ITEMS = int(os.environ.get("WEBHOOK_BATCH_MAX_ITEMS", "50000"))
+# Open the DB writer and reader connections at startup instead of on the first requests
+API_PREWARM = os.environ.get("API_PREWARM", "1") == "1"
 
-app = FastAPI(title="7z IA Exclusive - Autonomous Agent API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Runs once per server process, before the first request is accepted: creates or migrates the
+    schema (a no-op once tasks.db is at SCHEMA_VERSION) and optionally pre-warms the DB connections.
+    Nothing touches the database at import time.
+    """
+    await asyncio.to_thread(init_db)
+    if API_PREWARM:
+        await asyncio.to_thread(warm_up)
+    yield
+
+app = FastAPI(title="7z IA Exclusive - Autonomous Agent API", lifespan=lifespan)
 
 # --- Request/Response Schemas ---
 
@@ -21,97 +52,413 @@ class WebhookRequest(BaseModel):
     """Schema for the incoming webhook request."""
     task_description: str
     callback_url: str = None # URL to send the final result
+    callback_batch: bool = False # Receiver accepts {"results": [...]} with several results per POST
+    priority: int = Field(TASK_DEFAULT_PRIORITY, ge=0, le=9) # Higher first; >= TASK_INTERACTIVE_PRIORITY is interactive
+    tenant: Optional[str] = Field(None, min_length=1) # Fair-share unit; defaults to the callback_url host
+    deadline: Optional[datetime] = None # Cancelled if not finished by then (naive datetimes are UTC)
+
+    @field_validator("deadline")
+    @classmethod
+    def deadline_in_future(cls, value: Optional[datetime]) -> Optional[datetime]:
+        if value is not None:
+            value = value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+            if value <= datetime.now(timezone.utc):
+                raise ValueError("deadline must be in the future")
+        return value
+
+    def scheduling(self) -> Dict[str, Any]:
+        """Priority, tenant and deadline (epoch seconds) as stored in the tasks table."""
+        callback_host = urlparse(self.callback_url).hostname if self.callback_url else None
+        return {
+            "priority": self.priority,
+            "tenant": self.tenant or callback_host or DEFAULT_TENANT,
+            "deadline_at": self.deadline.timestamp() if self.deadline else None,
+        }
 
 class WebhookResponse(BaseModel):
     """Schema for the immediate response to the webhook."""
     status: str
     message: str
     task_id: str
+    duplicate: bool = False # True when the request was attached to an existing task
+    result: Optional[str] = None # Stored result, for duplicates of a task that already finished
 
-# --- Helper Function for Callback ---
+class BatchWebhookItem(WebhookRequest):
+    """One task of POST /webhook/batch (the Idempotency-Key travels inside each item)."""
+    idempotency_key: Optional[str] = None
 
-async def send_callback(task_id: str, callback_url: str, final_result: str):
-    """Sends the final result to the callback URL."""
-    print(f"Enviando resultado da tarefa {task_id} para {callback_url}")
-    
-    payload = {
-        "task_id": task_id,
-        "status": "COMPLETED",
-        "result": final_result
-    }
-    
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(callback_url, json=payload)
-            response.raise_for_status()
-            print(f"Callback enviado com sucesso. Status: {response.status_code}")
-    except httpx.HTTPStatusError as e:
-        print(f"Erro HTTP ao enviar callback: {e}")
-    except httpx.RequestError as e:
-        print(f"Erro de requisição ao enviar callback: {e}")
-    except Exception as e:
-        print(f"Erro desconhecido ao enviar callback: {e}")
+class StatusBatchRequest(BaseModel):
+    """Schema for POST /status/batch."""
+    task_ids: List[str]
 
-# --- Background Task for Agent Execution ---
+# --- Batch Helpers ---
 
-async def run_agent_task(task_id: str, task_description: str, callback_url: str):
+async def read_batch_items(request: Request) -> List[BatchWebhookItem]:
     """
-    Executes the autonomous agent's task, updates the DB, and sends the result via callback.
+    Parses the body of POST /webhook/batch: a JSON array, or NDJSON (one object per line) when the
+    Content-Type is application/x-ndjson. NDJSON is parsed as it streams in.
     """
-    final_result = ""
-    
-    # Check for API Key
-    if "GEMINI_API_KEY" not in os.environ:
-        final_result = "ERRO: GEMINI_API_KEY não configurada no ambiente do servidor."
-        update_task_status(task_id, "FAILED", final_result)
+    raw_items = []
+    if "ndjson" in request.headers.get("content-type", ""):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            raw_items.extend(line for line in lines if line.strip())
+            if len(raw_items) > WEBHOOK_BATCH_MAX_ITEMS:
+                break
+        if buffer.strip():
+            raw_items.append(buffer)
     else:
         try:
-            # The agent now takes the task_id and a function to update the DB status
-            agent = AutonomousAgent(task_id=task_id)
-            final_result = await agent.run(task_description, update_task_status)
-            
-        except Exception as e:
-            final_result = f"ERRO CRÍTICO durante a execução do agente: {e}"
-            update_task_status(task_id, "FAILED", final_result)
-
-    # Send Result via Callback
-    if callback_url:
-        await send_callback(task_id, callback_url, final_result)
-    else:
-        print(f"Tarefa {task_id} concluída, mas sem URL de callback para envio do resultado.")
+            raw_items = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+        if not isinstance(raw_items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+
+    if len(raw_items) > WEBHOOK_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {WEBHOOK_BATCH_MAX_ITEMS} tasks per batch")
+
+    items = []
+    for index, raw in enumerate(raw_items):
+        try:
+            if isinstance(raw, bytes):
+                items.append(BatchWebhookItem.model_validate_json(raw))
+            else:
+                items.append(BatchWebhookItem.model_validate(raw))
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail={"index": index, "errors": json.loads(e.json())})
+    return items
+
+def db_timestamp(value: datetime) -> str:
+    """Formats a datetime like SQLite's CURRENT_TIMESTAMP (UTC), as stored in tasks.created_at."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+def encode_cursor(task: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([task["created_at"], task["_rowid"]]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), int(rowid)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# --- Task Event Streams ---
+
+def _final_event_from_db(task: Dict[str, Any]) -> Dict[str, Any] | None:
+    """Builds the terminal event of a task that finished before any event reached this process."""
+    if task["status"] == "COMPLETED":
+        return {"id": 0, "task_id": task["id"], "type": "task_completed", "data": {"result": task["result"]}}
+    if task["status"] == "FAILED":
+        return {"id": 0, "task_id": task["id"], "type": "task_failed", "data": {"error": task["result"]}}
+    if task["status"] == "CANCELLED":
+        return {"id": 0, "task_id": task["id"], "type": "task_cancelled", "data": {"reason": task["result"]}}
+    return None
+
+async def task_event_stream(task: Dict[str, Any], after_id: int = 0) -> AsyncIterator[Dict[str, Any] | None]:
+    """
+    Yields the task's progress events from the in-process bus (fed by the workers' relay),
+    or None every SSE_KEEPALIVE_SECONDS while idle. While waiting, the task is re-read every
+    SSE_STATUS_POLL_SECONDS: once it is in a terminal status, its final event is built from
+    the database row and the stream ends, even if no event ever reached this process.
+    """
+    task_id = task["id"]
+    if not bus.history(task_id):
+        final_event = _final_event_from_db(task)
+        if final_event is not None:
+            yield final_event
+            return
+
+    events = bus.subscribe(task_id, after_id)
+    pending = asyncio.ensure_future(events.__anext__())
+    last_sent = time.monotonic()
+    try:
+        while True:
+            done, _ = await asyncio.wait({pending}, timeout=min(SSE_STATUS_POLL_SECONDS, SSE_KEEPALIVE_SECONDS))
+            if not done:
+                current = await aget_task(task_id, include_result=False)
+                if current is None or current["status"] in TERMINAL_STATUSES:
+                    final_event = _final_event_from_db(await aget_task(task_id)) if current else None
+                    if final_event is not None:
+                        yield final_event
+                    return
+                if time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                    last_sent = time.monotonic()
+                    yield None
+                continue
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                return
+            last_sent = time.monotonic()
+            yield event
+            pending = asyncio.ensure_future(events.__anext__())
+    finally:
+        # The subscription can only be closed once its cancelled __anext__ has finished
+        pending.cancel()
+        try:
+            await pending
+        except (asyncio.CancelledError, StopAsyncIteration):
+            pass
+        await events.aclose()
 
 # --- API Endpoints ---
 
 @app.post("/webhook", response_model=WebhookResponse)
-async def handle_webhook(request: WebhookRequest, background_tasks: BackgroundTasks):
+async def handle_webhook(request: WebhookRequest, idempotency_key: str = Header(None)):
     """
-    Receives a task via webhook and starts the autonomous agent in the background.
+    Receives a task via webhook and enqueues it for the worker pool.
+
+    Re-submissions (same Idempotency-Key header or, without one, the same description and
+    callback_url within WEBHOOK_DEDUP_WINDOW_SECONDS) do not start a new run: they get the
+    existing task_id, plus its stored result if it already finished.
+
+    Workers run higher `priority` tasks first and share capacity fairly between tenants
+    (TENANT_WEIGHTS); a task with a `deadline` is cancelled if it has not finished by then.
     """
     task_id = str(uuid.uuid4()) # Generate a unique task ID
     
-    # 1. Create task in DB with PENDING status
-    create_task(task_id, request.task_description, request.callback_url)
-    
-    # 2. Start the agent execution in a background task
-    background_tasks.add_task(run_agent_task, task_id, request.task_description, request.callback_url)
-    
+    # Create task in DB with PENDING status; a worker process (worker.py) claims and runs it
+    task, created = await acreate_or_attach_task(
+        task_id, request.task_description, request.callback_url, request.callback_batch, idempotency_key,
+        **request.scheduling()
+    )
+    if created:
+        return WebhookResponse(
+            status="pending",
+            message=f"Tarefa '{request.task_description}' recebida e enfileirada para execução. Acompanhe o status em /status/{task_id}.",
+            task_id=task_id
+        )
+
+    if task["task_description"] != request.task_description:
+        raise HTTPException(status_code=409, detail="Idempotency-Key already used for a different task")
     return WebhookResponse(
-        status="pending",
-        message=f"Tarefa '{request.task_description}' recebida e iniciada em segundo plano. Acompanhe o status em /status/{task_id}.",
-        task_id=task_id
+        status=task["status"].lower(),
+        message=f"Pedido duplicado: anexado à tarefa existente {task['id']}. Acompanhe o status em /status/{task['id']}.",
+        task_id=task["id"],
+        duplicate=True,
+        result=task["result"] if task["status"] == "COMPLETED" else None
+    )
+
+@app.post("/webhook/batch")
+async def handle_webhook_batch(request: Request):
+    """
+    Receives many tasks at once (JSON array or NDJSON of WebhookRequest objects, each with an
+    optional idempotency_key) and inserts them in a single transaction. Duplicates are coalesced
+    exactly as in /webhook. The response lists the task of each item, in order.
+    """
+    items = await read_batch_items(request)
+    requests = [
+        {**item.model_dump(exclude={"deadline"}), **item.scheduling(), "task_id": str(uuid.uuid4())}
+        for item in items
+    ]
+    outcomes = await acreate_or_attach_tasks(requests)
+
+    tasks, counts = [], {"created": 0, "duplicates": 0, "conflicts": 0}
+    for item, (task, created) in zip(items, outcomes):
+        if created:
+            counts["created"] += 1
+            tasks.append({"task_id": task["id"], "status": "pending", "duplicate": False})
+        elif task["task_description"] != item.task_description:
+            counts["conflicts"] += 1
+            tasks.append({"task_id": None, "status": "conflict", "duplicate": False,
+                          "detail": "Idempotency-Key already used for a different task"})
+        else:
+            counts["duplicates"] += 1
+            tasks.append({"task_id": task["id"], "status": task["status"].lower(), "duplicate": True})
+    return {**counts, "tasks": tasks}
+
+@app.get("/tasks")
+async def list_tasks(status: Optional[str] = None, created_after: Optional[datetime] = None,
+                     created_before: Optional[datetime] = None, cursor: Optional[str] = None,
+                     limit: int = Query(100, ge=1, le=1000), include_result: bool = False):
+    """
+    Lists tasks, newest first, filtered by status and creation time. Pass the returned
+    `next_cursor` as `cursor` to get the next page (keyset pagination, stable under inserts).
+    """
+    tasks = await alist_tasks(
+        status.upper() if status else None,
+        db_timestamp(created_after) if created_after else None,
+        db_timestamp(created_before) if created_before else None,
+        decode_cursor(cursor) if cursor else None,
+        limit,
+        include_result,
     )
+    next_cursor = encode_cursor(tasks[-1]) if len(tasks) == limit else None
+    for task in tasks:
+        del task["_rowid"]
+    return {"tasks": tasks, "next_cursor": next_cursor}
+
+@app.post("/status/batch")
+async def get_task_status_batch(request: StatusBatchRequest, include_result: bool = True):
+    """Retrieves the status (and result) of many tasks with one request and one query per 900 ids."""
+    if len(request.task_ids) > WEBHOOK_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {WEBHOOK_BATCH_MAX_ITEMS} ids per request")
+    tasks = await aget_tasks(request.task_ids, include_result)
+    return {
+        "tasks": [tasks[task_id] for task_id in dict.fromkeys(request.task_ids) if task_id in tasks],
+        "missing": [task_id for task_id in dict.fromkeys(request.task_ids) if task_id not in tasks],
+    }
 
 @app.get("/status/{task_id}")
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, include_result: bool = True):
     """
-    Retrieves the current status and result of a task.
+    Retrieves the current status and result of a task. With `include_result=false` only the
+    metadata (status, attempts, result_size, timestamps...) is read, without loading the result.
     """
-    task = get_task(task_id)
+    task = await aget_task(task_id, include_result)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     return task
 
+@app.get("/tasks/{task_id}/trace")
+async def get_task_trace(task_id: str):
+    """
+    The task's execution timeline: every span (task run, planning, steps, tools, Gemini calls,
+    DB writes, callbacks) with its offset from the first span, wall time, queue wait and attributes,
+    plus per-span-name totals.
+    """
+    task = await aget_task(task_id, include_result=False)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    spans = await aget_task_spans(task_id)
+    origin = spans[0]["started_at"] if spans else 0.0
+    summary: Dict[str, Dict[str, Any]] = {}
+    for span in spans:
+        span["offset"] = round(span["started_at"] - origin, 6)
+        totals = summary.setdefault(span["name"], {"count": 0, "duration": 0.0, "queue_wait": 0.0, "errors": 0})
+        totals["count"] += 1
+        totals["duration"] += span["duration"]
+        totals["queue_wait"] += span["queue_wait"]
+        totals["errors"] += span["status"] != "ok"
+        for key in ("prompt_tokens", "response_tokens", "retries"):
+            if key in span["attributes"]:
+                totals[key] = totals.get(key, 0) + span["attributes"][key]
+
+    return {"task_id": task_id, "status": task["status"], "spans": spans, "summary": summary}
+
+@app.post("/tasks/{task_id}/retry", response_model=WebhookResponse)
+async def retry_task(task_id: str):
+    """
+    Re-enqueues a failed task. The worker resumes it from the first incomplete step,
+    reusing the stored plan and the results of the steps already completed.
+    """
+    task = await aget_task(task_id, include_result=False)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if not await aretry_task(task_id):
+        raise HTTPException(status_code=409, detail=f"Only FAILED tasks can be retried (current status: {task['status']})")
+
+    return WebhookResponse(
+        status="pending",
+        message=f"Tarefa {task_id} reenfileirada; a execução continua a partir do primeiro passo incompleto.",
+        task_id=task_id
+    )
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    """
+    Cancels a pending or running task. A running agent is interrupted by its worker within
+    WORKER_CANCEL_CHECK_INTERVAL; the callback (if any) receives the CANCELLED status.
+    """
+    task = await acancel_task(task_id, "Tarefa cancelada pelo cliente.")
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task["status"] in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Task already finished (status: {task['status']})")
+
+    bus.publish(task_id, "task_cancelled", {"reason": "Tarefa cancelada pelo cliente."})
+    return {"task_id": task_id, "status": "cancelled", "previous_status": task["status"]}
+
+@app.get("/callbacks/dead-letters")
+async def list_dead_letters(limit: int = 100):
+    """Lists the callbacks that could not be delivered (most recent first)."""
+    return await alist_dead_letters(limit)
+
+@app.post("/callbacks/dead-letters/redrive")
+async def redrive_all_dead_letters():
+    """Moves every dead-lettered callback back to the outbox for a new round of attempts."""
+    return {"redriven": await aredrive_dead_letters()}
+
+@app.post("/callbacks/dead-letters/{dead_letter_id}/redrive")
+async def redrive_dead_letter(dead_letter_id: int):
+    """Moves one dead-lettered callback back to the outbox."""
+    if not await aredrive_dead_letters(dead_letter_id):
+        raise HTTPException(status_code=404, detail="Dead letter not found")
+    return {"redriven": 1}
+
+@app.get("/plans/cache")
+async def plan_cache_stats(top: int = 10):
+    """Plan cache totals across all workers: stored task shapes, reuses, hit rate and the most reused shapes."""
+    return await aplan_cache_stats(top)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of the API process (workers expose theirs on WORKER_METRICS_PORT)."""
+    body, content_type = exposition()
+    return Response(body, media_type=content_type)
+
+@app.get("/status/{task_id}/stream")
+async def stream_task_status(task_id: str, last_event_id: int = Header(0)):
+    """
+    Streams the task's progress as Server-Sent Events: plan creation, step start/finish,
+    partial LLM output and the final result. Reconnecting clients resume via Last-Event-ID.
+    """
+    task = await aget_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def sse():
+        async for event in task_event_stream(task, last_event_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(sse(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/status/{task_id}/ws")
+async def websocket_task_status(websocket: WebSocket, task_id: str, after: int = 0):
+    """WebSocket variant of /status/{task_id}/stream: one JSON message per event."""
+    await websocket.accept()
+    task = await aget_task(task_id)
+    if not task:
+        await websocket.close(code=4404, reason="Task not found")
+        return
+
+    try:
+        async for event in task_event_stream(task, after):
+            if event is not None:
+                await websocket.send_json(event)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+@app.post("/internal/events", include_in_schema=False)
+async def relay_events(events: List[Dict[str, Any]], x_relay_token: str = Header("")):
+    """
+    Receives the progress events published by worker processes (see events.EventRelay).
+    Disabled unless EVENTS_RELAY_TOKEN is set; events of unknown tasks are dropped.
+    """
+    if not EVENTS_RELAY_TOKEN:
+        raise HTTPException(status_code=404, detail="Event relay disabled (EVENTS_RELAY_TOKEN not set)")
+    if not hmac.compare_digest(x_relay_token.encode("utf-8"), EVENTS_RELAY_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid relay token")
+    task_ids = list({event.get("task_id") for event in events if isinstance(event.get("task_id"), str)})
+    known = await aget_tasks(task_ids, include_result=False) if task_ids else {}
+    delivered = 0
+    for event in events:
+        if event.get("task_id") in known:
+            bus.deliver(event)
+            delivered += 1
+    return {"delivered": delivered, "dropped": len(events) - delivered}
+
 @app.get("/")
 async def root():
     return {"message": "7z IA Exclusive API está online. Use o endpoint /webhook para enviar tarefas e /status/{task_id} para verificar o progresso."}
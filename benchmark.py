@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from fakes import sites_config
+
+# End-to-end load test, fully offline: the API and the workers run as separate processes against
+# fakes.py (Gemini, scraped sites and the callback receiver). Task latency is measured from the
+# POST /webhook to the arrival of the task's callback.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TIMEOUT = 30.0
+STATUS_BATCH_SIZE = 1000
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def free_port_range(count: int) -> int:
+    """First port of `count` consecutive free ports (worker process i listens on base + i)."""
+    for _ in range(50):
+        base = free_port()
+        try:
+            sockets = []
+            for offset in range(count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(("127.0.0.1", base + offset))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise RuntimeError("Não foi possível reservar portas livres para as métricas dos workers.")
+
+def percentile(values: List[float], fraction: float) -> float | None:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def peak_rss_kb(pid: int) -> int | None:
+    """Peak resident set size (VmHWM) of a process; None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def process_tree(pid: int) -> List[int]:
+    """The process and all its descendants (Linux)."""
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        try:
+            for thread in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{thread}/children") as f:
+                    stack.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+def tree_peak_rss_mb(pid: int) -> Dict[str, Any]:
+    peaks = {child: peak_rss_kb(child) for child in process_tree(pid)}
+    peaks = {child: kb for child, kb in peaks.items() if kb is not None}
+    return {
+        "total_mb": round(sum(peaks.values()) / 1024, 1) if peaks else None,
+        "max_process_mb": round(max(peaks.values()) / 1024, 1) if peaks else None,
+        "processes": len(peaks),
+    }
+
+def scrape_metrics(urls: List[str]) -> Dict[str, float]:
+    """Sums the samples of every /metrics endpoint, keyed by name and labels."""
+    totals: Dict[str, float] = {}
+    for url in urls:
+        try:
+            text = httpx.get(url, timeout=5.0).text
+        except httpx.HTTPError as e:
+            print(f"Aviso: métricas indisponíveis em {url}: {e}")
+            continue
+        for family in text_string_to_metric_families(text):
+            for sample in family.samples:
+                labels = ",".join(f"{key}={value}" for key, value in sorted(sample.labels.items()))
+                key = f"{sample.name}{{{labels}}}" if labels else sample.name
+                totals[key] = totals.get(key, 0.0) + sample.value
+    return totals
+
+def summarize_metrics(metrics: Dict[str, float]) -> Dict[str, Any]:
+    def value(key: str) -> float:
+        return metrics.get(key, 0.0)
+
+    def prefixed(prefix: str) -> float:
+        return sum(sample for key, sample in metrics.items() if key.startswith(prefix))
+
+    lock_waits = value("db_lock_wait_seconds_count")
+    return {
+        "db": {
+            "lock_wait_seconds_total": round(value("db_lock_wait_seconds_sum"), 4),
+            "write_batches": int(lock_waits),
+            # Batches that waited more than 10 ms for the write lock (contention between processes)
+            "lock_waits_over_10ms": int(lock_waits - value("db_lock_wait_seconds_bucket{le=0.01}")),
+            "writer_queue_wait_seconds_total": round(value("agent_queue_wait_seconds_sum{span=db.write}"), 4),
+            "writes": int(prefixed("agent_span_duration_seconds_count{span=db.write,")),
+        },
+        "gemini": {
+            "calls": int(prefixed("agent_span_duration_seconds_count{span=gemini.generate,")),
+            "retries": int(prefixed("gemini_retries_total")),
+            "hedged": int(prefixed("gemini_hedges_total")),
+            "hedge_backup_wins": int(prefixed("gemini_hedges_total{outcome=backup,")),
+            "prompt_tokens": int(prefixed("gemini_tokens_total{kind=prompt,")),
+            "response_tokens": int(prefixed("gemini_tokens_total{kind=response,")),
+            "cost_usd": round(prefixed("gemini_route_cost_usd_total"), 6),
+            "rate_limiter_wait_seconds_total": round(value("agent_queue_wait_seconds_sum{span=gemini.generate}"), 4),
+        },
+        "task_queue_wait_seconds_total": round(value("agent_queue_wait_seconds_sum{span=task.run}"), 4),
+    }
+
+def git_version() -> str | None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+class Benchmark:
+    """Starts the fake services, the API and the workers, applies the load and collects the results."""
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="7z-benchmark-")
+        self.fake_url = f"http://127.0.0.1:{free_port()}"
+        self.api_url = f"http://127.0.0.1:{free_port()}"
+        self.metrics_port = free_port_range(args.processes)
+        self.processes: Dict[str, subprocess.Popen] = {}
+        self.started_at: Dict[str, float] = {}
+        self.startup: Dict[str, float] = {}
+        self.submitted: Dict[str, float] = {}
+        self.rejected = 0
+
+    def environment(self) -> Dict[str, str]:
+        with open(os.path.join(self.workdir, "sites.json"), "w", encoding="utf-8") as f:
+            json.dump(sites_config(self.fake_url, self.args.sites), f)
+        env = {
+            **os.environ,
+            "DATABASE_FILE": os.path.join(self.workdir, "tasks.db"),
+            "LLM_CACHE_FILE": os.path.join(self.workdir, "llm_cache.db"),
+            "HTTP_CACHE_FILE": os.path.join(self.workdir, "http_cache.db"),
+            "SCRAPER_SITES_FILE": os.path.join(self.workdir, "sites.json"),
+            "GEMINI_API_KEY": "benchmark",
+            "GEMINI_BASE_URL": self.fake_url,
+            # Every task must reach the (fake) model; identical prompts would otherwise be served from the cache
+            "LLM_CACHE_ENABLED": "0",
+            "PLAN_CACHE_ENABLED": "0" if self.args.no_plan_cache else "1",
+            "PYTHONUNBUFFERED": "1",
+        }
+        env.pop("EVENTS_RELAY_URL", None)
+        return env
+
+    def start(self, name: str, command: List[str], env: Dict[str, str]):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "a")
+        self.started_at[name] = time.monotonic()
+        self.processes[name] = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, name: str, url: str) -> float:
+        """Waits until `url` answers; returns the seconds since the process was started."""
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.processes[name].poll() is not None:
+                    raise RuntimeError(f"{name} encerrou na inicialização (ver {self.workdir}/{name}.log)")
+                try:
+                    await client.get(url, timeout=1.0)
+                    return time.monotonic() - self.started_at[name]
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.1)
+        raise RuntimeError(f"{name} não respondeu em {STARTUP_TIMEOUT:g}s (ver {self.workdir}/{name}.log)")
+
+    async def start_services(self):
+        args = self.args
+        env = self.environment()
+        fake_port = self.fake_url.rsplit(":", 1)[1]
+        self.start("fakes", [
+            sys.executable, "fakes.py", "--port", fake_port,
+            "--latency-median", str(args.latency_median), "--latency-sigma", str(args.latency_sigma),
+            "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+            *(["--seed", str(args.seed)] if args.seed is not None else []),
+        ], env)
+        await self.wait_ready("fakes", f"{self.fake_url}/stats")
+
+        self.start("api", [
+            sys.executable, "-m", "uvicorn", "api:app", "--port", self.api_url.rsplit(":", 1)[1],
+            "--log-level", "warning", "--no-access-log",
+        ], env)
+        self.startup["api_ready"] = await self.wait_ready("api", f"{self.api_url}/")
+        # Cold-start cost left for the first real request (DB connections, lazily loaded code)
+        with httpx.Client() as client:
+            started = time.monotonic()
+            client.get(f"{self.api_url}/tasks", params={"limit": 1}).raise_for_status()
+            self.startup["api_first_request"] = time.monotonic() - started
+
+        self.start("workers", [
+            sys.executable, "worker.py", "--processes", str(args.processes), "--concurrency", str(args.concurrency),
+            "--metrics-port", str(self.metrics_port),
+        ], env)
+        # The metrics port opens once the worker modules are imported, right before the first claim
+        worker_metrics = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        self.startup["workers_ready"] = await self.wait_ready("workers", worker_metrics)
+
+    async def submit(self, client: httpx.AsyncClient, index: int):
+        submitted = time.time()
+        try:
+            response = await client.post(f"{self.api_url}/webhook", json={
+                "task_description": f"Resuma as notícias de IA de hoje e conte as palavras do resumo (pedido {index})",
+                "callback_url": f"{self.fake_url}/callbacks",
+            })
+            response.raise_for_status()
+            self.submitted[response.json()["task_id"]] = submitted
+        except httpx.HTTPError as e:
+            self.rejected += 1
+            print(f"Falha ao enviar o pedido {index}: {e}")
+
+    async def load(self):
+        """Open-loop load: requests are sent on schedule, whether or not earlier ones finished."""
+        total = int(self.args.rps * self.args.duration)
+        print(f"Enviando {total} tarefa(s) a {self.args.rps:g} req/s...")
+        async with httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_connections=100)) as client:
+            started = time.monotonic()
+            requests = []
+            for index in range(total):
+                delay = started + index / self.args.rps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                requests.append(asyncio.create_task(self.submit(client, index)))
+            await asyncio.gather(*requests)
+
+    async def drain(self) -> Dict[str, float]:
+        """Waits until every accepted task's callback arrived (or the drain timeout)."""
+        deadline = time.monotonic() + self.args.drain_timeout
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            while True:
+                received = (await client.get(f"{self.fake_url}/callbacks")).json()["received"]
+                pending = len(set(self.submitted) - set(received))
+                if not pending or time.monotonic() > deadline:
+                    if pending:
+                        print(f"Tempo de espera esgotado: {pending} tarefa(s) sem callback.")
+                    return received
+                await asyncio.sleep(0.5)
+
+    async def statuses(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        ids = list(self.submitted)
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            for start in range(0, len(ids), STATUS_BATCH_SIZE):
+                response = await client.post(f"{self.api_url}/status/batch",
+                                              json={"task_ids": ids[start:start + STATUS_BATCH_SIZE]})
+                for task in response.json()["tasks"]:
+                    counts[task["status"]] = counts.get(task["status"], 0) + 1
+        return counts
+
+    def stop(self):
+        # Workers first (they drain their running tasks), then the API and the fakes
+        for name in ("workers", "api", "fakes"):
+            process = self.processes.get(name)
+            if process is None or process.poll() is not None:
+                continue
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        try:
+            await self.start_services()
+            load_started = time.time()
+            await self.load()
+            received = await self.drain()
+            finished = time.time()
+
+            statuses = await self.statuses()
+            metrics = scrape_metrics([f"{self.api_url}/metrics"] + [
+                f"http://127.0.0.1:{self.metrics_port + index}/metrics" for index in range(args.processes)
+            ])
+            memory = {name: tree_peak_rss_mb(self.processes[name].pid) for name in ("api", "workers")}
+            fake_stats = httpx.get(f"{self.fake_url}/stats").json()
+            callbacks = httpx.get(f"{self.fake_url}/callbacks").json()
+        finally:
+            self.stop()
+
+        latencies = [received[task_id] - submitted for task_id, submitted in self.submitted.items() if task_id in received]
+        last_arrival = max((received[task_id] for task_id in self.submitted if task_id in received), default=finished)
+        elapsed = max(1e-9, last_arrival - load_started)
+        return {
+            "version": git_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "config": {
+                "rps": args.rps, "duration": args.duration, "processes": args.processes,
+                "concurrency": args.concurrency, "latency_median": args.latency_median,
+                "latency_sigma": args.latency_sigma, "error_rate": args.error_rate,
+                "rate_limit_rate": args.rate_limit_rate, "plan_cache": not args.no_plan_cache, "seed": args.seed,
+            },
+            "tasks": {
+                "submitted": len(self.submitted), "rejected": self.rejected, "finished": len(latencies),
+                "timed_out": len(self.submitted) - len(latencies), "statuses": statuses,
+            },
+            "latency_seconds": {
+                key: round(value, 4) if value is not None else None for key, value in {
+                    "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+                    "p99": percentile(latencies, 0.99), "max": max(latencies, default=None),
+                    "mean": sum(latencies) / len(latencies) if latencies else None,
+                }.items()
+            },
+            "throughput_tasks_per_second": round(len(latencies) / elapsed, 3),
+            "startup_seconds": {key: round(value, 4) for key, value in self.startup.items()},
+            "peak_rss": memory,
+            **summarize_metrics(metrics),
+            "fake_gemini": fake_stats,
+            "callbacks": {key: callbacks[key] for key in ("posts", "results", "duplicates")},
+            "workdir": self.workdir,
+        }
+
+async def measure_startup(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Cold-starts the API and the workers `args.startup_runs` times (new processes each time, same
+    database, like a scale-up from zero) without applying any load; reports the p50 and max of each phase.
+    """
+    benchmark = Benchmark(args)
+    runs = []
+    for _ in range(args.startup_runs):
+        try:
+            await benchmark.start_services()
+            runs.append(dict(benchmark.startup))
+        finally:
+            benchmark.stop()
+    return {
+        "version": git_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {"processes": args.processes, "startup_runs": args.startup_runs},
+        # Same shape as the full benchmark's "startup_seconds", so --baseline compares the two
+        "startup_seconds": {phase: round(percentile([run[phase] for run in runs], 0.50), 4) for phase in runs[0]},
+        "startup_seconds_max": {phase: round(max(run[phase] for run in runs), 4) for phase in runs[0]},
+        "workdir": benchmark.workdir,
+    }
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]):
+    """Prints the relative change of the headline numbers against an earlier results file."""
+    rows = [("latência p50", ("latency_seconds", "p50")), ("latência p95", ("latency_seconds", "p95")),
+            ("latência p99", ("latency_seconds", "p99")), ("tarefas/s", ("throughput_tasks_per_second",)),
+            ("espera por lock (s)", ("db", "lock_wait_seconds_total")),
+            ("API pronta (s)", ("startup_seconds", "api_ready")),
+            ("workers prontos (s)", ("startup_seconds", "workers_ready"))]
+    print(f"\nComparação com {baseline.get('version')} ({baseline.get('timestamp')}):")
+    for label, path in rows:
+        old, new = baseline, result
+        for key in path:
+            old = (old or {}).get(key) if isinstance(old, dict) else None
+            new = (new or {}).get(key) if isinstance(new, dict) else None
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "n/a"
+        print(f"  {label:22} {old!s:>12} -> {new!s:>12}  ({change})")
+
+def print_report(result: Dict[str, Any]):
+    latency = result["latency_seconds"]
+    def seconds(value):
+        return f"{value:.3f}s" if value is not None else "n/a"
+    print("\n--- Resultado do Benchmark ---")
+    print(f"Tarefas: {result['tasks']}")
+    print(f"Latência: p50 {seconds(latency['p50'])}, p95 {seconds(latency['p95'])}, p99 {seconds(latency['p99'])}")
+    print(f"Vazão: {result['throughput_tasks_per_second']} tarefas/s")
+    print(f"Inicialização: {result['startup_seconds']}")
+    print(f"Pico de RSS: {result['peak_rss']}")
+    print(f"Banco: {result['db']}")
+    print(f"Gemini: {result['gemini']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test of the API and the workers (see fakes.py).")
+    parser.add_argument("--rps", type=float, default=5.0, help="Tasks submitted per second.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load.")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent tasks per worker process.")
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Median fake Gemini latency (s).")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal spread of the fake latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Gemini requests failing with 503.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of Gemini requests failing with 429.")
+    parser.add_argument("--sites", type=int, default=3, help="Fake sites scraped by the web_scraper steps.")
+    parser.add_argument("--no-plan-cache", action="store_true", help="Plan every task with the (fake) model.")
+    parser.add_argument("--drain-timeout", type=float, default=300.0, help="Max wait (s) for callbacks after the load.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the fake latencies and failures.")
+    parser.add_argument("--output", default="benchmark.json", help="JSON results file.")
+    parser.add_argument("--baseline", help="Earlier results file to compare with.")
+    parser.add_argument("--startup-runs", type=int, default=0,
+                        help="Only measure the cold start of the API and the workers, this many times.")
+    args = parser.parse_args()
+
+    result = asyncio.run(measure_startup(args) if args.startup_runs > 0 else Benchmark(args).run())
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.startup_runs > 0:
+        print(f"Inicialização p50: {result['startup_seconds']}; máx: {result['startup_seconds_max']}")
+    else:
+        print_report(result)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(result, json.load(f))
+    print(f"\nResultados gravados em {args.output}")
@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+# --- Cache Configuration (environment variables) ---
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_FILE = os.environ.get("LLM_CACHE_FILE", "llm_cache.db")  # On-disk tier, shared by API and workers
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1024"))  # In-memory LRU size
+LLM_CACHE_TTL_SECONDS = float(os.environ.get("LLM_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Wait for the disk tier's lock (other workers writing) before giving up on a lookup or a write
+LLM_CACHE_BUSY_TIMEOUT_MS = int(os.environ.get("LLM_CACHE_BUSY_TIMEOUT_MS", "2000"))
+
+# Expired rows are purged from the disk tier every N writes
+PURGE_EVERY_N_WRITES = 500
+
+def cache_key(model: str, system_instruction: str | None, prompt: str, response_schema: Any = None) -> str:
+    """
+    Content-addressed key for a Gemini request: identical model, system instruction,
+    prompt and response schema always map to the same key.
+    """
+    if response_schema is not None and hasattr(response_schema, "model_json_schema"):
+        # Pydantic model classes (e.g. agent.Plan) are keyed by their JSON schema
+        response_schema = response_schema.model_json_schema()
+    material = json.dumps(
+        {"model": model, "system_instruction": system_instruction, "prompt": prompt, "response_schema": response_schema},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM responses: a bounded in-memory LRU in front of a SQLite table.
+
+    Both tiers honour the same TTL. `get_or_compute` also deduplicates concurrent identical
+    requests (single-flight): only the first caller runs `compute`, the others wait for its result.
+
+    The disk tier is best-effort: it is read and written off the event loop, and a SQLite error
+    (e.g. "database is locked" on the file shared by all workers) is logged and treated as a miss
+    or a skipped write, never as a failed call.
+    """
+    def __init__(self, db_file: str = LLM_CACHE_FILE, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()  # In-memory tier and counters
+        self._db_lock = threading.Lock()  # Disk tier connection (used from worker threads)
+        self._conn = None
+        self._writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "shared_inflight": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        """Opens the disk tier lazily (must be called with `_db_lock` held)."""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, timeout=LLM_CACHE_BUSY_TIMEOUT_MS / 1000,
+                                         check_same_thread=False)
+            # WAL: lookups from other workers do not block on a writer
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute(f"PRAGMA busy_timeout = {LLM_CACHE_BUSY_TIMEOUT_MS}")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached value, or None if it is missing or expired."""
+        value = self._get_memory(key)
+        return value if value is not None else self._get_disk(key)
+
+    async def aget(self, key: str) -> str | None:
+        """Like `get`, with the disk lookup run in a thread."""
+        value = self._get_memory(key)
+        return value if value is not None else await asyncio.to_thread(self._get_disk, key)
+
+    def set(self, key: str, value: str) -> None:
+        """Stores a value in both tiers."""
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, value, expires_at)
+        self._set_disk(key, value, expires_at)
+
+    def _get_memory(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+        return None
+
+    def _get_disk(self, key: str) -> str | None:
+        try:
+            with self._db_lock:
+                row = self._db().execute(
+                    "SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Erro ao ler o cache de respostas em disco (tratado como ausente): {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            value, expires_at = row
+            self._remember(key, value, expires_at)
+            self.counters["disk_hits"] += 1
+            return value
+
+    def _set_disk(self, key: str, value: str, expires_at: float) -> None:
+        try:
+            with self._db_lock:
+                conn = self._db()
+                try:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, value, expires_at)
+                    )
+                    self._writes += 1
+                    if self._writes % PURGE_EVERY_N_WRITES == 0:
+                        conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+                    conn.commit()
+                except sqlite3.Error:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+        except sqlite3.Error as e:
+            # The value is still in the memory tier and is returned to the caller
+            print(f"Erro ao gravar no cache de respostas em disco (ignorado): {e}")
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        """Inserts into the LRU tier, evicting the least recently used entries (lock held)."""
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]],
+                             store_key: Callable[[], str] = None) -> str:
+        """
+        Returns the cached value for `key`, computing and storing it on a miss.
+        Concurrent callers with the same key share a single `compute` call.
+
+        `store_key`, called after `compute`, gives the key the computed value is stored under when it
+        may differ from `key` (e.g. a hedged call answered by another model, see llm.generate_content).
+        """
+        value = await self.aget(key)
+        if value is not None:
+            return value
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.counters["shared_inflight"] += 1
+            try:
+                # shield(): a waiter being cancelled must not cancel the shared call.
+                # Raises the owner's exception as well, so failures are never cached.
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The owner was cancelled (e.g. its task was abandoned): compute on our own
+                return await self.get_or_compute(key, compute, store_key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+            stored_key = store_key() if store_key is not None else key
+            expires_at = time.time() + self.ttl_seconds
+            with self._lock:
+                self._remember(stored_key, value, expires_at)
+            future.set_result(value)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Mark the exception as retrieved when no other caller was waiting for it
+                future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        # Best-effort: a disk tier error must not turn an already paid response into a failure
+        await asyncio.to_thread(self._set_disk, stored_key, value, expires_at)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for this process."""
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "memory_entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+# Process-wide cache used by every Gemini call (see llm.py)
+response_cache = ResponseCache()
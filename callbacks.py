@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import random
+import time
+import httpx
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List
+
+from db import aclaim_callbacks, adead_letter_callback, amark_callbacks_delivered, areschedule_callback
+from tracing import record
+
+# --- Callback Delivery Configuration (environment variables) ---
+
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", "8"))  # Attempts before a dead letter
+CALLBACK_BACKOFF_BASE_SECONDS = float(os.environ.get("CALLBACK_BACKOFF_BASE_SECONDS", "2.0"))
+CALLBACK_BACKOFF_MAX_SECONDS = float(os.environ.get("CALLBACK_BACKOFF_MAX_SECONDS", "600.0"))
+CALLBACK_HOST_CONCURRENCY = int(os.environ.get("CALLBACK_HOST_CONCURRENCY", "4"))  # POSTs in flight per host
+CALLBACK_TIMEOUT_SECONDS = float(os.environ.get("CALLBACK_TIMEOUT_SECONDS", "30.0"))
+CALLBACK_BATCH_MAX = int(os.environ.get("CALLBACK_BATCH_MAX", "50"))  # Results per POST for batch receivers
+# After a wake-up the dispatcher waits this long so results finishing together share a batch
+CALLBACK_BATCH_WINDOW = float(os.environ.get("CALLBACK_BATCH_WINDOW", "0.2"))
+CALLBACK_POLL_INTERVAL = float(os.environ.get("CALLBACK_POLL_INTERVAL", "1.0"))
+
+# Outbox rows claimed at once (and in flight) per process
+MAX_IN_FLIGHT = 200
+# A claimed row whose process died is picked up again after this many seconds
+CLAIM_LEASE_SECONDS = 5 * CALLBACK_TIMEOUT_SECONDS + 60
+# 4xx answers that are worth retrying; any other 4xx means the receiver rejects the payload
+RETRYABLE_CLIENT_ERRORS = {408, 425, 429}
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """Full-jitter exponential backoff; a Retry-After from the receiver is honoured as a minimum."""
+    delay = random.uniform(0, min(CALLBACK_BACKOFF_MAX_SECONDS, CALLBACK_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, CALLBACK_BACKOFF_MAX_SECONDS))
+    return delay
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parses a Retry-After header (seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class CallbackDispatcher:
+    """
+    Delivers the results recorded in `callback_outbox` to the tasks' callback URLs.
+
+    Each destination host gets its own keep-alive connection pool and a concurrency limit.
+    Failed deliveries are retried with exponential backoff; after CALLBACK_MAX_ATTEMPTS attempts,
+    or when the receiver rejects the payload (4xx), the row moves to `callback_dead_letters`.
+    Tasks created with `callback_batch` receive `{"results": [...]}` with up to CALLBACK_BATCH_MAX
+    results per POST. Delivery is at-least-once: receivers should deduplicate by task_id.
+    """
+    def __init__(self, host_concurrency: int = CALLBACK_HOST_CONCURRENCY, max_attempts: int = CALLBACK_MAX_ATTEMPTS):
+        self.host_concurrency = host_concurrency
+        self.max_attempts = max_attempts
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._in_flight = 0
+        self._deliveries = set()
+        self._wakeup = None
+        self._stopping = None
+        self.counters = {"posts": 0, "delivered": 0, "batched_posts": 0, "retries": 0, "dead_letters": 0}
+
+    def _events(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = asyncio.Event()
+
+    def wake(self):
+        """Signals that new results were recorded, so they are sent without waiting for the next poll."""
+        self._events()
+        self._wakeup.set()
+
+    def stop(self):
+        """Stops claiming new callbacks; deliveries already in flight are allowed to finish."""
+        self._events()
+        self._stopping.set()
+        self._wakeup.set()
+
+    async def run(self):
+        """Main loop: claims due outbox rows and starts their deliveries."""
+        self._events()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=CALLBACK_POLL_INTERVAL)
+                if not self._stopping.is_set():
+                    await asyncio.sleep(CALLBACK_BATCH_WINDOW)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping.is_set() or self._in_flight >= MAX_IN_FLIGHT:
+                continue
+
+            try:
+                rows = await aclaim_callbacks(MAX_IN_FLIGHT - self._in_flight, CLAIM_LEASE_SECONDS)
+            except Exception as e:
+                print(f"Erro ao reivindicar callbacks: {e}")
+                continue
+            for url, group in self._group(rows):
+                self._in_flight += len(group)
+                delivery = asyncio.create_task(self._deliver(url, group))
+                self._deliveries.add(delivery)
+                delivery.add_done_callback(self._deliveries.discard)
+
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        print(f"Entrega de callbacks: {self.stats()}")
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    @staticmethod
+    def _group(rows: List[Dict[str, Any]]) -> List[tuple]:
+        """One POST per row, except rows of batch receivers, which share POSTs per callback_url."""
+        groups = []
+        batches: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            if row["batch"]:
+                batches.setdefault(row["callback_url"], []).append(row)
+            else:
+                groups.append((row["callback_url"], [row]))
+        for url, batch_rows in batches.items():
+            for start in range(0, len(batch_rows), CALLBACK_BATCH_MAX):
+                groups.append((url, batch_rows[start:start + CALLBACK_BATCH_MAX]))
+        return groups
+
+    def _client_for(self, url: str) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """Returns the shared keep-alive client and the concurrency slots of the URL's host."""
+        parsed = httpx.URL(url)
+        host = f"{parsed.scheme}://{parsed.host}:{parsed.port or ''}"
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(
+                timeout=CALLBACK_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=self.host_concurrency,
+                    max_keepalive_connections=self.host_concurrency,
+                    keepalive_expiry=60.0,
+                ),
+            )
+            self._slots[host] = asyncio.Semaphore(self.host_concurrency)
+        return self._clients[host], self._slots[host]
+
+    async def _deliver(self, url: str, rows: List[Dict[str, Any]]):
+        try:
+            await self._post(url, rows)
+        except Exception as e:
+            # Only DB errors get here; the rows' claim lease expires and they are sent again later
+            print(f"Erro ao registrar a entrega de callbacks para {url}: {e}")
+        finally:
+            self._in_flight -= len(rows)
+
+    async def _post(self, url: str, rows: List[Dict[str, Any]]):
+        payloads = [json.loads(row["payload"]) for row in rows]
+        body = {"results": payloads} if rows[0]["batch"] else payloads[0]
+
+        retry_after = None
+        status_code = None
+        queued = started = time.monotonic()
+        try:
+            client, slots = self._client_for(url)
+            async with slots:
+                started = time.monotonic()
+                self.counters["posts"] += 1
+                if rows[0]["batch"]:
+                    self.counters["batched_posts"] += 1
+                response = await client.post(url, json=body)
+            status_code = response.status_code
+            error = None if response.is_success else f"HTTP {response.status_code}"
+            permanent = 400 <= response.status_code < 500 and response.status_code not in RETRYABLE_CLIENT_ERRORS
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except (httpx.InvalidURL, httpx.UnsupportedProtocol) as e:
+            # Retrying cannot fix a bad URL
+            error = f"URL inválida: {e}"
+            permanent = True
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+            permanent = False
+        # Stored in the trace of every task in the POST
+        record("callback.post", time.monotonic() - started, queue_wait=started - queued,
+               status="ok" if error is None else "error", task_ids=[row["task_id"] for row in rows],
+               url=url, results=len(rows), http_status=status_code)
+
+        task_ids = ", ".join(row["task_id"] for row in rows)
+        if error is None:
+            await amark_callbacks_delivered([row["id"] for row in rows])
+            self.counters["delivered"] += len(rows)
+            print(f"Callback enviado para {url} (tarefas: {task_ids})")
+            return
+
+        for row in rows:
+            if permanent or row["attempts"] + 1 >= self.max_attempts:
+                await adead_letter_callback(row["id"], error)
+                self.counters["dead_letters"] += 1
+                print(f"Callback da tarefa {row['task_id']} movido para dead letters: {error}")
+            else:
+                await areschedule_callback(row["id"], time.time() + backoff_delay(row["attempts"], retry_after), error)
+                self.counters["retries"] += 1
+                print(f"Falha ao enviar callback da tarefa {row['task_id']} ({error}); nova tentativa agendada.")
+
+    def stats(self) -> Dict[str, Any]:
+        """Delivery counters for this process."""
+        return {**self.counters, "hosts": len(self._clients), "in_flight": self._in_flight}
+
+# Process-wide dispatcher, run by each worker process (see worker.serve)
+callback_dispatcher = CallbackDispatcher()
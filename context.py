@@ -0,0 +1,181 @@
+import os
+import re
+from typing import Dict, List
+
+from ratelimit import estimate_tokens
+
+# --- Working Context Configuration (environment variables) ---
+
+# Upper bound (estimated tokens) of the previous results handed to a single step
+AGENT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("AGENT_CONTEXT_TOKEN_BUDGET", "6000"))
+# Size of the compacted digest kept for older (non-dependency) results
+AGENT_CONTEXT_DIGEST_TOKENS = int(os.environ.get("AGENT_CONTEXT_DIGEST_TOKENS", "120"))
+
+# Same heuristic as ratelimit.estimate_tokens
+CHARS_PER_TOKEN = 4
+# Share of the budget that digests of older results may take from the dependencies' results
+DIGEST_BUDGET_SHARE = 0.25
+EMPTY_CONTEXT = "Início da execução. Nenhum resultado anterior."
+
+CODE_BLOCK = re.compile(r"```[ \t]*([\w+.-]*)[^\n]*\n(.*?)```", re.DOTALL)
+PYTHON_LANGUAGES = {"", "python", "python3", "py"}
+DEFINITION = re.compile(r"^\s*(?:async\s+)?(?:def|class)\s+(\w+)", re.MULTILINE)
+
+def count_tokens(*texts: str) -> int:
+    """Estimated token count, consistent with the scheduler's token budgets."""
+    return estimate_tokens(*texts)
+
+def extract_code(text: str) -> str | None:
+    """
+    Returns the Python code in a model answer: the longest ```python (or untagged) fenced block,
+    or None if the text has no such block.
+    """
+    blocks = [body for language, body in CODE_BLOCK.findall(text) if language.lower() in PYTHON_LANGUAGES]
+    if not blocks:
+        return None
+    return max(blocks, key=len).strip("\n")
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keeps the beginning and the end of `text` within ~max_tokens, marking the omitted middle."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    chars = max(0, max_tokens * CHARS_PER_TOKEN - 64)  # Room for the marker
+    head = text[:chars * 2 // 3]
+    tail = text[len(text) - chars // 3:] if chars // 3 else ""
+    omitted = count_tokens(text) - count_tokens(head, tail)
+    return f"{head}\n[... ~{omitted} tokens omitidos ...]\n{tail}"
+
+def compact(text: str, max_tokens: int) -> str:
+    """
+    Extractive digest of a result within ~max_tokens: the leading sentences of prose,
+    or the size and top-level definitions of code.
+    """
+    code = extract_code(text)
+    if code is not None and len(code) > len(text) / 2:
+        names = DEFINITION.findall(code)
+        definitions = f"; definições: {', '.join(names)}" if names else ""
+        return truncate_to_tokens(f"[código Python, {code.count(chr(10)) + 1} linhas{definitions}]", max_tokens)
+
+    flat = " ".join(text.split())
+    if count_tokens(flat) <= max_tokens:
+        return flat
+    limit = max(0, max_tokens * CHARS_PER_TOKEN - 6)
+    cut = flat[:limit]
+    # Prefer ending at a sentence boundary when one is reasonably close
+    boundary = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if boundary > limit // 2:
+        cut = cut[:boundary + 1]
+    return cut + " [...]"
+
+def allocate(sizes: Dict[int, int], budget: int) -> Dict[int, int]:
+    """Splits `budget` between entries (water-filling): small entries get all they need, large ones share the rest."""
+    allocation = {}
+    remaining = budget
+    pending = sorted(sizes, key=sizes.get)
+    while pending:
+        key = pending.pop(0)
+        allocation[key] = min(sizes[key], remaining // (len(pending) + 1))
+        remaining -= allocation[key]
+    return allocation
+
+class StepRecord:
+    """The result of one finished step, with its metadata and a cached digest."""
+    def __init__(self, step_id: int, description: str, tool_required: str, result: str, sequence: int):
+        self.step_id = step_id
+        self.description = description
+        self.tool_required = tool_required
+        self.result = result
+        self.sequence = sequence  # Completion order within the task
+        self.tokens = count_tokens(result)
+        self._digests: Dict[int, str] = {}
+
+    def digest(self, max_tokens: int) -> str:
+        if max_tokens not in self._digests:
+            self._digests[max_tokens] = compact(self.result, max_tokens)
+        return self._digests[max_tokens]
+
+class WorkingContext:
+    """
+    Structured record of a task's step results and the context each step receives.
+
+    A step's view holds the results of its direct dependencies verbatim and digests of the
+    results those depend on (older steps), newest first, all within `token_budget` estimated
+    tokens. Dependencies that do not fit are shortened, never dropped. Only ancestors of the step
+    are considered, so the view does not depend on how parallel branches were scheduled.
+    """
+    def __init__(self, dependencies: Dict[int, List[int]], token_budget: int = AGENT_CONTEXT_TOKEN_BUDGET,
+                 digest_tokens: int = AGENT_CONTEXT_DIGEST_TOKENS):
+        self.dependencies = dependencies
+        self.token_budget = token_budget
+        self.digest_tokens = digest_tokens
+        self.records: Dict[int, StepRecord] = {}
+
+    def record(self, step_id: int, description: str, tool_required: str, result: str) -> StepRecord:
+        self.records[step_id] = StepRecord(step_id, description, tool_required, result, len(self.records))
+        return self.records[step_id]
+
+    def ancestors(self, step_id: int) -> List[int]:
+        """Indirect dependencies of the step (dependencies of its dependencies, recursively)."""
+        direct = set(self.dependencies.get(step_id, []))
+        seen, stack = set(), list(direct)
+        while stack:
+            for dep in self.dependencies.get(stack.pop(), []):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return sorted(seen - direct)
+
+    def view(self, step_id: int) -> str:
+        """The token-budgeted context handed to the step."""
+        direct = [dep for dep in self.dependencies.get(step_id, []) if dep in self.records]
+        older = sorted((dep for dep in self.ancestors(step_id) if dep in self.records),
+                       key=lambda dep: self.records[dep].sequence, reverse=True)
+        if not direct and not older:
+            return EMPTY_CONTEXT
+
+        # Older results: a digest each, newest first, within their share of the budget
+        digest_budget = min(len(older) * self.digest_tokens, int(self.token_budget * DIGEST_BUDGET_SHARE))
+        digested = older[:digest_budget // self.digest_tokens] if self.digest_tokens else []
+        sections = []
+        if older:
+            lines = [
+                f"- Passo {dep} ({self.records[dep].tool_required}): {self.records[dep].digest(self.digest_tokens)}"
+                for dep in sorted(digested)
+            ]
+            omitted = sorted(set(older) - set(digested))
+            if omitted:
+                label = "Passos" if len(omitted) > 1 else "Passo"
+                lines.append(f"- {label} {', '.join(map(str, omitted))}: concluído(s) (resultados omitidos)")
+            sections.append("Resumo dos passos anteriores:\n" + "\n".join(lines))
+
+        # Direct dependencies: verbatim, shortened only if together they exceed the rest of the budget
+        labels = {dep: f"Resultado do Passo {dep}: " for dep in direct}
+        used = count_tokens(*sections, *labels.values()) + len(sections) + len(direct)
+        allocation = allocate({dep: self.records[dep].tokens for dep in direct}, max(0, self.token_budget - used))
+        for dep in direct:
+            sections.append(labels[dep] + truncate_to_tokens(self.records[dep].result, allocation[dep]))
+        return "\n\n".join(sections)
+
+    def code_for(self, step_id: int) -> str | None:
+        """
+        The code a `code_execution` step should run: the latest code produced by its dependencies
+        (then by its older ancestors, then by any finished `code_generator` step), or None.
+        """
+        def by_recency(ids):
+            return sorted((i for i in ids if i in self.records), key=lambda i: self.records[i].sequence, reverse=True)
+
+        candidates = by_recency(self.dependencies.get(step_id, [])) + by_recency(self.ancestors(step_id))
+        candidates += [i for i in by_recency(self.records) if self.records[i].tool_required == "code_generator"]
+        for candidate in candidates:
+            record = self.records[candidate]
+            code = extract_code(record.result)
+            if code is None and record.tool_required == "code_generator":
+                # code_generator already strips the fence from its answer
+                code = record.result
+            if code:
+                return code
+        return None
+
+    def render(self, step_ids: List[int]) -> str:
+        """Verbatim results of the given steps (used for the task's final result)."""
+        return "\n\n".join(f"Resultado do Passo {i}: {self.records[i].result}" for i in step_ids if i in self.records)
@@ -1,18 +1,249 @@
+import asyncio
+import hashlib
+import json
+import queue
 import sqlite3
 import os
-from typing import List, Dict, Any
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Dict, Any
 
-DATABASE_FILE = "tasks.db"
+from tracing import observe_lock_wait, record
 
-def get_db_connection():
-    """Cria e retorna uma conexão com o banco de dados."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row # Permite acessar colunas por nome
+try:
+    import zstandard
+except ImportError:  # Opcional: sem ele os resultados são comprimidos com zlib
+    zstandard = None
+
+DATABASE_FILE = os.environ.get("DATABASE_FILE", "tasks.db")
+
+# Group commit: o writer agrupa até DB_WRITE_BATCH_SIZE escritas, esperando no máximo DB_WRITE_BATCH_WINDOW segundos
+DB_WRITE_BATCH_SIZE = int(os.environ.get("DB_WRITE_BATCH_SIZE", "256"))
+DB_WRITE_BATCH_WINDOW = float(os.environ.get("DB_WRITE_BATCH_WINDOW", "0.002"))
+DB_READ_THREADS = int(os.environ.get("DB_READ_THREADS", "4"))  # Threads que atendem leituras vindas de código async
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "10000"))  # Espera pelo lock de outros processos
+
+# Deduplicação do /webhook: janela para reenvios idênticos (descrição + callback) e validade do Idempotency-Key
+WEBHOOK_DEDUP_WINDOW_SECONDS = int(os.environ.get("WEBHOOK_DEDUP_WINDOW_SECONDS", "300"))  # 0 desativa
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", str(24 * 3600)))
+
+# --- Agendamento Justo (variáveis de ambiente) ---
+
+# Prioridades de 0 a 9; as mais altas são sempre reivindicadas primeiro
+TASK_DEFAULT_PRIORITY = int(os.environ.get("TASK_DEFAULT_PRIORITY", "5"))
+# A partir desta prioridade a tarefa é "interativa" e pode usar as vagas reservadas dos workers
+TASK_INTERACTIVE_PRIORITY = int(os.environ.get("TASK_INTERACTIVE_PRIORITY", "8"))
+# Peso de cada tenant na fila justa, ex: '{"cliente-a": 3, "lote-noturno": 0.5}' (padrão 1)
+TENANT_WEIGHTS = json.loads(os.environ.get("TENANT_WEIGHTS", "{}"))
+DEFAULT_TENANT = "default"
+# Linha de `fair_queue` que guarda o relógio virtual da fila justa (tenants nunca são vazios)
+FAIR_QUEUE_CLOCK = ""
+
+# --- Armazenamento de Resultados (variáveis de ambiente) ---
+
+# Resultados maiores que isto (bytes UTF-8) saem de `tasks` e vão, comprimidos, para `result_blobs`
+RESULT_INLINE_MAX_BYTES = int(os.environ.get("RESULT_INLINE_MAX_BYTES", "1024"))
+# "zstd" (se o pacote zstandard estiver instalado), "zlib" ou "none"
+RESULT_COMPRESSION = os.environ.get("RESULT_COMPRESSION", "zstd" if zstandard else "zlib")
+RESULT_COMPRESSION_LEVEL = int(os.environ.get("RESULT_COMPRESSION_LEVEL", "6"))
+
+# Pragmas aplicados a toda conexão: WAL permite leituras concorrentes com a escrita
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+# Colunas adicionadas depois da versão inicial da tabela; aplicadas via ALTER TABLE em bancos existentes
+TASK_ADDED_COLUMNS = {
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "lease_owner": "TEXT",
+    "lease_expires_at": "REAL",
+    "plan": "TEXT",  # Plano gerado (JSON), reutilizado ao retomar a tarefa
+    "callback_batch": "INTEGER NOT NULL DEFAULT 0",  # 1 = o receptor aceita vários resultados por POST
+    "idempotency_key": "TEXT",  # Cabeçalho Idempotency-Key do pedido que criou a tarefa
+    "request_hash": "TEXT",  # sha256 de descrição + callback_url, para coalescer reenvios
+    "priority": f"INTEGER NOT NULL DEFAULT {TASK_DEFAULT_PRIORITY}",
+    "tenant": f"TEXT NOT NULL DEFAULT '{DEFAULT_TENANT}'",  # Cliente dono da tarefa (fila justa entre tenants)
+    "deadline_at": "REAL",  # Prazo (epoch); a execução é cancelada ao atingi-lo
+    "result_hash": "TEXT",  # sha256 do resultado guardado em result_blobs (NULL se está em `result`)
+    "result_size": "INTEGER",  # Tamanho do resultado em bytes, sem compressão
+}
+
+# Versão do esquema gravada em PRAGMA user_version: init_db só migra bancos com versão menor.
+# Incremente ao mudar tabelas, colunas ou índices em init_db
+SCHEMA_VERSION = 1
+
+# Estados finais de uma tarefa; ao entrar em um deles o callback é gravado no outbox
+TERMINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELLED")
+
+_local = threading.local()
+
+def get_db_connection() -> sqlite3.Connection:
+    """
+    Retorna a conexão desta thread com o banco de dados, criando-a na primeira chamada.
+
+    As conexões são reutilizadas (uma por thread e por processo, já que conexões SQLite
+    não podem atravessar um fork) e não devem ser fechadas por quem as usa.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DATABASE_FILE, isolation_level=None, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row # Permite acessar colunas por nome
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.pid = os.getpid()
     return conn
 
+# --- Writer único com group commit ---
+
+class DBWriter:
+    """
+    Thread única que executa todas as escritas do processo.
+
+    As operações enfileiradas são agrupadas em uma só transação (group commit); cada operação
+    roda dentro de um SAVEPOINT, então a falha de uma não desfaz as demais. O resultado de cada
+    operação só é entregue depois do COMMIT.
+    """
+    def __init__(self):
+        self._queue: "queue.Queue[tuple[Callable[[sqlite3.Cursor], Any], Future]]" = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, operation: Callable[[sqlite3.Cursor], Any]) -> Future:
+        """Enfileira uma operação de escrita e retorna um Future com o seu resultado."""
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                # Primeira escrita (ou processo filho após fork): inicia a thread do writer
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def _run(self):
+        conn = get_db_connection()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + DB_WRITE_BATCH_WINDOW
+            while len(batch) < DB_WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, batch)
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: list):
+        # Operações cujo chamador desistiu (ex: tarefa asyncio cancelada) não são executadas
+        batch = [(operation, future) for operation, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            cursor = conn.cursor()
+            # Espera pelo lock de escrita (outros processos escrevendo), até DB_BUSY_TIMEOUT_MS
+            waiting = time.monotonic()
+            cursor.execute("BEGIN IMMEDIATE")
+            observe_lock_wait(time.monotonic() - waiting)
+            for operation, future in batch:
+                cursor.execute("SAVEPOINT op")
+                try:
+                    outcomes.append((future, operation(cursor), None))
+                    cursor.execute("RELEASE op")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO op")
+                    cursor.execute("RELEASE op")
+                    outcomes.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # Falha do próprio lote (ex: lock não obtido dentro do busy_timeout): todas as operações falham
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+_writer = DBWriter()
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-reader")
+
+def _write(operation: Callable[[sqlite3.Cursor], Any]) -> Any:
+    """Executa uma escrita pelo writer e espera o commit (uso em código síncrono)."""
+    return _writer.submit(operation).result()
+
+async def _awrite(operation: Callable[[sqlite3.Cursor], Any], traced: bool = True) -> Any:
+    """
+    Executa uma escrita pelo writer sem bloquear o event loop. Com `traced`, registra um span
+    "db.write" com o tempo na fila do writer e o tempo de execução da operação.
+    """
+    if not traced:
+        return await asyncio.wrap_future(_writer.submit(operation))
+
+    timings = {}
+    def timed(cursor: sqlite3.Cursor):
+        timings["started"] = time.monotonic()
+        try:
+            return operation(cursor)
+        finally:
+            timings["finished"] = time.monotonic()
+
+    submitted = time.monotonic()
+    status = "error"
+    try:
+        result = await asyncio.wrap_future(_writer.submit(timed))
+        status = "ok"
+        return result
+    finally:
+        # Nome da função que montou a operação (ex: "_claim_task_op" ou "asave_step_result")
+        name = operation.__qualname__.split(".")[0]
+        now = time.monotonic()
+        started = timings.get("started", now)
+        record("db.write", now - submitted, queue_wait=started - submitted, status=status, operation=name,
+               execute=round(timings.get("finished", now) - started, 6))
+
+async def _aread(function: Callable, *args) -> Any:
+    """Executa uma leitura em uma thread de leitura (cada uma com a sua conexão WAL)."""
+    return await asyncio.get_running_loop().run_in_executor(_read_executor, function, *args)
+
+def warm_up():
+    """
+    Abre antes do primeiro pedido as conexões que ele usaria: a do writer (iniciando a sua thread)
+    e a de cada thread de leitura.
+    """
+    _write(lambda cursor: None)
+    for future in [_read_executor.submit(get_db_connection) for _ in range(DB_READ_THREADS)]:
+        future.result()
+
 def init_db():
-    """Inicializa o banco de dados e cria a tabela de tarefas."""
-    conn = get_db_connection()
+    """Inicializa o banco de dados e cria ou migra as tabelas (uma só vez por versão do esquema)."""
+    # Conexão própria e descartável: init_db roda antes de forks (ex: worker.py --processes N)
+    conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    # Só vale para bancos novos (antes da primeira tabela); bancos antigos precisam de um VACUUM
+    # (python3 retention.py --vacuum) para que a limpeza devolva espaço aos poucos
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")  # Persistente no arquivo do banco
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        # Esquema já atualizado (reinícios, processos adicionais da API): nada a criar ou migrar
+        conn.close()
+        return
+    # Serializa a migração entre processos que iniciam juntos (ex: uvicorn --workers N); o DDL é idempotente
+    conn.execute("BEGIN IMMEDIATE")
     cursor = conn.cursor()
     
     # Tabela para armazenar o estado das tarefas
@@ -27,57 +258,994 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
     """)
+    _ensure_columns(cursor, "tasks", TASK_ADDED_COLUMNS)
+
+    # Checkpoints: resultado de cada passo já concluído, para retomar a tarefa sem refazer chamadas ao Gemini
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_steps (
+            task_id TEXT NOT NULL,
+            step_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (task_id, step_id)
+        );
+    """)
+
+    # Outbox de callbacks: gravado na mesma transação que finaliza a tarefa e entregue pelo
+    # despachante dos workers (callbacks.py); nenhum resultado se perde se a entrega falhar
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS callback_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL,
+            callback_url TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            batch INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_expires_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_callback_outbox_status_next ON callback_outbox (status, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_callback_outbox_task_id ON callback_outbox (task_id)")
+
+    # Callbacks que esgotaram as tentativas (ou foram recusados pelo receptor); reenviáveis pela API
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS callback_dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL,
+            callback_url TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            batch INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # Callbacks adicionais de pedidos duplicados anexados a uma tarefa em andamento
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_callbacks (
+            task_id TEXT NOT NULL,
+            callback_url TEXT NOT NULL,
+            callback_batch INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (task_id, callback_url)
+        );
+    """)
+
+    # Cache de planos: plano validado por "forma" de tarefa (descrição normalizada, números como parâmetros)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS plan_cache (
+            template TEXT PRIMARY KEY,
+            plan TEXT NOT NULL,
+            params TEXT NOT NULL,
+            parametrized INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP
+        );
+    """)
+
+    # Resultados grandes, comprimidos e deduplicados pelo sha256 do texto (tarefas iguais dividem o blob)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS result_blobs (
+            hash TEXT PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+    """)
+
+    # Fila justa: "finish tag" virtual de cada tenant (weighted fair queuing, ver _claim_task_op)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fair_queue (
+            tenant TEXT PRIMARY KEY,
+            finish_tag REAL NOT NULL
+        );
+    """)
+
+    # Spans de execução de cada tarefa (ver tracing.py), servidos por GET /tasks/{task_id}/trace
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_spans (
+            task_id TEXT NOT NULL,
+            span_id TEXT NOT NULL,
+            parent_id TEXT,
+            name TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration REAL NOT NULL,
+            queue_wait REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            attributes TEXT
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_spans_task_id ON task_spans (task_id, started_at)")
+
+    # Índices para listagem por status/data, para a fila e para a limpeza de tarefas antigas
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created_at ON tasks (status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_request_hash ON tasks (request_hash, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_idempotency_key ON tasks (idempotency_key, created_at)")
+    # Fila: faixa de prioridade -> tenants da faixa -> tarefa mais antiga do tenant
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks (status, priority, tenant, created_at)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tasks_pending_deadline ON tasks (deadline_at) "
+        "WHERE status = 'PENDING' AND deadline_at IS NOT NULL"
+    )
+    # Limpeza de blobs órfãos (nenhuma tarefa aponta mais para eles)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tasks_result_hash ON tasks (result_hash) WHERE result_hash IS NOT NULL"
+    )
     
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
     conn.close()
     print(f"Banco de dados inicializado em {DATABASE_FILE}")
 
-def create_task(task_id: str, task_description: str, callback_url: str = None) -> None:
+def _ensure_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> None:
+    """Adiciona à tabela as colunas que ainda não existem (migração simples de esquema)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row["name"] for row in cursor.fetchall()}
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+# --- Resultados (blobs comprimidos e deduplicados) ---
+
+def _compress(data: bytes) -> tuple[str, bytes]:
+    if RESULT_COMPRESSION == "zstd" and zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=RESULT_COMPRESSION_LEVEL).compress(data)
+    if RESULT_COMPRESSION == "none":
+        return "none", data
+    return "zlib", zlib.compress(data, RESULT_COMPRESSION_LEVEL)
+
+def _decompress(encoding: str, data: bytes) -> str:
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Resultado comprimido com zstd, mas o pacote zstandard não está instalado.")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif encoding == "zlib":
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+def _store_result(cursor: sqlite3.Cursor, result: str | None) -> tuple[str | None, str | None, int | None]:
+    """
+    Prepara o resultado para gravação em `tasks`: retorna (result, result_hash, result_size).
+    Resultados pequenos ficam na própria linha; os maiores que RESULT_INLINE_MAX_BYTES são gravados
+    comprimidos em `result_blobs` (uma vez por conteúdo) e a tarefa guarda apenas o hash.
+    """
+    if result is None:
+        return None, None, None
+    data = result.encode("utf-8")
+    if len(data) <= RESULT_INLINE_MAX_BYTES:
+        return result, None, len(data)
+    digest = hashlib.sha256(data).hexdigest()
+    cursor.execute("SELECT 1 FROM result_blobs WHERE hash = ?", (digest,))
+    if cursor.fetchone() is None:
+        encoding, compressed = _compress(data)
+        cursor.execute(
+            "INSERT INTO result_blobs (hash, encoding, size, data) VALUES (?, ?, ?, ?)",
+            (digest, encoding, len(data), compressed)
+        )
+    return None, digest, len(data)
+
+def _load_results(cursor: sqlite3.Cursor, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Preenche `result` das tarefas cujo resultado está em `result_blobs` (uma consulta por bloco de hashes)."""
+    hashes = list({task["result_hash"] for task in tasks if task.get("result_hash")})
+    blobs = {}
+    for start in range(0, len(hashes), MAX_QUERY_PARAMS):
+        chunk = hashes[start:start + MAX_QUERY_PARAMS]
+        cursor.execute(f"SELECT hash, encoding, data FROM result_blobs WHERE hash IN ({', '.join('?' * len(chunk))})",
+                       chunk)
+        blobs.update((row["hash"], _decompress(row["encoding"], row["data"])) for row in cursor.fetchall())
+    for task in tasks:
+        if task.get("result_hash") in blobs:
+            task["result"] = blobs[task["result_hash"]]
+    return tasks
+
+def create_task(task_id: str, task_description: str, callback_url: str = None, callback_batch: bool = False,
+                priority: int = TASK_DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT, deadline_at: float = None) -> None:
     """Cria uma nova tarefa no banco de dados com status 'PENDING'."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO tasks (id, task_description, callback_url, status) VALUES (?, ?, ?, ?)",
-        (task_id, task_description, callback_url, "PENDING")
-    )
-    conn.commit()
-    conn.close()
+    _write(_create_task_op(task_id, task_description, callback_url, callback_batch, priority, tenant, deadline_at))
+
+async def acreate_task(task_id: str, task_description: str, callback_url: str = None, callback_batch: bool = False,
+                       priority: int = TASK_DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT,
+                       deadline_at: float = None) -> None:
+    """Versão assíncrona de create_task (não bloqueia o event loop)."""
+    await _awrite(_create_task_op(task_id, task_description, callback_url, callback_batch, priority, tenant, deadline_at))
+
+def _create_task_op(task_id: str, task_description: str, callback_url: str = None, callback_batch: bool = False,
+                    priority: int = TASK_DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT, deadline_at: float = None):
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            INSERT INTO tasks (id, task_description, callback_url, status, callback_batch, priority, tenant, deadline_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (task_id, task_description, callback_url, "PENDING", int(callback_batch), priority, tenant, deadline_at)
+        )
+    return operation
+
+def request_hash(task_description: str, callback_url: str = None) -> str:
+    """Identidade de um pedido para a deduplicação do /webhook."""
+    return hashlib.sha256(f"{task_description}\0{callback_url or ''}".encode("utf-8")).hexdigest()
+
+async def acreate_or_attach_task(task_id: str, task_description: str, callback_url: str = None,
+                                 callback_batch: bool = False, idempotency_key: str = None,
+                                 priority: int = TASK_DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT,
+                                 deadline_at: float = None) -> tuple[Dict[str, Any], bool]:
+    """
+    Cria a tarefa, a menos que o pedido seja uma duplicata: mesmo `idempotency_key` dentro de
+    IDEMPOTENCY_KEY_TTL_SECONDS ou, sem chave, mesma descrição e callback_url dentro de
+    WEBHOOK_DEDUP_WINDOW_SECONDS (tarefas 'FAILED' não contam). Retorna (tarefa, criada).
+
+    A duplicata é anexada à tarefa existente: se trouxer outra callback_url, ela também recebe o
+    resultado (na hora, se a tarefa já terminou). Verificação e inserção rodam na mesma transação,
+    então pedidos simultâneos (mesmo em processos diferentes) nunca criam duas tarefas.
+    A duplicata mantém a prioridade, o tenant e o prazo da tarefa existente.
+    """
+    return await _awrite(_create_or_attach_task_op(task_id, task_description, callback_url, callback_batch,
+                                                   idempotency_key, priority, tenant, deadline_at))
+
+def _create_or_attach_task_op(task_id: str, task_description: str, callback_url: str, callback_batch: bool,
+                              idempotency_key: str, priority: int = TASK_DEFAULT_PRIORITY,
+                              tenant: str = DEFAULT_TENANT, deadline_at: float = None):
+    def operation(cursor: sqlite3.Cursor):
+        digest = request_hash(task_description, callback_url)
+        if idempotency_key:
+            cursor.execute(
+                """
+                SELECT * FROM tasks WHERE idempotency_key = ? AND created_at >= datetime('now', ?)
+                ORDER BY created_at DESC LIMIT 1
+                """,
+                (idempotency_key, f"-{IDEMPOTENCY_KEY_TTL_SECONDS} seconds")
+            )
+            existing = cursor.fetchone()
+        elif WEBHOOK_DEDUP_WINDOW_SECONDS > 0:
+            cursor.execute(
+                """
+                SELECT * FROM tasks WHERE request_hash = ? AND created_at >= datetime('now', ?)
+                    AND status IN ('PENDING', 'IN_PROGRESS', 'COMPLETED')
+                ORDER BY created_at DESC LIMIT 1
+                """,
+                (digest, f"-{WEBHOOK_DEDUP_WINDOW_SECONDS} seconds")
+            )
+            existing = cursor.fetchone()
+        else:
+            existing = None
+
+        if existing is None:
+            cursor.execute(
+                """
+                INSERT INTO tasks (id, task_description, callback_url, status, callback_batch, idempotency_key,
+                    request_hash, priority, tenant, deadline_at)
+                VALUES (?, ?, ?, 'PENDING', ?, ?, ?, ?, ?, ?)
+                """,
+                (task_id, task_description, callback_url, int(callback_batch), idempotency_key, digest,
+                 priority, tenant, deadline_at)
+            )
+            return {"id": task_id, "task_description": task_description, "callback_url": callback_url,
+                    "status": "PENDING", "result": None, "priority": priority, "tenant": tenant,
+                    "deadline_at": deadline_at}, True
+
+        existing = _load_results(cursor, [dict(existing)])[0]
+        # Idempotency-Key reutilizado com outra descrição é um conflito (a API responde 409), não uma duplicata
+        conflict = existing["task_description"] != task_description
+        if callback_url and callback_url != existing["callback_url"] and not conflict:
+            if existing["status"] in TERMINAL_STATUSES:
+                _insert_callback(cursor, existing, callback_url, int(callback_batch))
+            else:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO task_callbacks (task_id, callback_url, callback_batch) VALUES (?, ?, ?)",
+                    (existing["id"], callback_url, int(callback_batch))
+                )
+        return existing, False
+    return operation
+
+async def acreate_or_attach_tasks(requests: List[Dict[str, Any]]) -> List[tuple[Dict[str, Any], bool]]:
+    """
+    Versão em lote de acreate_or_attach_task: todos os pedidos (dicts com task_id, task_description,
+    callback_url, callback_batch, idempotency_key, priority, tenant e deadline_at) são gravados em
+    uma única transação.
+    Retorna (tarefa, criada) para cada pedido, na mesma ordem.
+    """
+    def operation(cursor: sqlite3.Cursor):
+        return [
+            _create_or_attach_task_op(
+                request["task_id"], request["task_description"], request.get("callback_url"),
+                request.get("callback_batch", False), request.get("idempotency_key"),
+                request.get("priority", TASK_DEFAULT_PRIORITY), request.get("tenant", DEFAULT_TENANT),
+                request.get("deadline_at"),
+            )(cursor)
+            for request in requests
+        ]
+    return await _awrite(operation)
 
 def update_task_status(task_id: str, status: str, result: str = None) -> None:
-    """Atualiza o status e o resultado de uma tarefa."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """
+    Atualiza o status e o resultado de uma tarefa. Ao entrar em um estado final, o callback
+    da tarefa (se houver) é gravado no outbox na mesma transação. Uma tarefa 'CANCELLED' não
+    muda mais de estado (a execução em andamento apenas termina de ser interrompida).
+    """
+    _write(_update_task_status_op(task_id, status, result))
+
+async def aupdate_task_status(task_id: str, status: str, result: str = None) -> None:
+    """Versão assíncrona de update_task_status (agrupada com outras escritas em um único commit)."""
+    await _awrite(_update_task_status_op(task_id, status, result))
+
+def _update_task_status_op(task_id: str, status: str, result: str = None):
+    def operation(cursor: sqlite3.Cursor):
+        if result:
+            result_text, result_hash, result_size = _store_result(cursor, result)
+            cursor.execute(
+                """
+                UPDATE tasks SET status = ?, result = ?, result_hash = ?, result_size = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status != 'CANCELLED'
+                """,
+                (status, result_text, result_hash, result_size, task_id)
+            )
+        else:
+            cursor.execute(
+                "UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status != 'CANCELLED'",
+                (status, task_id)
+            )
+        if status in TERMINAL_STATUSES and cursor.rowcount == 1:
+            _enqueue_callback(cursor, task_id)
+    return operation
+
+def get_task(task_id: str, include_result: bool = True) -> Dict[str, Any] | None:
+    """
+    Busca uma tarefa pelo ID. Com `include_result=False`, retorna só os metadados
+    (TASK_SUMMARY_COLUMNS), sem ler o resultado nem o plano.
+    """
+    cursor = get_db_connection().cursor()
+    columns = "*" if include_result else TASK_SUMMARY_COLUMNS
+    cursor.execute(f"SELECT {columns} FROM tasks WHERE id = ?", (task_id,))
+    row = cursor.fetchone()
     
-    if result:
+    if row:
+        return _load_results(cursor, [dict(row)])[0] if include_result else dict(row)
+    return None
+
+async def aget_task(task_id: str, include_result: bool = True) -> Dict[str, Any] | None:
+    """Versão assíncrona de get_task (executada em uma thread de leitura)."""
+    return await _aread(get_task, task_id, include_result)
+
+# Colunas retornadas pelas consultas em lote (o plano e, por padrão, o resultado ficam de fora)
+TASK_SUMMARY_COLUMNS = (
+    "id, task_description, callback_url, status, attempts, priority, tenant, deadline_at, result_size, "
+    "created_at, updated_at"
+)
+# Máximo de parâmetros por consulta "IN (...)" (limite antigo do SQLite é 999)
+MAX_QUERY_PARAMS = 900
+
+def list_tasks(status: str = None, created_after: str = None, created_before: str = None, cursor: tuple = None,
+               limit: int = 100, include_result: bool = False) -> List[Dict[str, Any]]:
+    """
+    Lista tarefas da mais recente para a mais antiga, com filtros opcionais de status e de data
+    de criação ('YYYY-MM-DD HH:MM:SS', UTC). Paginação por keyset: `cursor` é o par
+    (created_at, rowid) da última tarefa da página anterior, então cada página usa o índice
+    em vez de pular linhas com OFFSET.
+    """
+    conditions, params = [], []
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if created_after:
+        conditions.append("created_at >= ?")
+        params.append(created_after)
+    if created_before:
+        conditions.append("created_at < ?")
+        params.append(created_before)
+    if cursor:
+        conditions.append("(created_at, rowid) < (?, ?)")
+        params.extend(cursor)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = TASK_SUMMARY_COLUMNS + (", result, result_hash" if include_result else "")
+    db_cursor = get_db_connection().cursor()
+    db_cursor.execute(
+        f"SELECT rowid AS _rowid, {columns} FROM tasks {where} ORDER BY created_at DESC, rowid DESC LIMIT ?",
+        (*params, limit)
+    )
+    tasks = [dict(row) for row in db_cursor.fetchall()]
+    return _load_results(db_cursor, tasks) if include_result else tasks
+
+async def alist_tasks(status: str = None, created_after: str = None, created_before: str = None, cursor: tuple = None,
+                      limit: int = 100, include_result: bool = False) -> List[Dict[str, Any]]:
+    """Versão assíncrona de list_tasks."""
+    return await _aread(list_tasks, status, created_after, created_before, cursor, limit, include_result)
+
+def get_tasks(task_ids: List[str], include_result: bool = True) -> Dict[str, Dict[str, Any]]:
+    """Busca várias tarefas de uma vez (em blocos de MAX_QUERY_PARAMS ids). Retorna {id: tarefa}."""
+    columns = TASK_SUMMARY_COLUMNS + (", result, result_hash" if include_result else "")
+    db_cursor = get_db_connection().cursor()
+    tasks = {}
+    unique_ids = list(dict.fromkeys(task_ids))
+    for start in range(0, len(unique_ids), MAX_QUERY_PARAMS):
+        chunk = unique_ids[start:start + MAX_QUERY_PARAMS]
+        db_cursor.execute(f"SELECT {columns} FROM tasks WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        tasks.update((row["id"], dict(row)) for row in db_cursor.fetchall())
+    if include_result:
+        _load_results(db_cursor, list(tasks.values()))
+    return tasks
+
+async def aget_tasks(task_ids: List[str], include_result: bool = True) -> Dict[str, Dict[str, Any]]:
+    """Versão assíncrona de get_tasks."""
+    return await _aread(get_tasks, task_ids, include_result)
+
+# --- Fila de Tarefas (leases e heartbeats) ---
+
+def claim_task(worker_id: str, lease_seconds: float, max_attempts: int,
+               min_priority: int = None) -> Dict[str, Any] | None:
+    """
+    Reivindica atomicamente a próxima tarefa disponível para um worker.
+
+    Tarefas 'IN_PROGRESS' com o lease expirado (o worker que as executava morreu ou parou de enviar
+    heartbeats) são retomadas primeiro. Entre as 'PENDING', vence a faixa de prioridade mais alta;
+    dentro da faixa, os tenants se revezam por weighted fair queuing (ver _claim_task_op), e cada
+    tenant tem as suas tarefas executadas em ordem de chegada. Com `min_priority`, só tarefas a
+    partir dessa prioridade são reivindicadas (vagas reservadas a tarefas interativas).
+
+    Tarefas que já atingiram `max_attempts` são marcadas como 'FAILED', e tarefas pendentes cujo
+    prazo (deadline) passou são marcadas como 'CANCELLED', em vez de serem executadas.
+    """
+    return _write(_claim_task_op(worker_id, lease_seconds, max_attempts, min_priority))
+
+async def aclaim_task(worker_id: str, lease_seconds: float, max_attempts: int,
+                      min_priority: int = None) -> Dict[str, Any] | None:
+    """Versão assíncrona de claim_task."""
+    return await _awrite(_claim_task_op(worker_id, lease_seconds, max_attempts, min_priority))
+
+def _finish_unclaimable(cursor: sqlite3.Cursor, task_ids: List[str], status: str, result: str) -> None:
+    for task_id in task_ids:
         cursor.execute(
-            "UPDATE tasks SET status = ?, result = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (status, result, task_id)
+            """
+            UPDATE tasks SET status = ?, lease_owner = NULL, lease_expires_at = NULL,
+                result = CASE WHEN result IS NULL AND result_hash IS NULL THEN ? ELSE result END,
+                result_size = COALESCE(result_size, ?), updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (status, result, len(result.encode("utf-8")), task_id)
+        )
+        _enqueue_callback(cursor, task_id)
+
+def _next_fair_task(cursor: sqlite3.Cursor, min_priority: int) -> str | None:
+    """
+    Escolhe a próxima tarefa 'PENDING' (weighted fair queuing entre tenants).
+
+    Cada tenant tem um "finish tag" virtual em `fair_queue`. Na faixa de prioridade mais alta com
+    tarefas pendentes, vence o tenant de menor tag; a tag avança 1/peso a cada tarefa reivindicada,
+    então tenants de peso 2 recebem o dobro das vagas. O relógio virtual (a tag de início da última
+    tarefa reivindicada) é o piso das tags: um tenant que volta após ficar ocioso, ou que é novo,
+    começa nele e não acumula crédito pelo tempo parado.
+    """
+    cursor.execute("SELECT MAX(priority) FROM tasks WHERE status = 'PENDING' AND priority >= ?", (min_priority,))
+    lane = cursor.fetchone()[0]
+    if lane is None:
+        return None
+
+    # Tenants distintos da faixa por "skip scan" no índice idx_tasks_queue (um salto por tenant, não por tarefa)
+    cursor.execute(
+        """
+        WITH RECURSIVE lane_tenants (tenant) AS (
+            SELECT MIN(tenant) FROM tasks WHERE status = 'PENDING' AND priority = ?1
+            UNION ALL
+            SELECT (SELECT MIN(tenant) FROM tasks WHERE status = 'PENDING' AND priority = ?1 AND tenant > lane_tenants.tenant)
+            FROM lane_tenants WHERE tenant IS NOT NULL
         )
-    else:
+        SELECT lane_tenants.tenant, fair_queue.finish_tag
+        FROM lane_tenants LEFT JOIN fair_queue ON fair_queue.tenant = lane_tenants.tenant
+        WHERE lane_tenants.tenant IS NOT NULL
+        """,
+        (lane,)
+    )
+    tenants = [(row["tenant"], row["finish_tag"]) for row in cursor.fetchall()]
+    cursor.execute("SELECT finish_tag FROM fair_queue WHERE tenant = ?", (FAIR_QUEUE_CLOCK,))
+    clock = cursor.fetchone()
+    virtual_time = clock["finish_tag"] if clock else 0.0
+    start_tags = {tenant: max(tag, virtual_time) if tag is not None else virtual_time for tenant, tag in tenants}
+    tenant = min(start_tags, key=lambda candidate: (start_tags[candidate], candidate))
+
+    cursor.execute(
+        """
+        SELECT id FROM tasks WHERE status = 'PENDING' AND priority = ? AND tenant = ?
+        ORDER BY created_at, rowid LIMIT 1
+        """,
+        (lane, tenant)
+    )
+    task_id = cursor.fetchone()["id"]
+    weight = float(TENANT_WEIGHTS.get(tenant, 1.0)) or 1.0
+    # Avança a tag do tenant e o relógio virtual
+    cursor.executemany(
+        """
+        INSERT INTO fair_queue (tenant, finish_tag) VALUES (?, ?)
+        ON CONFLICT (tenant) DO UPDATE SET finish_tag = excluded.finish_tag
+        """,
+        [(tenant, start_tags[tenant] + 1.0 / weight), (FAIR_QUEUE_CLOCK, start_tags[tenant])]
+    )
+    return task_id
+
+def _claim_task_op(worker_id: str, lease_seconds: float, max_attempts: int, min_priority: int = None):
+    # A operação roda na transação BEGIN IMMEDIATE do writer, que obtém o lock de escrita
+    # antes da leitura: dois workers (mesmo em processos diferentes) nunca reivindicam a mesma tarefa
+    def operation(cursor: sqlite3.Cursor):
+        now = time.time()
+        floor = min_priority if min_priority is not None else -1
         cursor.execute(
-            "UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (status, task_id)
+            "SELECT id FROM tasks WHERE status = 'IN_PROGRESS' AND lease_expires_at < ? AND attempts >= ?",
+            (now, max_attempts)
         )
-        
-    conn.commit()
-    conn.close()
+        _finish_unclaimable(cursor, [row["id"] for row in cursor.fetchall()], "FAILED",
+                            "ERRO: número máximo de tentativas excedido.")
+        cursor.execute("SELECT id FROM tasks WHERE status = 'PENDING' AND deadline_at IS NOT NULL AND deadline_at < ?",
+                       (now,))
+        _finish_unclaimable(cursor, [row["id"] for row in cursor.fetchall()], "CANCELLED",
+                            "ERRO: prazo (deadline) expirado antes do início da execução.")
 
-def get_task(task_id: str) -> Dict[str, Any] | None:
-    """Busca uma tarefa pelo ID."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+        cursor.execute(
+            """
+            SELECT id FROM tasks WHERE status = 'IN_PROGRESS' AND lease_expires_at < ? AND priority >= ?
+            ORDER BY priority DESC, lease_expires_at LIMIT 1
+            """,
+            (now, floor)
+        )
+        row = cursor.fetchone()
+        task_id = row["id"] if row is not None else _next_fair_task(cursor, floor)
+        if task_id is None:
+            return None
+
+        cursor.execute(
+            """
+            UPDATE tasks SET status = 'IN_PROGRESS', lease_owner = ?, lease_expires_at = ?,
+                attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (worker_id, now + lease_seconds, task_id)
+        )
+        cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+        return dict(cursor.fetchone())
+    return operation
+
+def heartbeat_task(task_id: str, worker_id: str, lease_seconds: float) -> bool:
+    """
+    Renova o lease de uma tarefa em execução.
+
+    Retorna False se o worker perdeu o lease (expirou e outra instância reivindicou a tarefa,
+    ou a tarefa não está mais em execução); nesse caso o worker deve abandonar a execução.
+    """
+    return _write(_heartbeat_task_op(task_id, worker_id, lease_seconds))
+
+async def aheartbeat_task(task_id: str, worker_id: str, lease_seconds: float) -> bool:
+    """Versão assíncrona de heartbeat_task."""
+    return await _awrite(_heartbeat_task_op(task_id, worker_id, lease_seconds))
+
+def _heartbeat_task_op(task_id: str, worker_id: str, lease_seconds: float):
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            "UPDATE tasks SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND status = 'IN_PROGRESS'",
+            (time.time() + lease_seconds, task_id, worker_id)
+        )
+        return cursor.rowcount == 1
+    return operation
+
+# --- Checkpoints (plano e passos) ---
+
+async def asave_plan(task_id: str, plan_json: str) -> None:
+    """Persiste o plano gerado para a tarefa."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute("UPDATE tasks SET plan = ? WHERE id = ?", (plan_json, task_id))
+    await _awrite(operation)
+
+async def asave_step_result(task_id: str, step_id: int, status: str, result: str) -> None:
+    """Registra o estado ('COMPLETED' ou 'FAILED') e o resultado de um passo."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            INSERT INTO task_steps (task_id, step_id, status, result) VALUES (?, ?, ?, ?)
+            ON CONFLICT (task_id, step_id) DO UPDATE SET
+                status = excluded.status, result = excluded.result, updated_at = CURRENT_TIMESTAMP
+            """,
+            (task_id, step_id, status, result)
+        )
+    await _awrite(operation)
+
+def get_completed_steps(task_id: str) -> Dict[int, str]:
+    """Retorna {step_id: resultado} dos passos já concluídos da tarefa."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT step_id, result FROM task_steps WHERE task_id = ? AND status = 'COMPLETED'", (task_id,))
+    return {row["step_id"]: row["result"] for row in cursor.fetchall()}
+
+async def aget_completed_steps(task_id: str) -> Dict[int, str]:
+    """Versão assíncrona de get_completed_steps."""
+    return await _aread(get_completed_steps, task_id)
+
+async def aretry_task(task_id: str) -> bool:
+    """
+    Recoloca uma tarefa 'FAILED' na fila. O plano e os passos concluídos são mantidos,
+    então a nova execução continua a partir do primeiro passo incompleto.
+    Retorna False se a tarefa não existe ou não está 'FAILED'.
+    """
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            UPDATE tasks SET status = 'PENDING', result = NULL, result_hash = NULL, result_size = NULL, attempts = 0,
+                lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'FAILED'
+            """,
+            (task_id,)
+        )
+        return cursor.rowcount == 1
+    return await _awrite(operation)
+
+async def acancel_task(task_id: str, reason: str) -> Dict[str, Any] | None:
+    """
+    Cancela uma tarefa que ainda não terminou: o status passa a 'CANCELLED' (com `reason` como
+    resultado) e o callback é gravado no outbox. Uma execução em andamento é interrompida pelo
+    worker ao perceber o novo status. Retorna a tarefa como estava antes (None se não existe);
+    se ela já estava em um estado final, nada é alterado.
+    """
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+        task = cursor.fetchone()
+        if task is None:
+            return None
+        if task["status"] not in TERMINAL_STATUSES:
+            cursor.execute(
+                """
+                UPDATE tasks SET status = 'CANCELLED', result = ?, result_hash = ?, result_size = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (*_store_result(cursor, reason), task_id)
+            )
+            _enqueue_callback(cursor, task_id)
+        return dict(task)
+    return await _awrite(operation)
+
+def cancelled_tasks(task_ids: List[str]) -> List[str]:
+    """Dos ids informados, retorna os das tarefas 'CANCELLED' (consultado pelos workers)."""
+    if not task_ids:
+        return []
+    cursor = get_db_connection().cursor()
+    cancelled = []
+    for start in range(0, len(task_ids), MAX_QUERY_PARAMS):
+        chunk = task_ids[start:start + MAX_QUERY_PARAMS]
+        cursor.execute(
+            f"SELECT id FROM tasks WHERE id IN ({', '.join('?' * len(chunk))}) AND status = 'CANCELLED'", chunk
+        )
+        cancelled.extend(row["id"] for row in cursor.fetchall())
+    return cancelled
+
+async def acancelled_tasks(task_ids: List[str]) -> List[str]:
+    """Versão assíncrona de cancelled_tasks."""
+    return await _aread(cancelled_tasks, task_ids)
+
+# --- Outbox de Callbacks ---
+
+def _enqueue_callback(cursor: sqlite3.Cursor, task_id: str) -> None:
+    """
+    Grava no outbox o resultado final da tarefa para a sua callback_url e para as dos pedidos
+    duplicados anexados a ela (roda dentro da transação).
+    """
+    cursor.execute(
+        "SELECT id, status, result, result_hash, callback_url, callback_batch FROM tasks WHERE id = ?", (task_id,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return
+    task = _load_results(cursor, [dict(row)])[0]
+    targets = [(task["callback_url"], task["callback_batch"])] if task["callback_url"] else []
+    cursor.execute("SELECT callback_url, callback_batch FROM task_callbacks WHERE task_id = ?", (task_id,))
+    targets += [(row["callback_url"], row["callback_batch"]) for row in cursor.fetchall()]
+    for callback_url, callback_batch in targets:
+        _insert_callback(cursor, task, callback_url, callback_batch)
+
+def _insert_callback(cursor: sqlite3.Cursor, task: Dict[str, Any], callback_url: str, callback_batch: int) -> None:
+    payload = json.dumps({"task_id": task["id"], "status": task["status"], "result": task["result"]}, ensure_ascii=False)
+    cursor.execute(
+        "INSERT INTO callback_outbox (task_id, callback_url, payload, batch, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+        (task["id"], callback_url, payload, callback_batch, time.time())
+    )
+
+async def aclaim_callbacks(limit: int, lease_seconds: float) -> List[Dict[str, Any]]:
+    """
+    Reivindica até `limit` callbacks prontos para envio ('PENDING' com next_attempt_at vencido,
+    ou 'SENDING' com o lease expirado porque o processo que os enviava morreu).
+    """
+    def operation(cursor: sqlite3.Cursor):
+        now = time.time()
+        cursor.execute(
+            """
+            SELECT * FROM callback_outbox
+            WHERE (status = 'PENDING' AND next_attempt_at <= ?) OR (status = 'SENDING' AND lease_expires_at < ?)
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+            """,
+            (now, now, limit)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE callback_outbox SET status = 'SENDING', lease_expires_at = ? WHERE id = ?",
+            [(now + lease_seconds, row["id"]) for row in rows]
+        )
+        return rows
+    return await _awrite(operation)
+
+async def amark_callbacks_delivered(callback_ids: List[int]) -> None:
+    """Marca os callbacks como entregues (as linhas ficam como registro da entrega)."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.executemany(
+            """
+            UPDATE callback_outbox SET status = 'DELIVERED', attempts = attempts + 1, lease_expires_at = NULL,
+                last_error = NULL, delivered_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            [(callback_id,) for callback_id in callback_ids]
+        )
+    await _awrite(operation)
+
+async def areschedule_callback(callback_id: int, next_attempt_at: float, error: str) -> None:
+    """Registra uma tentativa de entrega que falhou e agenda a próxima."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            UPDATE callback_outbox SET status = 'PENDING', attempts = attempts + 1, next_attempt_at = ?,
+                lease_expires_at = NULL, last_error = ?
+            WHERE id = ?
+            """,
+            (next_attempt_at, error, callback_id)
+        )
+    await _awrite(operation)
+
+async def adead_letter_callback(callback_id: int, error: str) -> None:
+    """Move um callback do outbox para a tabela de dead letters."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            INSERT INTO callback_dead_letters (task_id, callback_url, payload, batch, attempts, last_error)
+            SELECT task_id, callback_url, payload, batch, attempts + 1, ? FROM callback_outbox WHERE id = ?
+            """,
+            (error, callback_id)
+        )
+        cursor.execute("DELETE FROM callback_outbox WHERE id = ?", (callback_id,))
+    await _awrite(operation)
+
+def list_dead_letters(limit: int = 100) -> List[Dict[str, Any]]:
+    """Lista os callbacks em dead letter, dos mais recentes para os mais antigos."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT * FROM callback_dead_letters ORDER BY id DESC LIMIT ?", (limit,))
+    return [dict(row) for row in cursor.fetchall()]
+
+async def alist_dead_letters(limit: int = 100) -> List[Dict[str, Any]]:
+    """Versão assíncrona de list_dead_letters."""
+    return await _aread(list_dead_letters, limit)
+
+async def aredrive_dead_letters(dead_letter_id: int = None) -> int:
+    """
+    Devolve ao outbox o dead letter `dead_letter_id` (ou todos, se None), com as tentativas zeradas.
+    Retorna quantos callbacks foram reenfileirados.
+    """
+    def operation(cursor: sqlite3.Cursor):
+        where, params = ("WHERE id = ?", (dead_letter_id,)) if dead_letter_id is not None else ("", ())
+        cursor.execute(
+            f"""
+            INSERT INTO callback_outbox (task_id, callback_url, payload, batch, next_attempt_at)
+            SELECT task_id, callback_url, payload, batch, ? FROM callback_dead_letters {where} ORDER BY id
+            """,
+            (time.time(), *params)
+        )
+        redriven = cursor.rowcount
+        cursor.execute(f"DELETE FROM callback_dead_letters {where}", params)
+        return redriven
+    return await _awrite(operation)
+
+# --- Cache de Planos ---
+
+def get_cached_plan(template: str) -> Dict[str, Any] | None:
+    """Busca o plano em cache de um template exato."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT template, plan, params, parametrized FROM plan_cache WHERE template = ?", (template,))
     row = cursor.fetchone()
+    return dict(row) if row else None
+
+async def aget_cached_plan(template: str) -> Dict[str, Any] | None:
+    """Versão assíncrona de get_cached_plan."""
+    return await _aread(get_cached_plan, template)
+
+async def asave_cached_plan(template: str, plan_json: str, params_json: str, parametrized: bool) -> None:
+    """Grava (ou substitui) o plano de um template, preservando o contador de acertos."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            INSERT INTO plan_cache (template, plan, params, parametrized) VALUES (?, ?, ?, ?)
+            ON CONFLICT (template) DO UPDATE SET
+                plan = excluded.plan, params = excluded.params, parametrized = excluded.parametrized
+            """,
+            (template, plan_json, params_json, int(parametrized))
+        )
+    await _awrite(operation)
+
+async def arecord_plan_hit(template: str) -> None:
+    """Conta um reaproveitamento do plano do template."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            "UPDATE plan_cache SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP WHERE template = ?",
+            (template,)
+        )
+    await _awrite(operation)
+
+def plan_cache_stats(top: int = 10) -> Dict[str, Any]:
+    """Totais do cache de planos (todas as execuções) e os templates mais reaproveitados."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits FROM plan_cache")
+    totals = dict(cursor.fetchone())
+    # Cada entrada nasceu de um planejamento pelo modelo (um miss); os acertos são os reaproveitamentos
+    planned = totals["entries"] + totals["hits"]
+    totals["hit_rate"] = totals["hits"] / planned if planned else 0.0
+    cursor.execute("SELECT template, hits, last_used_at FROM plan_cache ORDER BY hits DESC LIMIT ?", (top,))
+    return {**totals, "top_templates": [dict(row) for row in cursor.fetchall()]}
+
+async def aplan_cache_stats(top: int = 10) -> Dict[str, Any]:
+    """Versão assíncrona de plan_cache_stats."""
+    return await _aread(plan_cache_stats, top)
+
+# --- Spans de Execução ---
+
+async def asave_spans(rows: List[tuple]) -> None:
+    """Grava um lote de spans (ver tracing.Span.to_row); a própria gravação não gera span."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.executemany(
+            """
+            INSERT INTO task_spans (task_id, span_id, parent_id, name, started_at, duration, queue_wait, status, attributes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+    await _awrite(operation, traced=False)
+
+def get_task_spans(task_id: str) -> List[Dict[str, Any]]:
+    """Retorna os spans de uma tarefa em ordem de início."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        """
+        SELECT span_id, parent_id, name, started_at, duration, queue_wait, status, attributes
+        FROM task_spans WHERE task_id = ? ORDER BY started_at
+        """,
+        (task_id,)
+    )
+    spans = []
+    for row in cursor.fetchall():
+        span = dict(row)
+        span["attributes"] = json.loads(span["attributes"]) if span["attributes"] else {}
+        spans.append(span)
+    return spans
+
+async def aget_task_spans(task_id: str) -> List[Dict[str, Any]]:
+    """Versão assíncrona de get_task_spans."""
+    return await _aread(get_task_spans, task_id)
+
+# --- Retenção (limpeza de tarefas antigas e compactação) ---
+
+def expired_tasks(created_before: str, limit: int) -> List[str]:
+    """
+    Ids de até `limit` tarefas em estado final criadas antes de `created_before` ('YYYY-MM-DD HH:MM:SS', UTC),
+    das mais antigas para as mais novas. Tarefas com callbacks ainda não entregues ficam de fora.
+    """
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        f"""
+        SELECT id FROM tasks
+        WHERE status IN ({', '.join('?' * len(TERMINAL_STATUSES))}) AND created_at < ?
+            AND NOT EXISTS (
+                SELECT 1 FROM callback_outbox
+                WHERE callback_outbox.task_id = tasks.id AND callback_outbox.status != 'DELIVERED'
+            )
+        ORDER BY created_at LIMIT ?
+        """,
+        (*TERMINAL_STATUSES, created_before, limit)
+    )
+    return [row["id"] for row in cursor.fetchall()]
+
+async def aexpired_tasks(created_before: str, limit: int) -> List[str]:
+    """Versão assíncrona de expired_tasks."""
+    return await _aread(expired_tasks, created_before, limit)
+
+async def apurge_tasks(task_ids: List[str]) -> int:
+    """
+    Apaga as tarefas (em estado final) e tudo o que pertence a elas: passos, spans, callbacks
+    adicionais e callbacks já entregues. Os blobs de resultado sem outra tarefa que os use são
+    apagados por apurge_orphan_blobs. Retorna o número de tarefas apagadas.
+    """
+    def operation(cursor: sqlite3.Cursor):
+        deleted = 0
+        for start in range(0, len(task_ids), MAX_QUERY_PARAMS):
+            chunk = task_ids[start:start + MAX_QUERY_PARAMS]
+            ids = ", ".join("?" * len(chunk))
+            cursor.execute(
+                f"DELETE FROM tasks WHERE id IN ({ids}) AND status IN ({', '.join('?' * len(TERMINAL_STATUSES))})",
+                (*chunk, *TERMINAL_STATUSES)
+            )
+            deleted += cursor.rowcount
+            for table in ("task_steps", "task_spans", "task_callbacks"):
+                cursor.execute(f"DELETE FROM {table} WHERE task_id IN ({ids})", chunk)
+            cursor.execute(f"DELETE FROM callback_outbox WHERE task_id IN ({ids}) AND status = 'DELIVERED'", chunk)
+        return deleted
+    return await _awrite(operation)
+
+async def apurge_orphan_blobs(limit: int) -> int:
+    """Apaga até `limit` blobs de resultado que nenhuma tarefa referencia mais. Retorna quantos."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            DELETE FROM result_blobs WHERE hash IN (
+                SELECT hash FROM result_blobs
+                WHERE NOT EXISTS (SELECT 1 FROM tasks WHERE tasks.result_hash = result_blobs.hash)
+                LIMIT ?
+            )
+            """,
+            (limit,)
+        )
+        return cursor.rowcount
+    return await _awrite(operation)
+
+async def apurge_delivered_callbacks(delivered_before: str, limit: int) -> int:
+    """Apaga até `limit` callbacks entregues antes de `delivered_before` (o payload guarda uma cópia do resultado)."""
+    def operation(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            DELETE FROM callback_outbox WHERE id IN (
+                SELECT id FROM callback_outbox WHERE status = 'DELIVERED' AND delivered_at < ? LIMIT ?
+            )
+            """,
+            (delivered_before, limit)
+        )
+        return cursor.rowcount
+    return await _awrite(operation)
+
+async def aincremental_vacuum(max_pages: int) -> int:
+    """
+    Devolve ao sistema de arquivos até `max_pages` páginas livres (PRAGMA incremental_vacuum), em uma
+    transação curta do writer em vez de um VACUUM completo. Retorna o número de páginas liberadas
+    (0 se o banco não usa auto_vacuum incremental, ver enable_incremental_vacuum).
+    """
+    def operation(cursor: sqlite3.Cursor):
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        pages = min(max_pages, cursor.execute("PRAGMA freelist_count").fetchone()[0])
+        # O módulo sqlite3 executa o pragma um único passo (uma página) por chamada
+        for _ in range(pages):
+            cursor.execute("PRAGMA incremental_vacuum(1)")
+        return pages
+    return await _awrite(operation)
+
+def enable_incremental_vacuum() -> None:
+    """
+    Ativa o auto_vacuum incremental em um banco criado antes dele. Exige um VACUUM completo,
+    que reescreve o arquivo e bloqueia as escritas enquanto roda: execute com a API e os workers parados.
+    """
+    conn = sqlite3.connect(DATABASE_FILE, isolation_level=None, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
     conn.close()
-    
-    if row:
-        return dict(row)
-    return None
+
+def database_size() -> Dict[str, int]:
+    """Páginas do arquivo do banco: total, livres e tamanho de cada página (bytes)."""
+    cursor = get_db_connection().cursor()
+    return {
+        "page_count": cursor.execute("PRAGMA page_count").fetchone()[0],
+        "freelist_count": cursor.execute("PRAGMA freelist_count").fetchone()[0],
+        "page_size": cursor.execute("PRAGMA page_size").fetchone()[0],
+    }
 
 if __name__ == "__main__":
     # Exemplo de uso e teste
-    if os.path.exists(DATABASE_FILE):
-        os.remove(DATABASE_FILE)
+    for path in (DATABASE_FILE, f"{DATABASE_FILE}-wal", f"{DATABASE_FILE}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
         
     init_db()
     
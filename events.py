@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+import httpx
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+# --- Event Stream Configuration (environment variables) ---
+
+EVENTS_HISTORY_SIZE = int(os.environ.get("EVENTS_HISTORY_SIZE", "500"))  # Events kept per task for replay
+EVENTS_RETENTION_SECONDS = float(os.environ.get("EVENTS_RETENTION_SECONDS", "300"))  # After the task ends
+EVENTS_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("EVENTS_SUBSCRIBER_QUEUE_SIZE", "1000"))
+# Worker processes forward their events to the API process at this base URL (e.g. http://127.0.0.1:8000)
+EVENTS_RELAY_URL = os.environ.get("EVENTS_RELAY_URL")
+# Shared secret of the relay; required: the API refuses relayed events while it is unset
+EVENTS_RELAY_TOKEN = os.environ.get("EVENTS_RELAY_TOKEN", "")
+
+# Event types that end a task's stream
+TERMINAL_EVENTS = {"task_completed", "task_failed", "task_cancelled"}
+
+class TaskEventBus:
+    """
+    In-process pub/sub of task progress events (plan, steps, partial output, final result).
+
+    Each task keeps a bounded history so late subscribers (or reconnecting clients sending
+    Last-Event-ID) get the events they missed. Histories are dropped some time after the task ends.
+    """
+    def __init__(self, history_size: int = EVENTS_HISTORY_SIZE, retention_seconds: float = EVENTS_RETENTION_SECONDS):
+        self.history_size = history_size
+        self.retention_seconds = retention_seconds
+        self._history: Dict[str, deque] = {}
+        self._sequence: Dict[str, int] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+    def add_listener(self, listener: Callable[[Dict[str, Any]], None]):
+        """Registers a callback that receives every published event (used by the relay)."""
+        self._listeners.append(listener)
+
+    def publish(self, task_id: str, event_type: str, data: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Creates a new event for the task and delivers it. Must be called from the event loop."""
+        # Ids are microsecond timestamps (kept strictly increasing), so they stay ordered
+        # when a retried task continues in another worker process
+        self._sequence[task_id] = max(self._sequence.get(task_id, 0) + 1, time.time_ns() // 1000)
+        event = {
+            "id": self._sequence[task_id],
+            "task_id": task_id,
+            "type": event_type,
+            "data": data or {},
+            "ts": time.time(),
+        }
+        self.deliver(event)
+        for listener in self._listeners:
+            listener(event)
+        return event
+
+    def deliver(self, event: Dict[str, Any]):
+        """
+        Delivers an already-built event to the local subscribers. Events relayed from a worker
+        process enter here directly, so they are never relayed again.
+        """
+        task_id = event["task_id"]
+        self._sequence[task_id] = max(self._sequence.get(task_id, 0), event["id"])
+        self._history.setdefault(task_id, deque(maxlen=self.history_size)).append(event)
+
+        for queue in list(self._subscribers.get(task_id, [])):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow to keep up: close the stream, the client can reconnect with Last-Event-ID
+                self._subscribers[task_id].remove(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+        if event["type"] in TERMINAL_EVENTS:
+            for queue in self._subscribers.pop(task_id, []):
+                try:
+                    queue.put_nowait(None)
+                except asyncio.QueueFull:
+                    pass
+            asyncio.get_running_loop().call_later(self.retention_seconds, self._forget, task_id, event["id"])
+
+    def _forget(self, task_id: str, last_event_id: int):
+        # Keep the history if the task was retried and produced new events in the meantime
+        if self._sequence.get(task_id) == last_event_id and not self._subscribers.get(task_id):
+            self._history.pop(task_id, None)
+            self._sequence.pop(task_id, None)
+
+    def history(self, task_id: str, after_id: int = 0) -> List[Dict[str, Any]]:
+        return [event for event in self._history.get(task_id, ()) if event["id"] > after_id]
+
+    async def subscribe(self, task_id: str, after_id: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yields the task's events, starting with the history newer than `after_id`,
+        until a terminal event is delivered.
+        """
+        queue = asyncio.Queue(maxsize=EVENTS_SUBSCRIBER_QUEUE_SIZE)
+        backlog = self.history(task_id, after_id)
+        if not any(event["type"] in TERMINAL_EVENTS for event in backlog):
+            self._subscribers.setdefault(task_id, []).append(queue)
+        else:
+            queue = None
+
+        try:
+            last_id = after_id
+            for event in backlog:
+                last_id = event["id"]
+                yield event
+            while queue is not None:
+                event = await queue.get()
+                if event is None:
+                    return
+                if event["id"] > last_id:
+                    last_id = event["id"]
+                    yield event
+        finally:
+            if queue is not None and queue in self._subscribers.get(task_id, []):
+                self._subscribers[task_id].remove(queue)
+
+class EventRelay:
+    """
+    Forwards the events of a worker process to the API process (POST /internal/events),
+    in small batches over a keep-alive connection, so SSE/WebSocket clients on the API see them.
+    """
+    def __init__(self, base_url: str, token: str = EVENTS_RELAY_TOKEN, max_batch: int = 100):
+        self.url = base_url.rstrip("/") + "/internal/events"
+        self.token = token
+        self.max_batch = max_batch
+        self._queue = None
+        self._client = None
+        self._sender = None
+
+    def enqueue(self, event: Dict[str, Any]):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._client = httpx.AsyncClient(timeout=10.0)
+            self._sender = asyncio.get_running_loop().create_task(self._send_loop())
+        self._queue.put_nowait(event)
+
+    async def _send_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < self.max_batch:
+                batch.append(self._queue.get_nowait())
+            try:
+                response = await self._client.post(self.url, json=batch, headers={"X-Relay-Token": self.token})
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                # Progress events are best effort: the final result is always persisted in the DB
+                print(f"Erro ao repassar {len(batch)} evento(s) para a API: {e}")
+
+# Process-wide event bus
+bus = TaskEventBus()
+
+if EVENTS_RELAY_URL:
+    if not EVENTS_RELAY_TOKEN:
+        print("Aviso: EVENTS_RELAY_URL definido sem EVENTS_RELAY_TOKEN; a API vai recusar os eventos repassados.")
+    bus.add_listener(EventRelay(EVENTS_RELAY_URL).enqueue)
@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from google.genai import errors
+
+# Local stand-ins for the external services (Gemini, the scraped sites and a callback receiver),
+# used by benchmark.py and for running the agent offline. See `FakeGeminiClient` and `create_app`.
+
+# Plan returned for every planning request: scraping, generation and sandboxed code, with parallel branches
+DEFAULT_PLAN = {
+    "task_goal": "Resumir as notícias de IA e contar as palavras do resumo",
+    "phases": [
+        {"step_id": 1, "description": "Coletar as notícias de IA mais recentes", "tool_required": "web_scraper",
+         "depends_on": []},
+        {"step_id": 2, "description": "Escrever um resumo das notícias coletadas", "tool_required": "content_generator",
+         "depends_on": [1]},
+        {"step_id": 3, "description": "Gerar uma função Python que conte palavras", "tool_required": "code_generator",
+         "depends_on": []},
+        {"step_id": 4, "description": "Executar o código gerado", "tool_required": "code_execution",
+         "depends_on": [3]},
+        {"step_id": 5, "description": "Confirmar a conclusão da tarefa", "tool_required": "none",
+         "depends_on": [2, 4]},
+    ],
+}
+FAKE_CODE = "```python\ntexto = 'o agente resume as notícias de IA'\nprint(len(texto.split()))\n```"
+WORDS = "agente modelo dados resultado notícias inteligência artificial análise resumo tarefa".split()
+CHARS_PER_TOKEN = 4
+
+class FakeGemini:
+    """
+    Answers generation requests like Gemini would, after a simulated latency.
+
+    Latencies follow a log-normal distribution (`latency_median` seconds, spread `latency_sigma`),
+    capped at `latency_max`. A share of the requests fails with 503 (`error_rate`) or 429
+    (`rate_limit_rate`). Structured requests (response schema set) receive `plan` as JSON; code
+    generation prompts receive a fenced Python block; everything else ~`response_tokens` of text.
+    """
+    def __init__(self, latency_median: float = 0.5, latency_sigma: float = 0.5, latency_max: float = 30.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, response_tokens: int = 200,
+                 plan: Dict[str, Any] = None, seed: int = None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_max = latency_max
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.response_tokens = response_tokens
+        self.plan = plan or DEFAULT_PLAN
+        self._random = random.Random(seed)
+        self.counters = {"requests": 0, "errors": 0, "rate_limited": 0, "structured": 0}
+
+    def latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return min(self.latency_max, self._random.lognormvariate(math.log(self.latency_median), self.latency_sigma))
+
+    def failure(self) -> int | None:
+        """Status code of a simulated failure for this request, or None."""
+        draw = self._random.random()
+        if draw < self.rate_limit_rate:
+            self.counters["rate_limited"] += 1
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.counters["errors"] += 1
+            return 503
+        return None
+
+    def answer(self, prompt: str, system_instruction: str = None, structured: bool = False) -> str:
+        if structured:
+            self.counters["structured"] += 1
+            return json.dumps(self.plan, ensure_ascii=False)
+        if system_instruction and "código" in system_instruction:
+            return FAKE_CODE
+        return " ".join(self._random.choice(WORDS) for _ in range(self.response_tokens * CHARS_PER_TOKEN // 8))
+
+    async def respond(self, prompt: str, system_instruction: str = None, structured: bool = False) -> tuple[int, str, Dict[str, int]]:
+        """Waits the simulated latency; returns (status code, text, usage)."""
+        self.counters["requests"] += 1
+        await asyncio.sleep(self.latency())
+        status = self.failure()
+        if status is not None:
+            return status, "", {}
+        text = self.answer(prompt, system_instruction, structured)
+        prompt_tokens = (len(prompt) + len(system_instruction or "")) // CHARS_PER_TOKEN + 1
+        output_tokens = len(text) // CHARS_PER_TOKEN + 1
+        return 200, text, {"prompt_token_count": prompt_tokens, "candidates_token_count": output_tokens,
+                           "total_token_count": prompt_tokens + output_tokens}
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counters)
+
+def _api_error(status: int) -> Dict[str, Any]:
+    reason = "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"
+    return {"error": {"code": status, "message": f"Falha simulada ({reason})", "status": reason}}
+
+# --- In-process client (same surface as genai.Client().aio.models) ---
+
+class FakeModels:
+    def __init__(self, gemini: FakeGemini):
+        self.gemini = gemini
+
+    async def _respond(self, contents: Any, config: Any) -> SimpleNamespace:
+        system_instruction = getattr(config, "system_instruction", None) if config is not None else None
+        structured = config is not None and getattr(config, "response_schema", None) is not None
+        status, text, usage = await self.gemini.respond(str(contents), system_instruction, structured)
+        if status == 429:
+            raise errors.ClientError(status, _api_error(status))
+        if status != 200:
+            raise errors.ServerError(status, _api_error(status))
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(**usage))
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> SimpleNamespace:
+        return await self._respond(contents, config)
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> AsyncIterator[SimpleNamespace]:
+        response = await self._respond(contents, config)
+
+        async def chunks():
+            pieces = _split(response.text)
+            for index, piece in enumerate(pieces):
+                last = index == len(pieces) - 1
+                yield SimpleNamespace(text=piece, usage_metadata=response.usage_metadata if last else None)
+        return chunks()
+
+class FakeGeminiClient:
+    """Drop-in for genai.Client in a single process: `llm.set_client(FakeGeminiClient(FakeGemini()))`."""
+    def __init__(self, gemini: FakeGemini = None):
+        self.gemini = gemini or FakeGemini()
+        self.aio = SimpleNamespace(models=FakeModels(self.gemini))
+
+def _split(text: str, chunks: int = 4) -> List[str]:
+    size = max(1, math.ceil(len(text) / chunks))
+    return [text[i:i + size] for i in range(0, len(text), size)] or [text]
+
+# --- HTTP server (Gemini REST API, scraped sites and callback receiver) ---
+
+def sites_config(base_url: str, sites: int = 3, limit: int = 5) -> List[Dict[str, Any]]:
+    """A scraper_sites.json pointing at the fake server's pages."""
+    return [{"url": f"{base_url}/sites/{index}", "selector": "h2.title", "limit": limit} for index in range(sites)]
+
+def create_app(gemini: FakeGemini = None) -> FastAPI:
+    """
+    The fake services as one FastAPI app:
+
+    *   `POST /v1beta/models/{model}:generateContent` and `:streamGenerateContent` (SSE), the Gemini
+        REST API as called by google-genai with `GEMINI_BASE_URL` pointing here
+    *   `GET /sites/{index}`, news pages for the web scraper (see `sites_config`)
+    *   `POST /callbacks`, a callback receiver (single or batched results); `GET /callbacks` returns
+        when each task's result first arrived, `DELETE /callbacks` clears them
+    *   `GET /stats`, the Gemini request counters
+    """
+    gemini = gemini or FakeGemini()
+    app = FastAPI(title="7z IA Exclusive - Fake services")
+    received: Dict[str, float] = {}
+    counters = {"posts": 0, "results": 0, "duplicates": 0}
+
+    async def parse_generation(request: Request) -> tuple[int, str, Dict[str, int]]:
+        body = await request.json()
+        prompt = "".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+        system = "".join(part.get("text", "") for part in (body.get("systemInstruction") or {}).get("parts", []))
+        generation_config = body.get("generationConfig") or {}
+        structured = "responseSchema" in generation_config or "responseJsonSchema" in generation_config
+        return await gemini.respond(prompt, system or None, structured)
+
+    def response_json(text: str, usage: Dict[str, int], finished: bool = True) -> Dict[str, Any]:
+        candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+        if finished:
+            candidate["finishReason"] = "STOP"
+        payload = {"candidates": [candidate]}
+        if usage:
+            payload["usageMetadata"] = {
+                "promptTokenCount": usage["prompt_token_count"],
+                "candidatesTokenCount": usage["candidates_token_count"],
+                "totalTokenCount": usage["total_token_count"],
+            }
+        return payload
+
+    @app.post("/v1beta/models/{model}:generateContent")
+    async def generate_content(model: str, request: Request):
+        status, text, usage = await parse_generation(request)
+        if status != 200:
+            return JSONResponse(_api_error(status), status_code=status)
+        return response_json(text, usage)
+
+    @app.post("/v1beta/models/{model}:streamGenerateContent")
+    async def stream_generate_content(model: str, request: Request):
+        status, text, usage = await parse_generation(request)
+        if status != 200:
+            return JSONResponse(_api_error(status), status_code=status)
+
+        async def events():
+            pieces = _split(text)
+            for index, piece in enumerate(pieces):
+                last = index == len(pieces) - 1
+                yield f"data: {json.dumps(response_json(piece, usage if last else {}, last), ensure_ascii=False)}\r\n\r\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/sites/{index}", response_class=HTMLResponse)
+    async def site(index: int):
+        titles = "".join(f'<article><h2 class="title">Notícia {item} do site {index}: avanços em IA</h2></article>'
+                         for item in range(10))
+        return f"<html><body>{titles}</body></html>"
+
+    @app.post("/callbacks")
+    async def receive_callback(request: Request):
+        body = await request.json()
+        now = time.time()
+        counters["posts"] += 1
+        for result in body.get("results", [body]):
+            counters["results"] += 1
+            if result["task_id"] in received:
+                counters["duplicates"] += 1
+            else:
+                received[result["task_id"]] = now
+        return {"received": True}
+
+    @app.get("/callbacks")
+    async def list_callbacks():
+        return {"received": received, **counters}
+
+    @app.delete("/callbacks")
+    async def clear_callbacks():
+        received.clear()
+        counters.update(posts=0, results=0, duplicates=0)
+        return {"cleared": True}
+
+    @app.get("/stats")
+    async def stats():
+        return gemini.stats()
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake Gemini, scraped sites and callback receiver for offline runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Median Gemini latency (s).")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal spread of the latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429.")
+    parser.add_argument("--response-tokens", type=int, default=200, help="Approximate size of text answers.")
+    parser.add_argument("--plan-file", help="JSON file with the Plan returned to planning requests.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    plan = None
+    if args.plan_file:
+        with open(args.plan_file, encoding="utf-8") as f:
+            plan = json.load(f)
+    fake = FakeGemini(latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                      error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                      response_tokens=args.response_tokens, plan=plan, seed=args.seed)
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,208 @@
+import asyncio
+import email.utils
+import importlib.util
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import httpx
+from typing import Any, Dict, List
+
+# --- Fetcher Configuration (environment variables) ---
+
+SCRAPER_SITES_FILE = os.environ.get(
+    "SCRAPER_SITES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scraper_sites.json")
+)
+# A cached page younger than this is reused without any request, when the server sends no max-age/Expires
+SCRAPER_FRESHNESS_SECONDS = float(os.environ.get("SCRAPER_FRESHNESS_SECONDS", "600"))
+SCRAPER_TIMEOUT_SECONDS = float(os.environ.get("SCRAPER_TIMEOUT_SECONDS", "5"))
+SCRAPER_MAX_CONNECTIONS = int(os.environ.get("SCRAPER_MAX_CONNECTIONS", "20"))
+HTTP_CACHE_FILE = os.environ.get("HTTP_CACHE_FILE", "http_cache.db")
+# Wait for the cache's lock (other workers writing) before giving up on a lookup or a write
+HTTP_CACHE_BUSY_TIMEOUT_MS = int(os.environ.get("HTTP_CACHE_BUSY_TIMEOUT_MS", "2000"))
+
+# lxml is much faster than the pure-Python html.parser; used when installed (found without importing it,
+# like bs4 it is only loaded when the first page is parsed)
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+# Selectors like "h2.title" or "a#main.link" can be parsed with a SoupStrainer on the tag name
+SIMPLE_SELECTOR = re.compile(r"^([a-zA-Z][a-zA-Z0-9]*)((?:[.#][\w-]+)*)$")
+
+def load_sites(path: str = SCRAPER_SITES_FILE) -> List[Dict[str, Any]]:
+    """Reads the list of sources ({"url", "selector", "limit"}) scraped by web_scraper."""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+class HTTPCache:
+    """
+    On-disk HTTP cache (SQLite) keyed by URL.
+
+    Stores the body with its ETag/Last-Modified validators and a freshness deadline derived from
+    Cache-Control (max-age, no-cache, no-store), Expires or, without them, SCRAPER_FRESHNESS_SECONDS.
+
+    The cache is best-effort: a SQLite error (e.g. "database is locked" on the file shared by all
+    workers) is logged and treated as a miss or a skipped write, never as a failed fetch. Its methods
+    block on SQLite, so async callers run them in a thread.
+    """
+    def __init__(self, db_file: str = HTTP_CACHE_FILE):
+        self.db_file = db_file
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        """Opens the cache lazily (must be called with `_lock` held)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=HTTP_CACHE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            # WAL: lookups from other workers do not block on a writer
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA busy_timeout = {HTTP_CACHE_BUSY_TIMEOUT_MS}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS http_cache (
+                    url TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fresh_until REAL NOT NULL
+                );
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, url: str) -> Dict[str, Any] | None:
+        try:
+            with self._lock:
+                row = self._db().execute("SELECT * FROM http_cache WHERE url = ?", (url,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Erro ao ler o cache HTTP (tratado como ausente): {e}")
+            return None
+        return dict(row) if row else None
+
+    def store(self, url: str, response: httpx.Response, body: str) -> None:
+        lifetime = freshness_lifetime(response.headers)
+        if lifetime is None:
+            return
+        self._write(
+            "INSERT OR REPLACE INTO http_cache (url, body, etag, last_modified, fresh_until) VALUES (?, ?, ?, ?, ?)",
+            (url, body, response.headers.get("etag"), response.headers.get("last-modified"), time.time() + lifetime)
+        )
+
+    def refresh(self, url: str, response: httpx.Response) -> None:
+        """Extends the freshness of an entry after a 304 Not Modified."""
+        lifetime = freshness_lifetime(response.headers) or 0
+        self._write("UPDATE http_cache SET fresh_until = ? WHERE url = ?", (time.time() + lifetime, url))
+
+    def _write(self, sql: str, params: tuple) -> None:
+        try:
+            with self._lock:
+                conn = self._db()
+                try:
+                    conn.execute(sql, params)
+                    conn.commit()
+                except sqlite3.Error:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+        except sqlite3.Error as e:
+            print(f"Erro ao gravar no cache HTTP (ignorado): {e}")
+
+def freshness_lifetime(headers: httpx.Headers) -> float | None:
+    """
+    Seconds a response may be reused without revalidation, or None if it must not be stored.
+    The server's max-age (or Expires) is honoured as is, shorter or longer than the configured
+    window, which only applies when the server gives no freshness information; no-cache means
+    store, but always revalidate.
+    """
+    directives = {}
+    for part in headers.get("cache-control", "").lower().split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    max_age = directives.get("s-maxage") or directives.get("max-age")
+    if max_age and max_age.isdigit():
+        return float(max_age)
+    if headers.get("expires"):
+        try:
+            expires_at = email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+            return max(0.0, expires_at - time.time())
+        except (TypeError, ValueError):
+            pass
+    return SCRAPER_FRESHNESS_SECONDS
+
+def extract_texts(html: str, selector: str, limit: int) -> List[str]:
+    """Parses only the elements the selector can match (when it is a simple selector) and returns their texts."""
+    from bs4 import BeautifulSoup, SoupStrainer
+    match = SIMPLE_SELECTOR.match(selector)
+    strainer = SoupStrainer(match.group(1)) if match else None
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=strainer)
+    return [tag.get_text(strip=True) for tag in soup.select(selector, limit=limit)]
+
+class Fetcher:
+    """Fetches all sources concurrently over one pooled async HTTP client, through the HTTP cache."""
+    def __init__(self, cache: HTTPCache = None):
+        self.cache = cache or HTTPCache()
+        self._client = None
+        self.counters = {"fresh_hits": 0, "revalidated": 0, "downloads": 0, "errors": 0}
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=SCRAPER_TIMEOUT_SECONDS,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=SCRAPER_MAX_CONNECTIONS, max_keepalive_connections=SCRAPER_MAX_CONNECTIONS),
+                headers={"User-Agent": "7z-IA-Exclusive/1.0"},
+            )
+        return self._client
+
+    async def fetch(self, url: str) -> str:
+        """Returns the page body, from the cache when fresh or still valid (304)."""
+        cached = await asyncio.to_thread(self.cache.get, url)
+        if cached and cached["fresh_until"] > time.time():
+            self.counters["fresh_hits"] += 1
+            return cached["body"]
+
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = await self.client().get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            self.counters["revalidated"] += 1
+            await asyncio.to_thread(self.cache.refresh, url, response)
+            return cached["body"]
+
+        response.raise_for_status()
+        self.counters["downloads"] += 1
+        await asyncio.to_thread(self.cache.store, url, response, response.text)
+        return response.text
+
+    async def fetch_texts(self, site: Dict[str, Any]) -> List[str]:
+        html = await self.fetch(site["url"])
+        # Parsing is CPU-bound: keep it off the event loop
+        return await asyncio.to_thread(extract_texts, html, site["selector"], site.get("limit", 3))
+
+    async def collect(self, sites: List[Dict[str, Any]]) -> List[str]:
+        """Fetches every site concurrently; a failing source is logged and skipped."""
+        results = await asyncio.gather(*(self.fetch_texts(site) for site in sites), return_exceptions=True)
+        texts = []
+        for site, result in zip(sites, results):
+            if isinstance(result, Exception):
+                self.counters["errors"] += 1
+                print(f"Erro ao acessar {site['url']}: {result}")
+            else:
+                texts.extend(result)
+        return texts
+
+# Process-wide fetcher used by tools.web_scraper
+fetcher = Fetcher()
@@ -0,0 +1,159 @@
+import asyncio
+import contextvars
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from tracing import count_hedge
+
+# --- Hedging Configuration (environment variables) ---
+
+# Routes (tools, "planning") whose Gemini calls are hedged, with optional overrides, e.g.
+# '{"content_generator": {}, "planning": {"percentile": 0.9, "model": "gemini-2.5-flash", "budget": 0.1}}'
+GEMINI_HEDGE_ROUTES = json.loads(os.environ.get("GEMINI_HEDGE_ROUTES", "{}"))
+# A duplicate request is sent once a call is slower than this percentile of the route's recent latencies
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", "0.95"))
+# Max share of a route's calls that may be hedged (bounds the extra cost)
+GEMINI_HEDGE_BUDGET = float(os.environ.get("GEMINI_HEDGE_BUDGET", "0.05"))
+# Latencies needed before a route starts hedging
+GEMINI_HEDGE_MIN_SAMPLES = int(os.environ.get("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+
+# Latest first-response latencies kept per route for the percentile
+HEDGE_LATENCY_WINDOW = 500
+
+_race: contextvars.ContextVar = contextvars.ContextVar("hedge_race", default=None)
+
+class _Race:
+    """The attempts of one hedged call; the first to claim the response wins and the others are cancelled."""
+    def __init__(self):
+        self.attempts: Dict[asyncio.Task, str] = {}  # Attempt -> model
+        self.winner: asyncio.Task = None
+        self.claimed_at: float = None
+
+def claim():
+    """
+    Called by an attempt when its response starts (first streamed chunk, or the complete answer).
+    The first attempt to claim wins the race and the other one is cancelled; a late attempt is
+    cancelled here, before it can deliver anything. Outside a hedged call this does nothing.
+    """
+    race = _race.get()
+    if race is None:
+        return
+    current = asyncio.current_task()
+    if race.winner is None:
+        race.winner = current
+        race.claimed_at = time.monotonic()
+        for attempt in race.attempts:
+            if attempt is not current:
+                attempt.cancel()
+    elif race.winner is not current:
+        raise asyncio.CancelledError()
+
+class HedgePolicy:
+    def __init__(self, percentile: float = GEMINI_HEDGE_PERCENTILE, budget: float = GEMINI_HEDGE_BUDGET,
+                 model: str = None):
+        self.percentile = percentile
+        self.budget = budget
+        self.model = model  # Model of the duplicate request (None: same model as the original)
+
+class RouteHedging:
+    """Latency window and hedge counters of one route."""
+    def __init__(self):
+        self.latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self.counters = {"calls": 0, "hedged": 0, "backup_wins": 0, "primary_wins": 0}
+
+    def delay(self, percentile: float) -> float | None:
+        if len(self.latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+class Hedger:
+    """
+    Request hedging for Gemini calls: if a call of a configured route has not started answering
+    after the route's `percentile` latency, the same request is sent again (optionally to a faster
+    model) and the first response wins; the other request is cancelled.
+
+    At most `budget` of a route's calls are hedged. The duplicate goes through the same rate limiter
+    as every other call, so hedging never exceeds the Gemini quotas. Streamed calls race on their
+    first chunk, so the caller only ever sees the deltas of one request.
+    """
+    def __init__(self, routes: Dict[str, Dict[str, Any]] = None):
+        self.policies = {
+            route: HedgePolicy(**settings) for route, settings in {**GEMINI_HEDGE_ROUTES, **(routes or {})}.items()
+        }
+        self._routes: Dict[str, RouteHedging] = {}
+
+    async def run(self, route: str, model: str, attempt: Callable[[str], Awaitable[Any]]) -> tuple[Any, str]:
+        """
+        Runs `attempt(model)`, hedged if the route is configured. Attempts must call `claim()` when their
+        response starts (or the response counts as started when the attempt returns).
+        Returns (result, model that answered).
+        """
+        policy = self.policies.get(route)
+        if policy is None:
+            return await attempt(model), model
+
+        stats = self._routes.setdefault(route, RouteHedging())
+        stats.counters["calls"] += 1
+        race = _Race()
+        started = time.monotonic()
+        primary = self._start(race, attempt, model)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=stats.delay(policy.percentile))
+            if not done and race.winner is None and stats.counters["hedged"] < policy.budget * stats.counters["calls"]:
+                stats.counters["hedged"] += 1
+                self._start(race, attempt, policy.model or model)
+
+            pending, error = set(race.attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if len(race.attempts) > 1:
+                        outcome = "primary" if task is primary else "backup"
+                        stats.counters[f"{outcome}_wins"] += 1
+                        count_hedge(route, outcome)
+                    return task.result(), race.attempts[task]
+            if len(race.attempts) > 1:
+                count_hedge(route, "failed")
+            raise error
+        finally:
+            for task in race.attempts:
+                task.cancel()
+            if race.winner is not None:
+                # Time to first response of the primary; a lower bound of it when the backup won,
+                # so slow periods still push the percentile up
+                stats.latencies.append(race.claimed_at - started)
+
+    @staticmethod
+    def _start(race: _Race, attempt: Callable[[str], Awaitable[Any]], model: str) -> asyncio.Task:
+        async def run():
+            _race.set(race)
+            result = await attempt(model)
+            claim()
+            return result
+        task = asyncio.create_task(run())
+        race.attempts[task] = model
+        return task
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-route hedge counters, hedge rate and current hedge delay (seconds) for this process."""
+        report = {}
+        for route, stats in self._routes.items():
+            delay = stats.delay(self.policies[route].percentile)
+            report[route] = {
+                **stats.counters,
+                "hedge_rate": round(stats.counters["hedged"] / max(1, stats.counters["calls"]), 4),
+                "hedge_delay": round(delay, 4) if delay is not None else None,
+            }
+        return report
+
+# Process-wide hedger used by llm.generate_content
+hedger = Hedger()
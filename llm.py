@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+import httpx
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, Callable
+
+from cache import LLM_CACHE_ENABLED, cache_key, response_cache
+from hedging import claim, hedger
+from ratelimit import GEMINI_EXPECTED_OUTPUT_TOKENS, GEMINI_MAX_CONCURRENCY, estimate_tokens, scheduler
+from routing import router
+from tracing import count_cache_lookup, count_tokens, span
+
+if TYPE_CHECKING:
+    # google.genai takes ~0.5s to import; it is loaded on the first get_client()/generate_content() call
+    from google import genai
+
+# --- Shared Client Configuration (environment variables) ---
+
+GEMINI_MAX_CONNECTIONS = int(os.environ.get("GEMINI_MAX_CONNECTIONS", str(GEMINI_MAX_CONCURRENCY)))
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_TIMEOUT_SECONDS", "120"))
+# Alternative endpoint for the Gemini REST API, e.g. the local fake of fakes.py (http://127.0.0.1:8090)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+_client: "genai.Client" = None
+_client_lock = threading.Lock()
+
+def get_client() -> "genai.Client":
+    """
+    Returns the process-wide Gemini client.
+
+    The async API (`client.aio`) runs on a single pooled httpx.AsyncClient, so connections
+    are reused across tasks instead of being rebuilt for every AutonomousAgent.
+    A client installed with `set_client` (e.g. fakes.FakeGeminiClient) is returned instead.
+    Safe to call from a thread (the worker pre-warms it off the event loop).
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = _create_client()
+    return _client
+
+def _create_client() -> "genai.Client":
+    from google import genai
+    from google.genai import types
+    # Assumes GEMINI_API_KEY is set in the environment
+    return genai.Client(
+        http_options=types.HttpOptions(
+            base_url=GEMINI_BASE_URL,
+            httpx_async_client=httpx.AsyncClient(
+                timeout=httpx.Timeout(GEMINI_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=GEMINI_MAX_CONNECTIONS,
+                    max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+                ),
+            ),
+        ),
+    )
+
+def set_client(client) -> None:
+    """Replaces the process-wide client used by the agent and the tools (tests, benchmarks)."""
+    global _client
+    _client = client
+
+# --- Single entry point for Gemini text generation ---
+
+async def generate_content(client: "genai.Client", model: str, contents: str, system_instruction: str = None,
+                           response_schema: Any = None, use_cache: bool = True,
+                           on_delta: Callable[[str], None] = None, route: str = None) -> str:
+    """
+    Calls `client.aio.models.generate_content` and returns the response text.
+
+    Responses are cached by (model, system instruction, prompt, response schema) in `cache.response_cache`;
+    pass `use_cache=False` to always call the model (e.g. when a fresh answer is required).
+    Cache misses go through `ratelimit.scheduler`, which retries transient errors and raises
+    the underlying exception once the retries are exhausted.
+
+    If `on_delta` is given, the call uses `generate_content_stream` and `on_delta` receives each
+    text chunk as it arrives (a cached answer is delivered as a single chunk). The returned text
+    is always the complete response.
+
+    Latency, token usage and cost are reported to `routing.router` under `route`
+    (defaults to the model name), and the call is traced as a "gemini.generate" span with the
+    prompt/response tokens, cache hit, retries and rate-limiter wait. Routes listed in
+    GEMINI_HEDGE_ROUTES are hedged by `hedging.hedger`.
+    """
+    config = None
+    if system_instruction is not None or response_schema is not None:
+        from google.genai import types
+        config = types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            response_mime_type="application/json" if response_schema is not None else None,
+            response_schema=response_schema,
+        )
+
+    estimated_tokens = estimate_tokens(contents, system_instruction) + GEMINI_EXPECTED_OUTPUT_TOKENS
+
+    started = time.monotonic()
+    called = streamed = False
+    usage = None
+    served_model = model
+
+    async def stream(attempt_model: str) -> SimpleNamespace:
+        nonlocal streamed
+        chunks, usage = [], None
+        async for chunk in await client.aio.models.generate_content_stream(model=attempt_model, contents=contents,
+                                                                           config=config):
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                # First chunk: with hedging, only the request that answers first gets to stream
+                claim()
+                streamed = True
+                chunks.append(chunk.text)
+                on_delta(chunk.text)
+        return SimpleNamespace(text="".join(chunks) if chunks else None, usage_metadata=usage)
+
+    async def attempt(attempt_model: str) -> SimpleNamespace:
+        return await scheduler.run(
+            attempt_model,
+            estimated_tokens,
+            (lambda: stream(attempt_model)) if on_delta is not None else
+            lambda: client.aio.models.generate_content(model=attempt_model, contents=contents, config=config),
+        )
+
+    async def call() -> str:
+        nonlocal called, usage, served_model
+        called = True
+        # Hedged per route (see hedging.py): a slow call may be answered by a duplicate request
+        response, served_model = await hedger.run(route or model, model, attempt)
+        if response.text is None:
+            # Blocked or empty candidates: raise instead of caching an empty answer
+            raise ValueError(f"Resposta vazia do modelo {served_model}.")
+        usage = response.usage_metadata
+        return response.text
+
+    with span("gemini.generate", model=model, route=route or model, streamed=on_delta is not None):
+        if use_cache and LLM_CACHE_ENABLED:
+            key = cache_key(model, system_instruction, contents, response_schema)
+            # Stored under the model that answered: a hedged backup on another model must not be
+            # served later as the requested model's answer
+            text = await response_cache.get_or_compute(
+                key, call, lambda: cache_key(served_model, system_instruction, contents, response_schema)
+            )
+            count_cache_lookup(hit=not called)
+        else:
+            text = await call()
+        count_tokens(served_model, usage)
+    router.record(route or model, served_model, time.monotonic() - started, usage, cached=not called)
+
+    if on_delta is not None and not streamed:
+        # Served from the cache (or by another in-flight identical call)
+        on_delta(text)
+    return text
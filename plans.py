@@ -0,0 +1,150 @@
+import json
+import os
+import re
+import unicodedata
+from typing import Any, Dict, Iterator, List
+
+from db import aget_cached_plan, arecord_plan_hit, asave_cached_plan
+
+# --- Plan Cache Configuration (environment variables) ---
+
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "1") != "0"
+
+NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+NUMBER_SLOT = "<n>"
+
+def _clean(task_description: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", task_description).lower().split())
+
+def normalize(task_description: str) -> tuple[str, List[str]]:
+    """
+    Splits a task description into its shape and its parameters:
+    ("calcule o <n>º número de fibonacci", ["5"]) for "Calcule o 5º número de Fibonacci".
+    """
+    text = _clean(task_description)
+    return NUMBER.sub(NUMBER_SLOT, text), NUMBER.findall(text)
+
+def _slot(index: int) -> str:
+    return f"⟦{index}⟧"
+
+def _value_pattern(value: str) -> re.Pattern:
+    # The value as a whole number: "5" matches in "5º" but not in "15" or "5.5"
+    return re.compile(rf"(?<![\d.,]){re.escape(value)}(?![\d]|[.,]\d)")
+
+def parametrize(plan: Dict[str, Any], task_description: str) -> Dict[str, Any] | None:
+    """
+    Replaces the task's parameters in the plan's texts by numbered slots. Returns None if a parameter
+    cannot be told apart from other numbers: the same value twice in the task, or a value that appears
+    in the plan more or less often than in the task (e.g. "3" in "Python 3"). Such plans are only
+    reused verbatim, for the same parameters.
+    """
+    text = _clean(task_description)
+    params = NUMBER.findall(text)
+    if len(set(params)) != len(params):
+        return None
+    for value in params:
+        pattern = _value_pattern(value)
+        if sum(len(pattern.findall(string)) for string in _strings(plan)) != len(pattern.findall(text)):
+            return None
+
+    def replace(string: str) -> str:
+        for index, value in enumerate(params):
+            string = _value_pattern(value).sub(_slot(index), string)
+        return string
+
+    return _map_strings(plan, replace)
+
+def instantiate(plan: Dict[str, Any], params: List[str]) -> Dict[str, Any]:
+    """Fills the numbered slots of a parametrized plan with the new task's parameters."""
+    def replace(text: str) -> str:
+        for index, value in enumerate(params):
+            text = text.replace(_slot(index), value)
+        return text
+
+    return _map_strings(plan, replace)
+
+def _strings(value: Any) -> Iterator[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+
+def _map_strings(value: Any, function) -> Any:
+    if isinstance(value, str):
+        return function(value)
+    if isinstance(value, list):
+        return [_map_strings(item, function) for item in value]
+    if isinstance(value, dict):
+        return {key: _map_strings(item, function) for key, item in value.items()}
+    return value
+
+class PlanStore:
+    """
+    Cache of validated plans keyed by task shape (see `normalize`), persisted in `plan_cache`.
+
+    A new task reuses a stored plan only when its template matches exactly and it has as many
+    parameters; the new parameters are substituted into the plan's texts (see `parametrize`).
+    """
+    def __init__(self, enabled: bool = PLAN_CACHE_ENABLED):
+        self.enabled = enabled
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self.counters = {"hits": 0, "misses": 0, "stored": 0}
+
+    def _add(self, entry: Dict[str, Any]):
+        self._entries[entry["template"]] = {**entry, "plan": json.loads(entry["plan"]), "params": json.loads(entry["params"])}
+
+    def _reuse(self, entry: Dict[str, Any], params: List[str]) -> Dict[str, Any] | None:
+        """The entry's plan for the new parameters, or None if it cannot be adapted to them."""
+        if len(params) != len(entry["params"]):
+            return None
+        if entry["parametrized"]:
+            return instantiate(entry["plan"], params)
+        return entry["plan"] if params == entry["params"] else None
+
+    async def lookup(self, task_description: str) -> Dict[str, Any] | None:
+        """Returns a plan (as a dict, to be validated by the caller) for the task, or None on a miss."""
+        if not self.enabled:
+            return None
+        template, params = normalize(task_description)
+
+        entry = self._entries.get(template)
+        plan = self._reuse(entry, params) if entry is not None else None
+        if plan is None:
+            # Stored (or replaced) by another process?
+            row = await aget_cached_plan(template)
+            if row is not None:
+                self._add(row)
+                plan = self._reuse(self._entries[template], params)
+        if plan is None:
+            self.counters["misses"] += 1
+            return None
+
+        self.counters["hits"] += 1
+        await arecord_plan_hit(template)
+        return plan
+
+    async def store(self, task_description: str, plan: Dict[str, Any]):
+        """Stores a validated plan generated by the model for the task's shape."""
+        if not self.enabled:
+            return
+        template, params = normalize(task_description)
+        parametrized = parametrize(plan, task_description)
+        stored = parametrized if parametrized is not None else plan
+        entry = {"template": template, "plan": json.dumps(stored, ensure_ascii=False),
+                 "params": json.dumps(params), "parametrized": int(parametrized is not None)}
+        await asave_cached_plan(template, entry["plan"], entry["params"], parametrized is not None)
+        self._add(entry)
+        self.counters["stored"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for this process."""
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {**self.counters, "entries": len(self._entries),
+                "hit_rate": self.counters["hits"] / lookups if lookups else 0.0}
+
+# Process-wide plan cache used by AutonomousAgent.run
+plan_store = PlanStore()
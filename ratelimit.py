@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import time
+import httpx
+from typing import Any, Awaitable, Callable, Dict
+
+from tracing import add_queue_wait, count_retry
+
+# --- Scheduler Configuration (environment variables) ---
+
+GEMINI_RPM = float(os.environ.get("GEMINI_RPM", "1000"))  # Requests per minute, per model
+GEMINI_TPM = float(os.environ.get("GEMINI_TPM", "1000000"))  # Tokens per minute, per model
+# Per-model overrides, e.g. '{"gemini-2.5-pro": {"rpm": 150, "tpm": 2000000}}'
+GEMINI_RATE_LIMITS = json.loads(os.environ.get("GEMINI_RATE_LIMITS", "{}"))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "64"))  # Upper bound of the adaptive limit
+GEMINI_INITIAL_CONCURRENCY = int(os.environ.get("GEMINI_INITIAL_CONCURRENCY", "8"))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.environ.get("GEMINI_BACKOFF_BASE_SECONDS", "1.0"))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.environ.get("GEMINI_BACKOFF_MAX_SECONDS", "30.0"))
+# Output tokens reserved per call before the real usage is known
+GEMINI_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("GEMINI_EXPECTED_OUTPUT_TOKENS", "1024"))
+
+# A call this many times slower than the latency baseline counts as a congestion signal
+LATENCY_CONGESTION_FACTOR = 3.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Priority of the task making the calls (set by the worker); waiting calls get concurrency slots in priority order
+_task_priority: contextvars.ContextVar = contextvars.ContextVar("gemini_task_priority", default=0)
+
+def set_priority(priority: int):
+    """Sets the priority of the Gemini calls made by the current asyncio task (and the tasks it creates)."""
+    _task_priority.set(priority)
+
+def estimate_tokens(*texts: str) -> int:
+    """Rough token estimate (~4 characters per token) used before the real usage is known."""
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+def _api_error_code(error: BaseException) -> int | None:
+    """
+    HTTP status of a google.genai APIError, else None. The SDK is not imported for the check:
+    an APIError can only exist once llm.get_client() has loaded it.
+    """
+    errors = sys.modules.get("google.genai.errors")
+    if errors is not None and isinstance(error, errors.APIError):
+        return error.code
+    return None
+
+def is_retryable(error: BaseException) -> bool:
+    """True for rate limiting (429), server-side and transport errors."""
+    code = _api_error_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def is_rate_limited(error: BaseException) -> bool:
+    return _api_error_code(error) == 429
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute` units per minute."""
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float):
+        """Waits until `amount` units are available and takes them (FIFO between waiters)."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, delta: float):
+        """Corrects a previous reservation (negative delta returns units; the bucket may go into debt)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limit: grows by ~1 per round of successful calls and halves on 429s.
+    A call much slower than the latency baseline shrinks the limit slightly.
+    When the limit is reached, freed slots go to the highest-priority waiting call first.
+    """
+    def __init__(self, initial: int, maximum: int, minimum: int = 1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.latency_baseline = None
+        self._condition = None
+        self._waiting: Dict[int, int] = {}  # Waiting calls per priority
+
+    async def acquire(self, priority: int = 0):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                await self._condition.wait_for(
+                    lambda: self.in_flight < int(self.limit) and priority >= max(self._waiting)
+                )
+            except BaseException:
+                # A cancelled high-priority waiter must not keep blocking the lower ones
+                self._condition.notify_all()
+                raise
+            finally:
+                self._waiting[priority] -= 1
+                if not self._waiting[priority]:
+                    del self._waiting[priority]
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency: float):
+        if self.latency_baseline is None:
+            self.latency_baseline = latency
+        congested = latency > LATENCY_CONGESTION_FACTOR * self.latency_baseline
+        # Slow EWMA so a burst of slow calls does not immediately become the new normal
+        self.latency_baseline = 0.9 * self.latency_baseline + 0.1 * latency
+        if congested:
+            self.limit = max(self.minimum, self.limit * 0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_rate_limited(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+class ModelLimits:
+    """Request bucket, token bucket and adaptive concurrency for one model."""
+    def __init__(self, model: str):
+        limits = GEMINI_RATE_LIMITS.get(model, {})
+        self.requests = TokenBucket(limits.get("rpm", GEMINI_RPM))
+        self.tokens = TokenBucket(limits.get("tpm", GEMINI_TPM))
+        self.concurrency = AdaptiveConcurrencyLimiter(GEMINI_INITIAL_CONCURRENCY, GEMINI_MAX_CONCURRENCY)
+        self.counters = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+class GeminiScheduler:
+    """
+    Central admission control for Gemini calls.
+
+    Every call waits for its model's request and token budgets and for a concurrency slot,
+    then runs with jittered exponential backoff on retryable errors. Non-retryable errors,
+    and retryable ones after GEMINI_MAX_RETRIES attempts, are raised to the caller.
+    """
+    def __init__(self):
+        self._models: Dict[str, ModelLimits] = {}
+
+    def limits_for(self, model: str) -> ModelLimits:
+        if model not in self._models:
+            self._models[model] = ModelLimits(model)
+        return self._models[model]
+
+    async def run(self, model: str, estimated_tokens: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        limits = self.limits_for(model)
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            await limits.requests.acquire(1)
+            await limits.tokens.acquire(estimated_tokens)
+            await limits.concurrency.acquire(_task_priority.get())
+            started = time.monotonic()
+            add_queue_wait(started - queued)
+            try:
+                limits.counters["calls"] += 1
+                response = await call()
+            except Exception as e:
+                if is_rate_limited(e):
+                    limits.counters["rate_limited"] += 1
+                    limits.concurrency.on_rate_limited()
+                if not is_retryable(e) or attempt >= GEMINI_MAX_RETRIES:
+                    limits.counters["failures"] += 1
+                    raise
+            else:
+                limits.concurrency.on_success(time.monotonic() - started)
+                usage = getattr(response, "usage_metadata", None)
+                if usage is not None and usage.total_token_count:
+                    limits.tokens.adjust(usage.total_token_count - estimated_tokens)
+                return response
+            finally:
+                await limits.concurrency.release()
+
+            # Full jitter: sleep a random time up to the exponential backoff ceiling
+            backoff = min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * (2 ** attempt))
+            attempt += 1
+            limits.counters["retries"] += 1
+            count_retry(model)
+            print(f"Gemini ({model}) indisponível/limitado; nova tentativa {attempt}/{GEMINI_MAX_RETRIES} em até {backoff:.1f}s")
+            await asyncio.sleep(random.uniform(0, backoff))
+
+    def stats(self) -> Dict[str, Any]:
+        """Current limits and counters per model for this process."""
+        return {
+            model: {
+                **limits.counters,
+                "concurrency_limit": round(limits.concurrency.limit, 2),
+                "in_flight": limits.concurrency.in_flight,
+            }
+            for model, limits in self._models.items()
+        }
+
+# Process-wide scheduler shared by every Gemini call (see llm.py)
+scheduler = GeminiScheduler()
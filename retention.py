@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import signal
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+from db import (
+    aexpired_tasks, aget_tasks, aincremental_vacuum, apurge_delivered_callbacks, apurge_orphan_blobs, apurge_tasks,
+    database_size, enable_incremental_vacuum, init_db,
+)
+
+# --- Retention Configuration (environment variables) ---
+
+TASK_RETENTION_DAYS = float(os.environ.get("TASK_RETENTION_DAYS", "30"))  # Finished tasks older than this are purged
+# Delivered callbacks keep a copy of the result in the outbox; they are dropped sooner
+CALLBACK_OUTBOX_RETENTION_HOURS = float(os.environ.get("CALLBACK_OUTBOX_RETENTION_HOURS", "24"))
+# If set, purged tasks (with their results) are appended to gzipped JSON lines files in this directory first
+TASK_ARCHIVE_DIR = os.environ.get("TASK_ARCHIVE_DIR", "")
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "500"))  # Rows deleted per write transaction
+# Free pages returned to the file system per write (PRAGMA incremental_vacuum), keeping each transaction short
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", "2000"))
+
+def _db_timestamp(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def _archive(directory: str, tasks: List[Dict[str, Any]]):
+    """Appends the tasks to today's archive file (one gzip member per batch)."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"tasks-{datetime.now(timezone.utc):%Y-%m-%d}.jsonl.gz")
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for task in tasks:
+            f.write(json.dumps(task, ensure_ascii=False) + "\n")
+
+class RetentionJob:
+    """
+    Keeps tasks.db bounded: deletes finished tasks older than `retention_days` (archiving them first
+    if `archive_dir` is set), delivered callbacks and unreferenced result blobs, then returns the
+    freed pages to the file system with incremental vacuums.
+
+    Everything runs in small batches through the DB writer, so workers and the API keep writing
+    between them. Run a single instance (`python3 retention.py`), e.g. next to the API.
+    """
+    def __init__(self, retention_days: float = TASK_RETENTION_DAYS, archive_dir: str = TASK_ARCHIVE_DIR,
+                 batch_size: int = RETENTION_BATCH_SIZE, vacuum_pages: int = RETENTION_VACUUM_PAGES):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stopping = None
+
+    def stop(self):
+        if self._stopping is None:
+            self._stopping = asyncio.Event()
+        self._stopping.set()
+
+    async def run_once(self) -> Dict[str, int]:
+        """One full pass; returns what was removed."""
+        counters = {"tasks": 0, "archived": 0, "callbacks": 0, "blobs": 0, "pages_freed": 0}
+        now = datetime.now(timezone.utc)
+
+        if self.retention_days > 0:
+            cutoff = _db_timestamp(now - timedelta(days=self.retention_days))
+            while task_ids := await aexpired_tasks(cutoff, self.batch_size):
+                if self.archive_dir:
+                    tasks = await aget_tasks(task_ids, include_result=True)
+                    await asyncio.to_thread(_archive, self.archive_dir, list(tasks.values()))
+                    counters["archived"] += len(tasks)
+                counters["tasks"] += await apurge_tasks(task_ids)
+                if len(task_ids) < self.batch_size or self._stopped():
+                    break
+
+        delivered_before = _db_timestamp(now - timedelta(hours=CALLBACK_OUTBOX_RETENTION_HOURS))
+        counters["callbacks"] += await self._drain(apurge_delivered_callbacks, delivered_before, self.batch_size)
+        counters["blobs"] += await self._drain(apurge_orphan_blobs, self.batch_size)
+        # Return the freed pages to the file system, `vacuum_pages` per write transaction
+        while freed := await aincremental_vacuum(self.vacuum_pages):
+            counters["pages_freed"] += freed
+            if self._stopped():
+                break
+        return counters
+
+    async def _drain(self, purge, *args) -> int:
+        """Repeats a batched purge until it deletes nothing."""
+        total = 0
+        while deleted := await purge(*args):
+            total += deleted
+            if self._stopped():
+                break
+        return total
+
+    def _stopped(self) -> bool:
+        return self._stopping is not None and self._stopping.is_set()
+
+    async def run(self, interval: float = RETENTION_INTERVAL_SECONDS):
+        """Runs a pass every `interval` seconds until `stop()`."""
+        if self._stopping is None:
+            self._stopping = asyncio.Event()
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                counters = await self.run_once()
+                print(f"Retenção: {counters} em {time.monotonic() - started:.1f}s; banco: {database_size()}")
+            except Exception as e:
+                print(f"Erro na limpeza de retenção: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+# Process-wide job, run by `python3 retention.py`
+retention_job = RetentionJob()
+
+async def _serve(once: bool):
+    if once:
+        print(f"Retenção: {await retention_job.run_once()}; banco: {database_size()}")
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, retention_job.stop)
+    await retention_job.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Purges and compacts old tasks in tasks.db.")
+    parser.add_argument("--once", action="store_true", help="Run a single pass and exit (e.g. from cron).")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Enable incremental auto_vacuum on an existing database (full VACUUM; stop API/workers).")
+    args = parser.parse_args()
+
+    init_db()
+    if args.vacuum:
+        enable_incremental_vacuum()
+        print(f"auto_vacuum incremental ativado; banco: {database_size()}")
+    else:
+        asyncio.run(_serve(args.once))
@@ -0,0 +1,118 @@
+import json
+import os
+from collections import deque
+from typing import Any, Dict
+
+from tracing import observe_route
+
+# --- Model Routing Configuration (environment variables) ---
+
+GEMINI_MODEL_LITE = os.environ.get("GEMINI_MODEL_LITE", "gemini-2.5-flash-lite")  # Summaries, confirmations
+GEMINI_MODEL_STANDARD = os.environ.get("GEMINI_MODEL_STANDARD", "gemini-2.5-flash")
+GEMINI_MODEL_STRONG = os.environ.get("GEMINI_MODEL_STRONG", "gemini-2.5-pro")  # Planning, code generation
+# Per-route overrides, e.g. '{"planning": "gemini-2.5-flash", "none": "gemini-2.5-flash-lite"}'
+GEMINI_ROUTES = json.loads(os.environ.get("GEMINI_ROUTES", "{}"))
+# USD per 1M tokens, e.g. '{"gemini-2.5-pro": {"input": 1.25, "output": 10.0}}'
+GEMINI_PRICING = json.loads(os.environ.get("GEMINI_PRICING", "{}"))
+# Set to 1 to have 'none' steps confirmed by the model (lite route) instead of deterministically
+AGENT_LLM_CONFIRMATIONS = os.environ.get("AGENT_LLM_CONFIRMATIONS", "0") == "1"
+
+# Model of each route: the planner and the code generator get the strong model,
+# summaries and confirmations the lite one
+DEFAULT_ROUTES = {
+    "planning": GEMINI_MODEL_STRONG,
+    "code_generator": GEMINI_MODEL_STRONG,
+    "content_generator": GEMINI_MODEL_STANDARD,
+    "data_analyzer": GEMINI_MODEL_STANDARD,
+    "web_scraper": GEMINI_MODEL_LITE,
+    "none": GEMINI_MODEL_LITE,
+}
+
+# List prices (USD per 1M tokens) used for the cost report
+DEFAULT_PRICING = {
+    "gemini-2.5-flash-lite": {"input": 0.10, "output": 0.40},
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50},
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.00},
+}
+
+# Model name reported for routes answered without calling the LLM
+DETERMINISTIC = "deterministic"
+# Latest latencies kept per route for the percentiles
+LATENCY_WINDOW = 500
+
+class RouteStats:
+    """Calls, latency and token/cost totals of one route."""
+    def __init__(self):
+        self.counters = {"calls": 0, "llm_calls": 0, "cached": 0, "deterministic": 0}
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost_usd = 0.0
+        self.models: Dict[str, int] = {}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+class ModelRouter:
+    """
+    Picks the Gemini model of each call from its route (the planner or the tool that makes the call)
+    and keeps per-route latency and cost statistics for this process.
+    """
+    def __init__(self, routes: Dict[str, str] = None, pricing: Dict[str, Dict[str, float]] = None):
+        self.routes = {**DEFAULT_ROUTES, **GEMINI_ROUTES, **(routes or {})}
+        self.pricing = {**DEFAULT_PRICING, **GEMINI_PRICING, **(pricing or {})}
+        self._stats: Dict[str, RouteStats] = {}
+
+    def model_for(self, route: str) -> str:
+        return self.routes.get(route, GEMINI_MODEL_STANDARD)
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        price = self.pricing.get(model, {})
+        return (input_tokens * price.get("input", 0.0) + output_tokens * price.get("output", 0.0)) / 1_000_000
+
+    def record(self, route: str, model: str, latency: float, usage: Any = None, cached: bool = False):
+        """
+        Records one answered request; `usage` is the response's usage_metadata (None for cache hits).
+        The figures are also exported to Prometheus (gemini_route_* metrics, see tracing.observe_route).
+        """
+        stats = self._stats.setdefault(route, RouteStats())
+        stats.counters["calls"] += 1
+        stats.models[model] = stats.models.get(model, 0) + 1
+        stats.latencies.append(latency)
+        if model == DETERMINISTIC:
+            stats.counters["deterministic"] += 1
+            observe_route(route, model, "deterministic", latency)
+            return
+        if cached:
+            stats.counters["cached"] += 1
+            observe_route(route, model, "cached", latency)
+            return
+
+        stats.counters["llm_calls"] += 1
+        input_tokens = output_tokens = 0
+        cost = 0.0
+        if usage is not None:
+            input_tokens = usage.prompt_token_count or 0
+            # Thinking tokens are billed as output
+            output_tokens = max(0, (usage.total_token_count or 0) - input_tokens)
+            cost = self.cost(model, input_tokens, output_tokens)
+            stats.input_tokens += input_tokens
+            stats.output_tokens += output_tokens
+            stats.cost_usd += cost
+        observe_route(route, model, "llm", latency, input_tokens, output_tokens, cost)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-route counters, latency percentiles (seconds), tokens and estimated cost."""
+        report = {}
+        for route, stats in self._stats.items():
+            latencies = sorted(stats.latencies)
+            report[route] = {
+                **stats.counters,
+                "models": dict(stats.models),
+                "latency_p50": round(latencies[len(latencies) // 2], 4) if latencies else None,
+                "latency_p95": round(latencies[int(len(latencies) * 0.95)], 4) if latencies else None,
+                "input_tokens": stats.input_tokens,
+                "output_tokens": stats.output_tokens,
+                "cost_usd": round(stats.cost_usd, 6),
+            }
+        return report
+
+# Process-wide router used by the agent and the tools
+router = ModelRouter()
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Any, Dict
+
+# --- Sandbox Configuration (environment variables) ---
+
+SANDBOX_POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", "2"))  # Pre-started worker processes
+SANDBOX_MAX_RUNS = int(os.environ.get("SANDBOX_MAX_RUNS", "50"))  # Runs before a worker is recycled
+SANDBOX_TIMEOUT_SECONDS = float(os.environ.get("SANDBOX_TIMEOUT_SECONDS", "10"))  # Wall clock per run
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", "10"))
+SANDBOX_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", "512"))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+# Extra time the pool waits for a worker's answer beyond the run's own timeout
+RESPONSE_GRACE_SECONDS = 5.0
+
+class SandboxWorker:
+    """A pre-started `sandbox_worker.py` process with its own scratch directory."""
+    def __init__(self, process: asyncio.subprocess.Process, scratch: str):
+        self.process = process
+        self.scratch = scratch
+        self.runs = 0
+
+    @classmethod
+    async def start(cls) -> "SandboxWorker":
+        scratch = tempfile.mkdtemp(prefix="sandbox-")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-I", WORKER_SCRIPT, scratch,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=scratch,
+        )
+        if not await process.stdout.readline():
+            raise RuntimeError("O processo do sandbox não iniciou.")
+        return cls(process, scratch)
+
+    async def run(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self.runs += 1
+        self.process.stdin.write(json.dumps(request).encode() + b"\n")
+        await self.process.stdin.drain()
+        line = await asyncio.wait_for(self.process.stdout.readline(), request["timeout"] + RESPONSE_GRACE_SECONDS)
+        if not line:
+            raise RuntimeError("O processo do sandbox terminou inesperadamente.")
+        return json.loads(line)
+
+    async def stop(self):
+        if self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+        shutil.rmtree(self.scratch + "-out", ignore_errors=True)
+
+class SandboxPool:
+    """
+    Pool of warm, isolated Python workers for executing generated code.
+
+    Each run is forked from an already-started interpreter (no interpreter start-up per run)
+    inside the worker's own scratch directory, under CPU, memory and wall-clock limits.
+    Workers are recycled after `max_runs` runs or after any limit breach.
+    """
+    def __init__(self, size: int = SANDBOX_POOL_SIZE, max_runs: int = SANDBOX_MAX_RUNS,
+                 timeout: float = SANDBOX_TIMEOUT_SECONDS, cpu_seconds: int = SANDBOX_CPU_SECONDS,
+                 memory_mb: int = SANDBOX_MEMORY_MB):
+        self.size = size
+        self.max_runs = max_runs
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self._idle: asyncio.Queue = None
+        self._starting = None
+
+    async def start(self):
+        """Starts the workers (called automatically on first use)."""
+        if self._idle is None:
+            if self._starting is None:
+                self._starting = asyncio.ensure_future(self._start_workers())
+            await asyncio.shield(self._starting)
+
+    async def _start_workers(self):
+        idle = asyncio.Queue()
+        for worker in await asyncio.gather(*(SandboxWorker.start() for _ in range(self.size))):
+            idle.put_nowait(worker)
+        self._idle = idle
+
+    async def execute(self, code: str) -> Dict[str, Any]:
+        """
+        Runs `code` in a sandbox worker. Returns stdout, stderr, exit_code, timed_out,
+        limit_exceeded and resource usage (wall_time, cpu_time, max_rss_kb).
+        """
+        await self.start()
+        worker = await self._idle.get()
+        request = {
+            "code": code,
+            "timeout": self.timeout,
+            "cpu_seconds": self.cpu_seconds,
+            "memory_mb": self.memory_mb,
+        }
+        recycle = True
+        try:
+            result = await worker.run(request)
+            if "error" in result:
+                raise RuntimeError(result["error"])
+            recycle = result["limit_exceeded"] or worker.runs >= self.max_runs
+            return result
+        finally:
+            if recycle:
+                # Replace the worker in the background; the caller does not wait for the new start-up
+                asyncio.ensure_future(self._replace(worker))
+            else:
+                self._idle.put_nowait(worker)
+
+    async def _replace(self, worker: SandboxWorker):
+        await worker.stop()
+        try:
+            replacement = await SandboxWorker.start()
+        except Exception as e:
+            print(f"Erro ao reiniciar worker do sandbox: {e}")
+            await asyncio.sleep(1)
+            asyncio.ensure_future(self._replace(worker))
+            return
+        self._idle.put_nowait(replacement)
+
+    async def close(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            await self._idle.get_nowait().stop()
+
+# Process-wide pool used by tools.execute_python_code
+sandbox_pool = SandboxPool()
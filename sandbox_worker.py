@@ -0,0 +1,155 @@
+"""
+Pre-started sandbox worker for execute_python_code (started and driven by sandbox.SandboxPool).
+
+Protocol: one JSON request per line on stdin, one JSON response per line on stdout.
+Each request is executed in a child forked from this already-initialised interpreter,
+inside the worker's scratch directory and under CPU/memory/file-size rlimits.
+Keep this module free of project imports: it must start fast and stay small.
+"""
+import json
+import os
+import resource
+import select
+import shutil
+import signal
+import sys
+import time
+import traceback
+
+MAX_OUTPUT_BYTES = 64 * 1024
+MAX_FILE_BYTES = 16 * 1024 * 1024
+# Exit code used by the child when the script runs out of memory (RLIMIT_AS)
+MEMORY_EXIT_CODE = 75
+# Modules imported once here, so forked children get them for free
+PREIMPORT = ("math", "json", "re", "random", "datetime", "collections", "itertools", "functools", "statistics")
+
+def _clean(directory):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def _print_script_traceback(error):
+    # Skip this module's frame so the traceback starts at the script
+    traceback.print_exception(type(error), error, error.__traceback__.tb_next)
+
+def _child(request, scratch, stdout_path, stderr_path):
+    """Runs in the forked child: applies limits, redirects output and executes the code."""
+    os.setsid()
+    os.chdir(scratch)
+    cpu = max(1, int(request["cpu_seconds"]))
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    memory = int(request["memory_mb"]) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_BYTES, MAX_FILE_BYTES))
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(os.open(stdout_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 1)
+    os.dup2(os.open(stderr_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 2)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", closefd=False)
+
+    code = 0
+    try:
+        exec(compile(request["code"], "script.py", "exec"), {"__name__": "__main__"})
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if not isinstance(e.code, int) and e.code is not None:
+            print(e.code, file=sys.stderr)
+    except MemoryError as e:
+        _print_script_traceback(e)
+        code = MEMORY_EXIT_CODE
+    except BaseException as e:
+        _print_script_traceback(e)
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+def _wait(pid, timeout):
+    """Waits for the child up to `timeout` seconds; returns (status, rusage, timed_out)."""
+    deadline = time.monotonic() + timeout
+    pidfd = os.pidfd_open(pid) if hasattr(os, "pidfd_open") else None
+    try:
+        while True:
+            waited, status, usage = os.wait4(pid, os.WNOHANG)
+            if waited == pid:
+                return status, usage, False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                os.killpg(pid, signal.SIGKILL)
+                _, status, usage = os.wait4(pid, 0)
+                return status, usage, True
+            if pidfd is not None:
+                select.select([pidfd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.002))
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read(MAX_OUTPUT_BYTES + 1)
+    except FileNotFoundError:
+        return ""
+    text = data[:MAX_OUTPUT_BYTES].decode(errors="replace")
+    return text + "\n[saída truncada]" if len(data) > MAX_OUTPUT_BYTES else text
+
+def _execute(request, scratch, output_dir):
+    _clean(scratch)
+    stdout_path = os.path.join(output_dir, "stdout")
+    stderr_path = os.path.join(output_dir, "stderr")
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _child(request, scratch, stdout_path, stderr_path)
+        finally:
+            os._exit(1)
+
+    status, usage, timed_out = _wait(pid, float(request["timeout"]))
+    wall_time = time.monotonic() - started
+    exit_code = os.waitstatus_to_exitcode(status)
+    cpu_exceeded = exit_code in (-signal.SIGXCPU, -signal.SIGKILL) and not timed_out
+    return {
+        "stdout": _read(stdout_path),
+        "stderr": _read(stderr_path),
+        "exit_code": exit_code,
+        "timed_out": timed_out,
+        "limit_exceeded": timed_out or cpu_exceeded or exit_code == MEMORY_EXIT_CODE,
+        "wall_time": round(wall_time, 4),
+        "cpu_time": round(usage.ru_utime + usage.ru_stime, 4),
+        "max_rss_kb": usage.ru_maxrss,
+    }
+
+def main():
+    scratch = sys.argv[1]
+    # Output files live outside the scratch dir, so scripts cannot clobber them by cleaning their CWD
+    output_dir = os.path.join(scratch, os.pardir, os.path.basename(scratch) + "-out")
+    os.makedirs(output_dir, exist_ok=True)
+    for name in PREIMPORT:
+        __import__(name)
+
+    channel_in = sys.stdin.buffer
+    channel_out = sys.stdout.buffer
+    # Tells the pool the worker is warm and ready for requests
+    channel_out.write(b'{"ready": true}\n')
+    channel_out.flush()
+    for line in channel_in:
+        request = json.loads(line)
+        try:
+            response = _execute(request, scratch, output_dir)
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+        channel_out.write(json.dumps(response).encode() + b"\n")
+        channel_out.flush()
+
+if __name__ == "__main__":
+    main()
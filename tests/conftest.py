@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+import pytest
+
+# Every SQLite file the modules open lives in a throwaway directory; set before db, cache and
+# fetcher are imported, since they read their paths at import time
+_DATA_DIR = tempfile.mkdtemp(prefix="agent-tests-")
+os.environ["DATABASE_FILE"] = os.path.join(_DATA_DIR, "tasks.db")
+os.environ["LLM_CACHE_FILE"] = os.path.join(_DATA_DIR, "llm_cache.db")
+os.environ["HTTP_CACHE_FILE"] = os.path.join(_DATA_DIR, "http_cache.db")
+os.environ["TRACE_PERSIST"] = "0"
+
+import db  # noqa: E402
+
+TABLES = ("tasks", "task_steps", "callback_outbox", "callback_dead_letters", "task_callbacks", "plan_cache",
+          "result_blobs", "fair_queue", "task_spans")
+
+@pytest.fixture(scope="session")
+def schema():
+    db.init_db()
+
+@pytest.fixture
+def database(schema):
+    """The db module over an empty database (all tables wiped before the test)."""
+    def wipe(cursor):
+        for table in TABLES:
+            cursor.execute(f"DELETE FROM {table}")
+    db._write(wipe)
+    return db
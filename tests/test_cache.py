@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from cache import ResponseCache
+from fakes import FakeGemini, FakeGeminiClient
+
+@pytest.fixture
+def response_cache(tmp_path):
+    return ResponseCache(db_file=str(tmp_path / "llm_cache.db"))
+
+def generate(client: FakeGeminiClient, prompt: str):
+    async def compute() -> str:
+        return (await client.aio.models.generate_content(model="gemini", contents=prompt)).text
+    return compute
+
+def test_concurrent_identical_requests_share_one_call(response_cache):
+    client = FakeGeminiClient(FakeGemini(latency_median=0.05, latency_sigma=0.01, seed=1))
+
+    async def scenario():
+        return await asyncio.gather(*(response_cache.get_or_compute("chave", generate(client, "prompt"))
+                                      for _ in range(10)))
+
+    answers = asyncio.run(scenario())
+    assert len(set(answers)) == 1
+    assert client.gemini.counters["requests"] == 1
+    assert response_cache.counters["shared_inflight"] == 9
+
+def test_answer_is_served_from_disk_by_another_process(response_cache):
+    client = FakeGeminiClient(FakeGemini(latency_median=0, seed=1))
+    answer = asyncio.run(response_cache.get_or_compute("chave", generate(client, "prompt")))
+
+    other = ResponseCache(db_file=response_cache.db_file)
+    assert asyncio.run(other.get_or_compute("chave", generate(client, "prompt"))) == answer
+    assert client.gemini.counters["requests"] == 1
+    assert other.counters["disk_hits"] == 1
+
+def test_failure_is_shared_but_not_cached(response_cache):
+    client = FakeGeminiClient(FakeGemini(latency_median=0.05, latency_sigma=0.01, error_rate=1.0, seed=1))
+
+    async def scenario():
+        return await asyncio.gather(*(response_cache.get_or_compute("chave", generate(client, "prompt"))
+                                      for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, Exception) for result in asyncio.run(scenario()))
+    assert client.gemini.counters["requests"] == 1
+    assert response_cache.get("chave") is None
+
+def test_value_is_stored_under_the_key_of_the_model_that_answered(response_cache):
+    client = FakeGeminiClient(FakeGemini(latency_median=0, seed=1))
+
+    asyncio.run(response_cache.get_or_compute("lento", generate(client, "prompt"), store_key=lambda: "rapido"))
+    assert response_cache.get("lento") is None
+    assert response_cache.get("rapido") is not None
+
+def test_locked_disk_tier_does_not_fail_the_call(response_cache, monkeypatch):
+    monkeypatch.setattr("cache.LLM_CACHE_BUSY_TIMEOUT_MS", 50)
+    client = FakeGeminiClient(FakeGemini(latency_median=0, seed=1))
+    asyncio.run(response_cache.get_or_compute("outra", generate(client, "prompt")))  # Creates the table
+    blocker = sqlite3.connect(response_cache.db_file)
+    blocker.execute("BEGIN EXCLUSIVE")
+    try:
+        locked = ResponseCache(db_file=response_cache.db_file)
+        answer = asyncio.run(locked.get_or_compute("chave", generate(client, "prompt")))
+        assert answer
+        assert locked.get("chave") == answer  # Still served from memory
+    finally:
+        blocker.rollback()
+        blocker.close()
@@ -0,0 +1,66 @@
+import asyncio
+
+def create(database, task_id, description="Resuma as notícias", callback_url=None, idempotency_key=None):
+    return asyncio.run(database.acreate_or_attach_task(task_id, description, callback_url,
+                                                        idempotency_key=idempotency_key))
+
+def test_resubmission_attaches_to_the_existing_task(database):
+    task, created = create(database, "t1", callback_url="http://cliente/a")
+    assert created and task["id"] == "t1"
+
+    task, created = create(database, "t2", callback_url="http://cliente/a")
+    assert not created
+    assert task["id"] == "t1"
+    assert database.get_task("t2") is None
+
+def test_different_description_or_callback_creates_a_task(database):
+    create(database, "t1", callback_url="http://cliente/a")
+
+    assert create(database, "t2", description="Outra tarefa", callback_url="http://cliente/a")[1]
+    # The callback is part of the request identity without an Idempotency-Key
+    assert create(database, "t3", callback_url="http://cliente/b")[1]
+
+def test_failed_task_is_not_reused(database):
+    create(database, "t1")
+    database.update_task_status("t1", "FAILED", "erro")
+
+    task, created = create(database, "t2")
+    assert created and task["id"] == "t2"
+
+def test_idempotency_key_attaches_and_adds_the_new_callback(database):
+    create(database, "t1", callback_url="http://cliente/a", idempotency_key="chave")
+
+    task, created = create(database, "t2", callback_url="http://cliente/b", idempotency_key="chave")
+    assert not created and task["id"] == "t1"
+
+    # Both callback URLs receive the result when the task finishes
+    database.update_task_status("t1", "COMPLETED", "pronto")
+    outbox = database.get_db_connection().execute("SELECT callback_url FROM callback_outbox").fetchall()
+    assert sorted(row["callback_url"] for row in outbox) == ["http://cliente/a", "http://cliente/b"]
+
+def test_duplicate_of_a_finished_task_gets_its_result_right_away(database):
+    create(database, "t1", idempotency_key="chave")
+    database.update_task_status("t1", "COMPLETED", "pronto")
+
+    task, created = create(database, "t2", callback_url="http://cliente/b", idempotency_key="chave")
+    assert not created and task["result"] == "pronto"
+    outbox = database.get_db_connection().execute("SELECT task_id, callback_url FROM callback_outbox").fetchall()
+    assert [tuple(row) for row in outbox] == [("t1", "http://cliente/b")]
+
+def test_reused_idempotency_key_with_another_description_is_returned_as_a_conflict(database):
+    create(database, "t1", idempotency_key="chave")
+
+    task, created = create(database, "t2", description="Outra tarefa", idempotency_key="chave")
+    # The API answers 409 when the returned task's description differs from the request's
+    assert not created and task["task_description"] == "Resuma as notícias"
+
+def test_concurrent_duplicates_create_a_single_task(database):
+    async def submit_all():
+        return await asyncio.gather(*(
+            database.acreate_or_attach_task(f"t{index}", "Resuma as notícias", "http://cliente/a")
+            for index in range(20)
+        ))
+
+    results = asyncio.run(submit_all())
+    assert sum(created for _, created in results) == 1
+    assert len({task["id"] for task, _ in results}) == 1
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeGemini, FakeGeminiClient
+from hedging import GEMINI_HEDGE_MIN_SAMPLES, Hedger
+
+class Models:
+    """Attempts answered by the fake Gemini after a per-model delay, recording starts and cancellations."""
+    def __init__(self):
+        self.client = FakeGeminiClient(FakeGemini(latency_median=0))
+        self.delays = {}
+        self.failing = set()
+        self.started = []
+        self.cancelled = []
+
+    async def attempt(self, model: str) -> str:
+        self.started.append(model)
+        try:
+            await asyncio.sleep(self.delays.get(model, 0))
+            if model in self.failing:
+                raise RuntimeError(f"{model} falhou")
+            return (await self.client.aio.models.generate_content(model=model, contents="prompt")).text
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+
+async def warm_up(hedger: Hedger, models: Models, route: str = "rota"):
+    """Fast calls until the route has enough latencies to compute its hedge delay."""
+    for _ in range(GEMINI_HEDGE_MIN_SAMPLES):
+        await hedger.run(route, "lento", models.attempt)
+    models.started.clear()
+
+def test_unconfigured_route_is_not_hedged():
+    models = Models()
+    models.delays["lento"] = 0.05
+    hedger = Hedger(routes={})
+
+    text, model = asyncio.run(hedger.run("rota", "lento", models.attempt))
+    assert text and model == "lento"
+    assert models.started == ["lento"]
+    assert hedger.stats() == {}
+
+def test_no_hedge_before_the_route_has_latency_samples():
+    models = Models()
+    models.delays["lento"] = 0.05
+    hedger = Hedger(routes={"rota": {"budget": 1.0, "model": "rapido"}})
+
+    _, model = asyncio.run(hedger.run("rota", "lento", models.attempt))
+    assert model == "lento"
+    assert models.started == ["lento"]
+
+def test_slow_call_is_answered_by_the_backup_and_the_primary_cancelled():
+    models = Models()
+    hedger = Hedger(routes={"rota": {"budget": 1.0, "model": "rapido"}})
+
+    async def scenario():
+        await warm_up(hedger, models)
+        models.delays["lento"] = 5.0
+        result = await asyncio.wait_for(hedger.run("rota", "lento", models.attempt), timeout=2)
+        await asyncio.sleep(0)  # Let the cancelled primary unwind
+        return result
+
+    text, model = asyncio.run(scenario())
+    assert text and model == "rapido"
+    assert models.started == ["lento", "rapido"]
+    assert models.cancelled == ["lento"]
+    stats = hedger.stats()["rota"]
+    assert stats["hedged"] == 1 and stats["backup_wins"] == 1
+
+def test_budget_caps_the_share_of_hedged_calls():
+    models = Models()
+    budget = 0.05
+    hedger = Hedger(routes={"rota": {"budget": budget, "model": "rapido"}})
+
+    async def scenario():
+        await warm_up(hedger, models)
+        models.delays["lento"] = 0.05
+        await asyncio.gather(*(hedger.run("rota", "lento", models.attempt) for _ in range(40)))
+
+    asyncio.run(scenario())
+    stats = hedger.stats()["rota"]
+    assert stats["calls"] == GEMINI_HEDGE_MIN_SAMPLES + 40
+    assert 1 <= stats["hedged"] <= budget * stats["calls"]
+    assert models.started.count("rapido") == stats["hedged"]
+
+def test_zero_budget_never_hedges():
+    models = Models()
+    hedger = Hedger(routes={"rota": {"budget": 0.0, "model": "rapido"}})
+
+    async def scenario():
+        await warm_up(hedger, models)
+        models.delays["lento"] = 0.05
+        return await hedger.run("rota", "lento", models.attempt)
+
+    assert asyncio.run(scenario())[1] == "lento"
+    assert "rapido" not in models.started
+
+def test_failed_primary_falls_back_to_the_pending_backup():
+    models = Models()
+    hedger = Hedger(routes={"rota": {"budget": 1.0, "model": "rapido"}})
+
+    async def scenario():
+        await warm_up(hedger, models)
+        models.delays.update({"lento": 0.05, "rapido": 0.1})
+        models.failing.add("lento")
+        return await hedger.run("rota", "lento", models.attempt)
+
+    text, model = asyncio.run(scenario())
+    assert text and model == "rapido"
+    assert hedger.stats()["rota"]["backup_wins"] == 1
+
+def test_error_is_raised_when_every_attempt_fails():
+    models = Models()
+    hedger = Hedger(routes={"rota": {"budget": 1.0, "model": "rapido"}})
+
+    async def scenario():
+        await warm_up(hedger, models)
+        models.delays.update({"lento": 0.05, "rapido": 0.05})
+        models.failing.update({"lento", "rapido"})
+        await hedger.run("rota", "lento", models.attempt)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+    assert models.started == ["lento", "rapido"]
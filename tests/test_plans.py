@@ -0,0 +1,67 @@
+import asyncio
+
+from plans import PlanStore
+
+FIBONACCI = {"task_goal": "Calcular um número de Fibonacci", "phases": [
+    {"step_id": 1, "description": "Gerar código que calcule o 5º número de Fibonacci",
+     "tool_required": "code_generator", "depends_on": []},
+    {"step_id": 2, "description": "Executar o código gerado", "tool_required": "code_execution", "depends_on": [1]},
+]}
+REPORT = {"task_goal": "Relatório sobre bancos", "phases": [
+    {"step_id": 1, "description": "Escrever um relatório sobre bancos", "tool_required": "content_generator",
+     "depends_on": []},
+]}
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_same_shape_reuses_the_plan_with_the_new_parameters(database):
+    store = PlanStore(enabled=True)
+    run(store.store("Calcule o 5º número de Fibonacci", FIBONACCI))
+
+    plan = run(store.lookup("Calcule   o 12º número de fibonacci"))
+    assert plan["phases"][0]["description"] == "Gerar código que calcule o 12º número de Fibonacci"
+    assert plan["phases"][1] == FIBONACCI["phases"][1]
+    assert store.stats()["hits"] == 1
+
+def test_tasks_differing_by_a_word_do_not_share_a_plan(database):
+    store = PlanStore(enabled=True)
+    run(store.store("Escreva um relatório detalhado sobre bancos", REPORT))
+    run(store.store("Crie um site sobre bancos", REPORT))
+
+    assert run(store.lookup("Escreva um relatório detalhado sobre hospitais")) is None
+    assert run(store.lookup("Não crie um site sobre bancos")) is None
+    assert store.stats()["misses"] == 2
+
+def test_number_that_also_appears_elsewhere_in_the_plan_is_not_a_parameter(database):
+    plan = {"task_goal": "Listar 3 itens", "phases": [
+        {"step_id": 1, "description": "Usar Python 3 para listar 3 itens", "tool_required": "code_generator",
+         "depends_on": []},
+    ]}
+    store = PlanStore(enabled=True)
+    run(store.store("Liste 3 itens", plan))
+
+    # "3" appears twice in the plan but once in the task: the plan is only reused for the same number
+    assert run(store.lookup("Liste 4 itens")) is None
+    assert run(store.lookup("Liste 3 itens")) == plan
+
+def test_plan_stored_by_another_process_is_found(database):
+    run(PlanStore(enabled=True).store("Calcule o 5º número de Fibonacci", FIBONACCI))
+
+    other = PlanStore(enabled=True)
+    plan = run(other.lookup("Calcule o 7º número de Fibonacci"))
+    assert plan["phases"][0]["description"] == "Gerar código que calcule o 7º número de Fibonacci"
+    assert database.plan_cache_stats()["hits"] == 1
+
+def test_different_number_of_parameters_is_a_miss(database):
+    store = PlanStore(enabled=True)
+    run(store.store("Calcule o 5º número de Fibonacci", FIBONACCI))
+
+    assert run(store.lookup("Calcule o 5º número de Fibonacci em 2 linguagens")) is None
+
+def test_disabled_store_never_hits(database):
+    store = PlanStore(enabled=False)
+    run(store.store("Calcule o 5º número de Fibonacci", FIBONACCI))
+
+    assert run(store.lookup("Calcule o 5º número de Fibonacci")) is None
+    assert database.plan_cache_stats()["entries"] == 0
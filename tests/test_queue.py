@@ -0,0 +1,82 @@
+import time
+
+LEASE = 60
+
+def test_claim_takes_the_oldest_pending_task_once(database):
+    database.create_task("t1", "primeira")
+    database.create_task("t2", "segunda")
+
+    task = database.claim_task("w1", LEASE, max_attempts=3)
+    assert task["id"] == "t1"
+    assert task["status"] == "IN_PROGRESS"
+    assert task["lease_owner"] == "w1"
+    assert task["attempts"] == 1
+    assert task["lease_expires_at"] > time.time()
+
+    assert database.claim_task("w2", LEASE, max_attempts=3)["id"] == "t2"
+    assert database.claim_task("w3", LEASE, max_attempts=3) is None
+
+def test_heartbeat_renews_only_the_owners_lease(database):
+    database.create_task("t1", "tarefa")
+    database.claim_task("w1", 1, max_attempts=3)
+
+    assert database.heartbeat_task("t1", "w1", LEASE)
+    assert database.get_task("t1")["lease_expires_at"] > time.time() + LEASE / 2
+    assert not database.heartbeat_task("t1", "w2", LEASE)
+
+def test_expired_lease_is_reclaimed_by_another_worker(database):
+    database.create_task("t1", "tarefa")
+    database.claim_task("w1", -1, max_attempts=3)  # Lease already expired: w1 died
+
+    task = database.claim_task("w2", LEASE, max_attempts=3)
+    assert task["id"] == "t1"
+    assert task["lease_owner"] == "w2"
+    assert task["attempts"] == 2
+    # The first worker lost the task and must stop executing it
+    assert not database.heartbeat_task("t1", "w1", LEASE)
+
+def test_live_lease_is_not_reclaimed(database):
+    database.create_task("t1", "tarefa")
+    database.claim_task("w1", LEASE, max_attempts=3)
+
+    assert database.claim_task("w2", LEASE, max_attempts=3) is None
+
+def test_task_fails_after_max_attempts(database):
+    database.create_task("t1", "tarefa", callback_url="http://cliente/callback")
+    for worker in ("w1", "w2"):
+        assert database.claim_task(worker, -1, max_attempts=2)["id"] == "t1"
+
+    assert database.claim_task("w3", LEASE, max_attempts=2) is None
+    task = database.get_task("t1")
+    assert task["status"] == "FAILED"
+    assert task["lease_owner"] is None
+    assert "tentativas" in task["result"]
+    # The final status is delivered to the callback through the outbox
+    outbox = database.get_db_connection().execute("SELECT task_id, callback_url FROM callback_outbox").fetchall()
+    assert [tuple(row) for row in outbox] == [("t1", "http://cliente/callback")]
+
+def test_pending_task_past_its_deadline_is_cancelled_not_run(database):
+    database.create_task("late", "tarefa", deadline_at=time.time() - 1)
+    database.create_task("on_time", "tarefa", deadline_at=time.time() + 60)
+
+    assert database.claim_task("w1", LEASE, max_attempts=3)["id"] == "on_time"
+    assert database.get_task("late")["status"] == "CANCELLED"
+
+def test_higher_priority_lane_is_claimed_first(database):
+    database.create_task("batch", "tarefa", priority=1)
+    database.create_task("interactive", "tarefa", priority=9)
+
+    assert database.claim_task("w1", LEASE, max_attempts=3)["id"] == "interactive"
+    # Slots reserved for interactive tasks do not take lower priorities
+    assert database.claim_task("w2", LEASE, max_attempts=3, min_priority=5) is None
+    assert database.claim_task("w2", LEASE, max_attempts=3)["id"] == "batch"
+
+def test_tenants_take_turns_in_the_same_lane(database):
+    for index in range(3):
+        database.create_task(f"a{index}", "tarefa", tenant="a")
+    database.create_task("b0", "tarefa", tenant="b")
+
+    claimed = [database.claim_task("w", LEASE, max_attempts=3)["id"] for _ in range(4)]
+    # Tenant "a" arrived first with three tasks, but "b" does not wait behind all of them
+    assert claimed.index("b0") <= 1
+    assert [task_id for task_id in claimed if task_id.startswith("a")] == ["a0", "a1", "a2"]
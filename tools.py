@@ -1,16 +1,20 @@
-import os
-import subprocess
-import requests
-from bs4 import BeautifulSoup
-from google import genai
-from google.genai import types
-from typing import List, Dict
+from typing import TYPE_CHECKING, Callable, List, Dict
 
-MODEL_NAME = 'gemini-2.5-flash'
+from context import extract_code
+from fetcher import fetcher, load_sites
+from llm import generate_content
+from routing import router
+from sandbox import sandbox_pool
+from tracing import traced
+
+if TYPE_CHECKING:
+    from google import genai
 
 # --- Tool 1: Code Generation (Uses Gemini) ---
 
-def code_generator(client: genai.Client, prompt: str, language: str = "python") -> str:
+@traced("tool.code_generator")
+async def code_generator(client: "genai.Client", prompt: str, language: str = "python", use_cache: bool = True,
+                         on_delta: Callable[[str], None] = None) -> str:
     """
     Generates code based on a detailed prompt.
     """
@@ -23,93 +27,65 @@ def code_generator(client: genai.Client, prompt: str, language: str = "python")
     
     full_prompt = f"Gere o seguinte código em {language}: {prompt}"
     
-    try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=full_prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction
-            )
-        )
-        
-        # Extract the code block from the response text
-        text = response.text.strip()
-        if text.startswith("```") and text.endswith("```"):
-            lines = text.split('\n')
-            if len(lines) > 2:
-                return '\n'.join(lines[1:-1])
-        
-        return text
-        
-    except Exception as e:
-        return f"Erro na geração de código: {e}"
+    # Gemini errors propagate to the agent (after the scheduler's retries)
+    response_text = await generate_content(
+        client,
+        model=router.model_for("code_generator"),
+        contents=full_prompt,
+        system_instruction=system_instruction,
+        use_cache=use_cache,
+        on_delta=on_delta,
+        route="code_generator",
+    )
+    
+    # Extract the code block from the response text (answers may add prose around the fence)
+    code = extract_code(response_text)
+    return code if code is not None else response_text.strip()
 
 # --- Tool 2: Secure Code Execution (Real Tool) ---
 
-def execute_python_code(code: str) -> str:
+@traced("tool.execute_python_code")
+async def execute_python_code(code: str) -> str:
     """
-    Executes Python code in a secure subprocess and captures output.
+    Executes Python code in a warm, isolated sandbox worker and captures output.
     """
     print("--- Executando Código Python ---")
-    temp_file = "temp_script.py"
     
     try:
-        # 1. Save code to a temporary file
-        with open(temp_file, "w") as f:
-            f.write(code)
-            
-        # 2. Execute the file using a subprocess
-        # Using a timeout to prevent infinite loops
-        result = subprocess.run(
-            ["python3", temp_file],
-            capture_output=True,
-            text=True,
-            timeout=10  # 10 seconds timeout
-        )
-        
-        output = f"STDOUT:\n{result.stdout}\n"
-        if result.stderr:
-            output += f"STDERR (Erro):\n{result.stderr}\n"
-        
-        return output
-        
-    except subprocess.TimeoutExpired:
-        return "Erro de Execução: O código excedeu o tempo limite de 10 segundos."
+        # Dispatched over pipes to a pre-started worker (see sandbox.py): no interpreter start-up,
+        # a private scratch directory per worker and CPU/memory/wall-clock limits per run
+        result = await sandbox_pool.execute(code)
     except Exception as e:
         return f"Erro de Execução: {e}"
-    finally:
-        # 3. Clean up the temporary file
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+    
+    if result["timed_out"]:
+        return f"Erro de Execução: O código excedeu o tempo limite de {sandbox_pool.timeout:g} segundos."
+    
+    output = f"STDOUT:\n{result['stdout']}\n"
+    if result["stderr"]:
+        output += f"STDERR (Erro):\n{result['stderr']}\n"
+    if result["limit_exceeded"]:
+        output += "Erro de Execução: o código excedeu o limite de CPU ou de memória do sandbox.\n"
+    output += (
+        f"Recursos: tempo {result['wall_time']:.3f}s, CPU {result['cpu_time']:.3f}s, "
+        f"memória máx. {result['max_rss_kb']} KB, código de saída {result['exit_code']}\n"
+    )
+    
+    return output
 
 # --- Tool 3: Web Scraper (Real Tool - AI News Gatherer) ---
 
-def web_scraper(client: genai.Client, objective: str) -> str:
+@traced("tool.web_scraper")
+async def web_scraper(client: "genai.Client", objective: str, use_cache: bool = True,
+                      on_delta: Callable[[str], None] = None) -> str:
     """
     Scrapes a set of predefined AI news sites and summarizes the content.
     """
     print("--- Web Scraper (Coletor de Notícias de IA) ---")
     
-    # Predefined list of sites for a robust prototype
-    ai_news_sites = [
-        {"url": "https://www.canaltech.com.br/inteligencia-artificial/", "selector": "h2.title"},
-        {"url": "https://www.tecmundo.com.br/inteligencia-artificial", "selector": "h3.tec--card__title"},
-    ]
-    
-    all_titles = []
-    
-    for site in ai_news_sites:
-        try:
-            response = requests.get(site["url"], timeout=5)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Extract titles based on the selector
-            titles = [tag.get_text(strip=True) for tag in soup.select(site["selector"])][:3]
-            all_titles.extend(titles)
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Erro ao acessar {site['url']}: {e}")
+    # Sources come from scraper_sites.json (SCRAPER_SITES_FILE); all of them are fetched concurrently,
+    # through the shared connection pool and the on-disk HTTP cache
+    all_titles = await fetcher.collect(load_sites())
             
     if not all_titles:
         return "Erro: Não foi possível coletar notícias de IA. As fontes podem estar inacessíveis ou os seletores desatualizados."
@@ -120,18 +96,14 @@ def web_scraper(client: genai.Client, objective: str) -> str:
         f"Títulos coletados: {'; '.join(all_titles)}"
     )
     
-    try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=summary_prompt
-        )
-        return response.text
-    except Exception as e:
-        return f"Erro na sumarização de notícias: {e}"
+    return await generate_content(client, model=router.model_for("web_scraper"), contents=summary_prompt,
+                                  use_cache=use_cache, on_delta=on_delta, route="web_scraper")
 
 # --- Tool 4: Content Generation (Uses Gemini) ---
 
-def content_generator(client: genai.Client, prompt: str) -> str:
+@traced("tool.content_generator")
+async def content_generator(client: "genai.Client", prompt: str, use_cache: bool = True,
+                            on_delta: Callable[[str], None] = None) -> str:
     """
     Generates detailed textual content (reports, summaries, articles) based on a prompt.
     """
@@ -142,21 +114,21 @@ def content_generator(client: genai.Client, prompt: str) -> str:
         "que atenda ao prompt fornecido. O texto deve ser formatado em Markdown."
     )
     
-    try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction
-            )
-        )
-        return response.text
-    except Exception as e:
-        return f"Erro na geração de conteúdo: {e}"
+    return await generate_content(
+        client,
+        model=router.model_for("content_generator"),
+        contents=prompt,
+        system_instruction=system_instruction,
+        use_cache=use_cache,
+        on_delta=on_delta,
+        route="content_generator",
+    )
 
 # --- Tool 5: Data Analyzer (Simulation - Future Expansion) ---
 
-def data_analyzer(client: genai.Client, data_summary: str, analysis_objective: str) -> str:
+@traced("tool.data_analyzer")
+async def data_analyzer(client: "genai.Client", data_summary: str, analysis_objective: str, use_cache: bool = True,
+                        on_delta: Callable[[str], None] = None) -> str:
     """
     Simulates a data analysis operation.
     """
@@ -168,11 +140,5 @@ def data_analyzer(client: genai.Client, data_summary: str, analysis_objective: s
         f"Forneça uma conclusão analítica e um insight."
     )
     
-    try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt
-        )
-        return response.text
-    except Exception as e:
-        return f"Erro na simulação de análise de dados: {e}"
+    return await generate_content(client, model=router.model_for("data_analyzer"), contents=prompt,
+                                  use_cache=use_cache, on_delta=on_delta, route="data_analyzer")
@@ -0,0 +1,256 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+
+# --- Tracing Configuration (environment variables) ---
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") != "0"
+# Persist the spans of each task in `task_spans` (served by GET /tasks/{task_id}/trace)
+TRACE_PERSIST = os.environ.get("TRACE_PERSIST", "1") != "0"
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "1.0"))  # Spans are written in batches
+
+# Seconds; LLM calls and whole tasks take much longer than the Prometheus defaults cover
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_metrics = None
+_metrics_lock = threading.Lock()  # The DB writer thread may record the first metric
+
+def metrics() -> SimpleNamespace:
+    """
+    The process's Prometheus metrics, created on first use: prometheus_client is imported when a metric
+    is first recorded or scraped, not when this module (imported by db, and so by the API) is loaded.
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                from prometheus_client import Counter, Histogram
+                _metrics = SimpleNamespace(
+                    span_seconds=Histogram("agent_span_duration_seconds", "Wall time of traced operations",
+                                           ["span", "status"], buckets=DURATION_BUCKETS),
+                    queue_wait_seconds=Histogram("agent_queue_wait_seconds",
+                                                 "Time spent waiting before an operation started", ["span"],
+                                                 buckets=DURATION_BUCKETS),
+                    gemini_tokens=Counter("gemini_tokens_total", "Gemini tokens reported by usage_metadata",
+                                          ["model", "kind"]),
+                    gemini_retries=Counter("gemini_retries_total", "Gemini calls retried after a transient error",
+                                           ["model"]),
+                    db_lock_wait_seconds=Histogram("db_lock_wait_seconds",
+                                                   "Time a write batch waited for the SQLite write lock",
+                                                   buckets=DURATION_BUCKETS),
+                    llm_cache_lookups=Counter("llm_cache_lookups_total", "Gemini requests by response cache outcome",
+                                              ["result"]),
+                    gemini_hedges=Counter("gemini_hedges_total", "Hedged Gemini calls by route and winning request",
+                                          ["route", "outcome"]),
+                    # Per-route figures of routing.ModelRouter; `source` is "llm", "cached" or "deterministic"
+                    route_requests=Counter("gemini_route_requests_total",
+                                           "Answered requests by route, model and source", ["route", "model", "source"]),
+                    route_latency_seconds=Histogram("gemini_route_latency_seconds",
+                                                    "Latency of answered requests by route and source",
+                                                    ["route", "source"], buckets=DURATION_BUCKETS),
+                    route_tokens=Counter("gemini_route_tokens_total", "Gemini tokens by route", ["route", "kind"]),
+                    route_cost_usd=Counter("gemini_route_cost_usd_total",
+                                           "Estimated Gemini cost (USD) by route and model", ["route", "model"]),
+                )
+    return _metrics
+
+def exposition() -> tuple[bytes, str]:
+    """This process's metrics in the Prometheus text format, with its content type (for GET /metrics)."""
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+    metrics()  # A scrape before any recorded operation still lists the metrics
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+_current_task: contextvars.ContextVar = contextvars.ContextVar("trace_task_id", default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+
+class Span:
+    """One timed operation; attributes are free-form (tokens, cache hits, retries, ...)."""
+    def __init__(self, name: str, task_id: str = None, parent_id: str = None, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.task_id = task_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.queue_wait = 0.0
+        self.status = "ok"
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.duration = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add(self, key: str, amount: float = 1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self, duration: float = None):
+        self.duration = duration if duration is not None else time.monotonic() - self._started
+        metrics().span_seconds.labels(self.name, self.status).observe(self.duration)
+        if self.queue_wait:
+            metrics().queue_wait_seconds.labels(self.name).observe(self.queue_wait)
+        if self.task_id is not None:
+            _exporter.add(self)
+
+    def to_row(self) -> tuple:
+        return (self.task_id, self.span_id, self.parent_id, self.name, self.started_at, self.duration,
+                self.queue_wait, self.status, json.dumps(self.attributes, ensure_ascii=False, default=str))
+
+class SpanExporter:
+    """Buffers finished task spans and writes them to `task_spans` in one DB operation per interval."""
+    def __init__(self, interval: float = TRACE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._buffer: List[Span] = []
+        self._scheduled = False
+
+    def add(self, span: Span):
+        if not TRACE_PERSIST:
+            return
+        self._buffer.append(span)
+        if not self._scheduled:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # Outside an event loop (sync code): flushed with the next async span
+            self._scheduled = True
+            loop.call_later(self.interval, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        self._scheduled = False
+        spans, self._buffer = self._buffer, []
+        if not spans:
+            return
+        # Imported here: db itself records its writes through this module
+        from db import asave_spans
+        try:
+            await asave_spans([span.to_row() for span in spans])
+        except Exception as e:
+            print(f"Erro ao gravar {len(spans)} span(s): {e}")
+
+_exporter = SpanExporter()
+
+async def flush():
+    """Writes the buffered spans now (e.g. before the process exits)."""
+    await _exporter.flush()
+
+def bind_task(task_id: str):
+    """Attributes the spans of the current asyncio task (and of the tasks it creates) to `task_id`."""
+    _current_task.set(task_id)
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """
+    Times the enclosed block as a child of the current span. Works in sync and async code;
+    the span is marked as an error if the block raises (or is cancelled).
+    """
+    if not TRACING_ENABLED:
+        yield Span(name, attributes=attributes)
+        return
+    parent = _current_span.get()
+    current = Span(name, _current_task.get(), parent.span_id if parent else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+
+def traced(name: str):
+    """Decorator form of `span` for coroutine functions (e.g. the tools)."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record(name: str, duration: float, queue_wait: float = 0.0, status: str = "ok", task_ids: List[str] = None,
+           **attributes):
+    """
+    Records an operation timed elsewhere (e.g. a DB write measured around the writer thread).
+    With `task_ids`, the span is stored in each task's trace but observed once in the histograms.
+    """
+    if not TRACING_ENABLED:
+        return
+    parent = _current_span.get()
+    ids = task_ids if task_ids is not None else [_current_task.get()]
+    for index, task_id in enumerate(ids):
+        finished = Span(name, task_id, parent.span_id if parent and task_ids is None else None, attributes)
+        finished.started_at -= duration
+        finished.queue_wait = queue_wait
+        finished.status = status
+        if index == 0:
+            finished.finish(duration)
+        else:
+            finished.duration = duration
+            if task_id is not None:
+                _exporter.add(finished)
+
+def observe_lock_wait(seconds: float):
+    """Time a DB write batch waited for the SQLite write lock (called from the writer thread)."""
+    metrics().db_lock_wait_seconds.observe(seconds)
+
+def add_queue_wait(seconds: float):
+    """Adds waiting time (rate limiter, concurrency slots, ...) to the current span."""
+    current = _current_span.get()
+    if current is not None:
+        current.queue_wait += seconds
+
+def count_retry(model: str):
+    metrics().gemini_retries.labels(model).inc()
+    current = _current_span.get()
+    if current is not None:
+        current.add("retries")
+
+def count_tokens(model: str, usage: Any):
+    """Adds the prompt/response token counts of a Gemini response to the metrics and the current span."""
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_token_count or 0
+    response_tokens = max(0, (usage.total_token_count or 0) - prompt_tokens)
+    tokens = metrics().gemini_tokens
+    tokens.labels(model, "prompt").inc(prompt_tokens)
+    tokens.labels(model, "response").inc(response_tokens)
+    current = _current_span.get()
+    if current is not None:
+        current.add("prompt_tokens", prompt_tokens)
+        current.add("response_tokens", response_tokens)
+
+def count_cache_lookup(hit: bool):
+    metrics().llm_cache_lookups.labels("hit" if hit else "miss").inc()
+    current = _current_span.get()
+    if current is not None:
+        current.set("cache_hit", hit)
+
+def count_hedge(route: str, outcome: str):
+    """Counts a hedged call; `outcome` is "primary", "backup" (the duplicate answered first) or "failed"."""
+    metrics().gemini_hedges.labels(route, outcome).inc()
+    current = _current_span.get()
+    if current is not None:
+        current.set("hedge", outcome)
+
+def observe_route(route: str, model: str, source: str, latency: float, input_tokens: int = 0,
+                  output_tokens: int = 0, cost_usd: float = 0.0):
+    """Exports one answered request of a route (see routing.ModelRouter.record)."""
+    exported = metrics()
+    exported.route_requests.labels(route, model, source).inc()
+    exported.route_latency_seconds.labels(route, source).observe(latency)
+    if input_tokens or output_tokens:
+        exported.route_tokens.labels(route, "input").inc(input_tokens)
+        exported.route_tokens.labels(route, "output").inc(output_tokens)
+    if cost_usd:
+        exported.route_cost_usd.labels(route, model).inc(cost_usd)
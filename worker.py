@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Import the agent and database modules
+from agent import AutonomousAgent
+from db import (
+    TASK_DEFAULT_PRIORITY, TASK_INTERACTIVE_PRIORITY, init_db, warm_up, aclaim_task, acancelled_tasks, aheartbeat_task,
+    aupdate_task_status,
+)
+from cache import response_cache
+from callbacks import callback_dispatcher
+from events import bus
+from fetcher import fetcher
+from hedging import hedger
+from llm import get_client
+from plans import plan_store
+from ratelimit import scheduler, set_priority
+from routing import router
+from sandbox import sandbox_pool
+from tracing import bind_task, flush, metrics, span
+
+# --- Worker Configuration (environment variables) ---
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))  # Max tasks running at once per process
+TASK_LEASE_SECONDS = float(os.environ.get("TASK_LEASE_SECONDS", "60"))  # A task is re-run if its lease is not renewed
+HEARTBEAT_INTERVAL = float(os.environ.get("WORKER_HEARTBEAT_INTERVAL", str(TASK_LEASE_SECONDS / 3)))
+POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "1.0"))  # Idle wait when the queue is empty
+TASK_MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS", "3"))
+# Slots of each process kept for interactive tasks (priority >= TASK_INTERACTIVE_PRIORITY); batch work uses the rest
+WORKER_INTERACTIVE_SLOTS = int(os.environ.get("WORKER_INTERACTIVE_SLOTS", "1"))
+# How often the running tasks are checked for cancellation (DELETE /tasks/{task_id})
+WORKER_CANCEL_CHECK_INTERVAL = float(os.environ.get("WORKER_CANCEL_CHECK_INTERVAL", "1.0"))
+# Prometheus /metrics port of the worker (0 disables); with --processes N, process i listens on port + i
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", "0"))
+# Create the shared clients (Gemini, scraper, DB connections, sandbox pool) in the background at startup,
+# instead of in the first task that needs each of them
+WORKER_PREWARM = os.environ.get("WORKER_PREWARM", "1") == "1"
+
+# --- Agent Execution ---
+
+async def run_agent_task(task_id: str, task_description: str, callback_url: str, queue_wait: float = 0.0,
+                         priority: int = TASK_DEFAULT_PRIORITY, deadline_at: float = None):
+    """
+    Executes the autonomous agent's task and updates the DB. The final status update also records
+    the callback in the outbox (same transaction); the callback dispatcher delivers it.
+    Everything the run does is traced under a "task.run" span (see GET /tasks/{task_id}/trace);
+    `queue_wait` is the time the task waited in the queue before being claimed.
+
+    If the task has a deadline (`deadline_at`, epoch seconds), the run is cancelled wherever it is
+    when the deadline passes (between or during steps) and the task ends as CANCELLED.
+    """
+    final_result = ""
+    bind_task(task_id)
+    set_priority(priority)
+
+    with span("task.run", priority=priority) as current:
+        current.queue_wait = queue_wait
+        # Check for API Key
+        if "GEMINI_API_KEY" not in os.environ:
+            final_result = "ERRO: GEMINI_API_KEY não configurada no ambiente do servidor."
+            await aupdate_task_status(task_id, "FAILED", final_result)
+            bus.publish(task_id, "task_failed", {"error": final_result})
+            current.status = "error"
+        else:
+            deadline = asyncio.timeout(max(0.0, deadline_at - time.time()) if deadline_at else None)
+            try:
+                # The agent now takes the task_id and a function to update the DB status
+                agent = AutonomousAgent(task_id=task_id)
+                async with deadline:
+                    final_result = await agent.run(task_description, aupdate_task_status)
+                bus.publish(task_id, "task_completed", {"result": final_result})
+
+            except Exception as e:
+                # Only the task's own deadline cancels it; any other timeout (e.g. an HTTP call) is a failure
+                if isinstance(e, TimeoutError) and deadline.expired():
+                    final_result = "ERRO: prazo (deadline) excedido durante a execução; tarefa cancelada."
+                    await aupdate_task_status(task_id, "CANCELLED", final_result)
+                    bus.publish(task_id, "task_cancelled", {"reason": final_result})
+                    current.status = "cancelled"
+                else:
+                    final_result = f"ERRO CRÍTICO durante a execução do agente: {e}"
+                    await aupdate_task_status(task_id, "FAILED", final_result)
+                    bus.publish(task_id, "task_failed", {"error": final_result})
+                    current.status = "error"
+
+    # The result is already in the callback outbox; wake the dispatcher to send it right away
+    if callback_url:
+        callback_dispatcher.wake()
+    else:
+        print(f"Tarefa {task_id} concluída, mas sem URL de callback para envio do resultado.")
+
+# --- Worker Loop ---
+
+class Worker:
+    """
+    Claims tasks from the `tasks` table and runs them with bounded concurrency.
+
+    Each claimed task holds a lease that is renewed by a heartbeat while the agent runs.
+    If the process dies, the lease expires and another worker re-runs the task.
+
+    The last `interactive_slots` free slots only take interactive tasks (priority >=
+    TASK_INTERACTIVE_PRIORITY), so batch work cannot occupy every slot. Runs of tasks cancelled
+    through the API are stopped within WORKER_CANCEL_CHECK_INTERVAL.
+    """
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY, worker_id: str = None,
+                 interactive_slots: int = WORKER_INTERACTIVE_SLOTS):
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # At least one slot always stays open to batch work
+        self.interactive_slots = max(0, min(interactive_slots, concurrency - 1))
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running = set()
+        self._runs: dict[str, asyncio.Task] = {}  # task_id -> agent run, for cancellation
+        self._cancelled = set()
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        """Stops claiming new tasks; tasks already running are allowed to finish."""
+        self._stopping.set()
+
+    async def run(self):
+        """Main loop: waits for a free slot, claims a task and starts it."""
+        print(f"Worker {self.worker_id} iniciado (concorrência: {self.concurrency}, "
+              f"vagas interativas: {self.interactive_slots})")
+        watcher = asyncio.create_task(self._watch_cancellations())
+
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            # Free slots, counting the one just acquired
+            free = self.concurrency - len(self._running)
+            min_priority = TASK_INTERACTIVE_PRIORITY if free <= self.interactive_slots else None
+            try:
+                task = await aclaim_task(self.worker_id, TASK_LEASE_SECONDS, TASK_MAX_ATTEMPTS, min_priority)
+            except Exception as e:
+                print(f"Erro ao reivindicar tarefa: {e}")
+                task = None
+
+            if task is None:
+                self._slots.release()
+                # Sleep until the next poll, waking up early on shutdown
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            execution = asyncio.create_task(self._execute(task))
+            self._running.add(execution)
+            execution.add_done_callback(self._running.discard)
+
+        if self._running:
+            print(f"Worker {self.worker_id} aguardando {len(self._running)} tarefa(s) em execução...")
+            await asyncio.gather(*self._running, return_exceptions=True)
+        watcher.cancel()
+        print(f"Cache de respostas do Gemini: {response_cache.stats()}")
+        print(f"Limites do Gemini por modelo: {scheduler.stats()}")
+        print(f"Latência e custo por rota: {router.stats()}")
+        print(f"Hedging de chamadas ao Gemini: {hedger.stats()}")
+        print(f"Cache de planos: {plan_store.stats()}")
+        print(f"Worker {self.worker_id} finalizado.")
+
+    async def _execute(self, task: dict):
+        """Runs one claimed task while keeping its lease alive."""
+        task_id = task["id"]
+        print(f"Worker {self.worker_id} executando tarefa {task_id} (tentativa {task['attempts']})")
+
+        # Queue wait of the first attempt only: a re-run task was not waiting since its creation
+        queue_wait = 0.0
+        if task["attempts"] == 1 and task.get("created_at"):
+            created_at = datetime.strptime(task["created_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+            queue_wait = max(0.0, datetime.now(timezone.utc).timestamp() - created_at.timestamp())
+        run = asyncio.create_task(
+            run_agent_task(task_id, task["task_description"], task["callback_url"], queue_wait,
+                           task["priority"], task["deadline_at"])
+        )
+        self._runs[task_id] = run
+        heartbeat = asyncio.create_task(self._heartbeat(task_id, run))
+        try:
+            await run
+        except asyncio.CancelledError:
+            if task_id in self._cancelled:
+                print(f"Tarefa {task_id} interrompida: cancelada pelo cliente.")
+                # The cancellation already wrote the callback to the outbox
+                callback_dispatcher.wake()
+            else:
+                print(f"Tarefa {task_id} abandonada: lease perdido para outro worker.")
+        finally:
+            heartbeat.cancel()
+            del self._runs[task_id]
+            self._cancelled.discard(task_id)
+            self._slots.release()
+
+    async def _heartbeat(self, task_id: str, run: asyncio.Task):
+        """Renews the lease periodically; cancels the run if the lease was lost (or the task cancelled)."""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                renewed = await aheartbeat_task(task_id, self.worker_id, TASK_LEASE_SECONDS)
+            except Exception as e:
+                # A transient DB error should not kill the task; the lease still has time left
+                print(f"Erro no heartbeat da tarefa {task_id}: {e}")
+                continue
+            if not renewed:
+                # Lost to another worker, or cancelled through the API before the watcher noticed
+                try:
+                    if await acancelled_tasks([task_id]):
+                        self._cancelled.add(task_id)
+                finally:
+                    run.cancel()
+                return
+
+    async def _watch_cancellations(self):
+        """Cancels the runs of tasks marked CANCELLED in the DB (DELETE /tasks/{task_id})."""
+        while True:
+            await asyncio.sleep(WORKER_CANCEL_CHECK_INTERVAL)
+            if not self._runs:
+                continue
+            try:
+                cancelled = await acancelled_tasks(list(self._runs))
+            except Exception as e:
+                print(f"Erro ao verificar cancelamentos: {e}")
+                continue
+            for task_id in cancelled:
+                if task_id in self._runs and task_id not in self._cancelled:
+                    self._cancelled.add(task_id)
+                    self._runs[task_id].cancel()
+
+async def prewarm():
+    """
+    Loads the heavy SDKs and creates the shared clients while the worker is already claiming tasks:
+    the Gemini client (importing google.genai), the scraper's HTTP client and HTML parser, the DB
+    connections and the sandbox pool. A task that needs one of them first simply creates it itself.
+    """
+    started = time.monotonic()
+    try:
+        await asyncio.to_thread(get_client)
+        await asyncio.to_thread(importlib.import_module, "bs4")
+        fetcher.client()
+        await asyncio.to_thread(warm_up)
+        await sandbox_pool.start()
+        print(f"Worker pré-aquecido em {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        print(f"Erro no pré-aquecimento do worker: {e}")
+
+async def serve(concurrency: int = WORKER_CONCURRENCY):
+    """Runs a single worker (and the callback dispatcher) until SIGINT/SIGTERM."""
+    worker = Worker(concurrency=concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    warming = asyncio.create_task(prewarm()) if WORKER_PREWARM else None
+    dispatcher = asyncio.create_task(callback_dispatcher.run())
+    await worker.run()
+    # Stop only after the running tasks finished, so their callbacks go out before exit
+    callback_dispatcher.stop()
+    await dispatcher
+    if warming is not None:
+        await warming
+    await flush()
+
+def _worker_process(concurrency: int, metrics_port: int = 0):
+    if metrics_port:
+        # Each process serves its own metrics; Prometheus scrapes every port
+        from prometheus_client import start_http_server
+        metrics()  # Registered now, so a scrape before the first task lists them
+        start_http_server(metrics_port)
+        print(f"Métricas Prometheus do worker em http://0.0.0.0:{metrics_port}/metrics")
+    asyncio.run(serve(concurrency))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker pool for 7z IA Exclusive agent tasks.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to start.")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="Max concurrent tasks per process.")
+    parser.add_argument("--metrics-port", type=int, default=WORKER_METRICS_PORT,
+                        help="Prometheus metrics port (process i uses port + i; 0 disables).")
+    args = parser.parse_args()
+
+    # Make sure the schema (including the queue columns) exists before any claim
+    init_db()
+
+    if args.processes <= 1:
+        _worker_process(args.concurrency, args.metrics_port)
+    else:
+        processes = [
+            multiprocessing.Process(
+                target=_worker_process, args=(args.concurrency, args.metrics_port + i if args.metrics_port else 0)
+            )
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        # Forward SIGTERM so every child stops claiming and drains its running tasks
+        signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in processes])
+        for process in processes:
+            process.join()